@@ -1,7 +1,8 @@
 # flake8: noqa
 from .version import __version__
 from .manager_utils import (
-    ManagerUtilsMixin, ManagerUtilsManager, ManagerUtilsQuerySet, post_bulk_operation,
-    upsert, bulk_update, single, get_or_none, bulk_upsert, bulk_upsert2, id_dict, sync,
-    sync2
+    ManagerUtilsMixin, ManagerUtilsManager, ManagerUtilsQuerySet, post_bulk_operation, RetryPolicy,
+    UpsertBuffer, upsert, bulk_update, single, register_cached_single, get_or_none, get_or_none_many, bulk_upsert,
+    bulk_upsert2, id_dict, sync, sync2, stream_sync2, sync_partitioned, upsert_graph, sync_m2m, claim, identity_map
 )
+from .upsert2 import Excluded
@@ -1,11 +1,25 @@
+from collections import Counter, namedtuple
+from contextlib import contextmanager
+from contextvars import ContextVar
+import copy
 import itertools
+import random
+import threading
+import time
+import uuid
+import zlib
 from typing import List
 
-from django.db import connection
-from django.db.models import Manager, Model
+from django.core.cache import caches
+from django.core.exceptions import EmptyResultSet
+from django.db import connection, transaction, DatabaseError
+from django.db.models import BooleanField, Manager, Model, Q
+from django.db.models.expressions import RawSQL
+from django.db.models.deletion import Collector
 from django.db.models.query import QuerySet
+from django.db.models.signals import post_delete, post_save
+from django.db.models.sql import DeleteQuery, UpdateQuery
 from django.dispatch import Signal
-from querybuilder.query import Query
 
 from . import upsert2
 
@@ -17,10 +31,274 @@ providing_args=['model']
 """
 
 
-def id_dict(queryset):
+class RetryPolicy(object):
+    """
+    Defines how a bulk write is retried when it fails because of a deadlock or a serialization failure.
+    Each attempt runs in its own savepoint so that only the failed write is retried.
+
+    :type max_attempts: int
+    :param max_attempts: The maximum number of times the write is attempted.
+
+    :type backoff: float
+    :param backoff: The base number of seconds to wait before a retry. The wait grows exponentially
+            with each retry and is jittered to spread out concurrent writers.
+
+    :type max_backoff: float
+    :param max_backoff: The maximum number of seconds to wait before a retry.
+
+    :type retryable_sqlstates: list of str
+    :param retryable_sqlstates: The SQLSTATE codes of the errors that are retried. Defaults to
+            deadlock_detected (40P01) and serialization_failure (40001).
+    """
+    def __init__(self, max_attempts=3, backoff=0.05, max_backoff=1.0, retryable_sqlstates=('40P01', '40001')):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retryable_sqlstates = frozenset(retryable_sqlstates)
+
+    def is_retryable(self, error):
+        """
+        Returns True if the database error has one of the retryable SQLSTATE codes.
+        """
+        # psycopg2 provides the code as pgcode and psycopg3 as sqlstate
+        cause = error.__cause__
+        sqlstate = getattr(cause, 'pgcode', None) or getattr(cause, 'sqlstate', None)
+        return sqlstate in self.retryable_sqlstates
+
+    def get_backoff(self, retry):
+        """
+        Returns the number of seconds to wait before the given retry.
+        """
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (retry - 1)))
+
+
+def _run_with_retries(retry_policy, func):
+    """
+    Runs a bulk write, retrying it in a savepoint according to the retry policy. Returns a tuple of the
+    result of the write and the number of retries.
+    """
+    if retry_policy is None:
+        return func(), 0
+
+    retries = 0
+    while True:
+        try:
+            with transaction.atomic():
+                return func(), retries
+        except DatabaseError as error:
+            if retries + 1 >= retry_policy.max_attempts or not retry_policy.is_retryable(error):
+                raise
+            retries += 1
+            time.sleep(retry_policy.get_backoff(retries))
+
+
+# The identity map of the current context, keyed on the model and then on the query
+_identity_map = ContextVar('identity_map', default=None)
+_identity_map_lock = threading.Lock()
+_identity_map_count = 0
+
+
+def _invalidate_identity_map(sender, **kwargs):
+    """
+    Drops the cached objects of a model from the identity map when the model is changed.
+    """
+    cache = _identity_map.get()
+    if cache is not None:
+        cache.pop(sender._meta.concrete_model, None)
+
+
+def _connect_identity_map_receivers(connect):
+    """
+    Connects or disconnects the receivers that invalidate identity maps. They are only connected
+    while an identity map is in use since listening to post_delete disables Django's fast deletes.
+    """
+    for signal in (post_bulk_operation, post_save, post_delete):
+        if connect:
+            signal.connect(_invalidate_identity_map, dispatch_uid='manager_utils_identity_map')
+        else:
+            signal.disconnect(dispatch_uid='manager_utils_identity_map')
+
+
+@contextmanager
+def identity_map():
+    """
+    Memoizes the results of get_or_none and single within a block, such as a request. Repeating a lookup
+    returns the same object without querying the database. The cached objects of a model are dropped when
+    a post_bulk_operation, post_save or post_delete signal is sent for the model. Changes made by other
+    threads or processes during the block are not seen.
+
+    Examples:
+
+    .. code-block:: python
+
+        with identity_map():
+            model_obj = get_or_none(TestModel.objects, int_field=1)
+
+            # The object is returned from the identity map
+            print(get_or_none(TestModel.objects, int_field=1) is model_obj)
+            True
+
+    """
+    global _identity_map_count
+
+    with _identity_map_lock:
+        if _identity_map_count == 0:
+            _connect_identity_map_receivers(True)
+        _identity_map_count += 1
+
+    token = _identity_map.set({})
+    try:
+        yield
+    finally:
+        _identity_map.reset(token)
+        with _identity_map_lock:
+            _identity_map_count -= 1
+            if _identity_map_count == 0:
+                _connect_identity_map_receivers(False)
+
+
+def _get_from_identity_map(queryset, get, **query_params):
+    """
+    Returns the object fetched by get for a lookup on a queryset, memoizing it in the identity map when one
+    is in use.
+    """
+    cache = _identity_map.get()
+    key = _get_query_key(queryset, **query_params) if cache is not None else None
+    if key is None:
+        return get()
+
+    model_cache = cache.setdefault(queryset.model._meta.concrete_model, {})
+    if key not in model_cache:
+        model_cache[key] = get()
+    return model_cache[key]
+
+
+def _get_query_key(queryset, **query_params):
+    """
+    Gets a key for a lookup on a queryset from its compiled sql. Returns None if the lookup cannot match any rows.
+    """
+    try:
+        sql, params = queryset.filter(**query_params).query.sql_with_params()
+    except EmptyResultSet:
+        return None
+    return queryset.db, sql, repr(params)
+
+
+# The process level cache of single, keyed on the model and then on the query
+_single_cache = {}
+_single_cache_generations = {}
+_single_cache_aliases = {}
+_single_cache_lock = threading.Lock()
+_SingleCacheEntry = namedtuple('SingleCacheEntry', ['obj', 'expires_at', 'version'])
+
+
+def _get_single_cache_version_key(model):
+    return 'manager_utils.single.{0}'.format(model._meta.label)
+
+
+def _invalidate_single_cache(sender, using=None, **kwargs):
+    """
+    Drops the cached objects of a model from the cache of single when the model is changed, and
+    notifies other processes through the cache framework. Readers can cache the old row again until
+    the change is committed, so the cache is invalidated again on commit.
+    """
+    _bump_single_cache_version(sender)
+    transaction.on_commit(lambda: _bump_single_cache_version(sender), using=using)
+
+
+def _bump_single_cache_version(sender):
+    """
+    Used by _invalidate_single_cache to drop the cached objects of a model and change its version.
+    """
+    with _single_cache_lock:
+        _single_cache.pop(sender, None)
+        _single_cache_generations[sender] = _single_cache_generations.get(sender, 0) + 1
+        cache_aliases = list(_single_cache_aliases[sender])
+
+    for cache_alias in cache_aliases:
+        caches[cache_alias].set(_get_single_cache_version_key(sender), uuid.uuid4().hex, None)
+
+
+def _register_single_cache(model, cache_alias):
+    """
+    Connects the receivers that invalidate the cache of single for a model. They are only connected
+    for models that are cached since listening to post_delete disables Django's fast deletes.
+    """
+    with _single_cache_lock:
+        if model not in _single_cache_aliases:
+            _single_cache_aliases[model] = set()
+            for signal in (post_bulk_operation, post_save, post_delete):
+                signal.connect(_invalidate_single_cache, sender=model, dispatch_uid='manager_utils_single_cache')
+        if cache_alias is not None:
+            _single_cache_aliases[model].add(cache_alias)
+
+
+def register_cached_single(model, cache_alias):
+    """
+    Registers a cache alias that changes to a model are announced on, invalidating the objects that other
+    processes cached with ``single(cached=True, cache_alias=cache_alias)``. Call it when processes that write
+    the model without reading it with single start, for example in ``AppConfig.ready``.
+
+    :type model: :class:`Model <django:django.db.models.Model>`
+    :param model: The model that is cached.
+
+    :type cache_alias: str
+    :param cache_alias: The alias of the Django cache that the readers of the model use.
+
+    Examples:
+
+    .. code-block:: python
+
+        class MyAppConfig(AppConfig):
+            def ready(self):
+                register_cached_single(self.get_model('SiteConfig'), 'default')
+
+    """
+    _register_single_cache(model, cache_alias)
+
+
+def _get_cached_single(queryset, ttl, cache_alias):
+    """
+    Used by single to return a copy of the object from the process level cache, fetching it when it is
+    not cached, expired, or invalidated by another process.
+    """
+    model = queryset.model
+    key = _get_query_key(queryset)
+    if key is None:
+        return queryset.get()
+
+    _register_single_cache(model, cache_alias)
+    version = caches[cache_alias].get(_get_single_cache_version_key(model)) if cache_alias is not None else None
+    entry = _single_cache.get(model, {}).get(key)
+    if entry is None or entry.version != version or (entry.expires_at or float('inf')) <= time.monotonic():
+        generation = _single_cache_generations.get(model, 0)
+        entry = _SingleCacheEntry(
+            queryset.get(), time.monotonic() + ttl if ttl is not None else None, version
+        )
+
+        # Do not cache the object if the model was changed while it was fetched
+        with _single_cache_lock:
+            if _single_cache_generations.get(model, 0) == generation:
+                _single_cache.setdefault(model, {})[key] = entry
+
+    return copy.deepcopy(entry.obj)
+
+
+def id_dict(queryset, key='pk', fields=None, chunk_size=None):
     """
     Returns a dictionary of all the objects keyed on their ID.
 
+    :type key: str or list of str
+    :param key: The field that the dictionary is keyed on. If a list of fields is provided, the dictionary
+            is keyed on tuples of their values. Defaults to the primary key.
+
+    :type fields: list of str
+    :param fields: Return tuples of the values of these fields instead of objects.
+
+    :type chunk_size: int
+    :param chunk_size: Stream the rows from the database in chunks of this size with the queryset's
+            iterator, rather than loading them all at once. Prefetched relations are ignored when streaming.
+
     :rtype: dict
     :returns: A dictionary of objects from the queryset or manager that is keyed
             on the objects' IDs.
@@ -34,11 +312,63 @@ def id_dict(queryset):
 
         print(id_dict(TestModel.objects.all()))
 
+        # Key the values of a field on a composite key
+        print(id_dict(TestModel.objects.all(), key=['int_field', 'char_field'], fields=['float_field']))
+
+    """
+    model = queryset.model
+    key_attnames = [
+        model._meta.pk.attname if field == 'pk' else model._meta.get_field(field).attname
+        for field in ([key] if isinstance(key, str) else key)
+    ]
+
+    if fields is not None:
+        rows = queryset.values_list(*key_attnames, *fields)
+        get_key = lambda row: row[:len(key_attnames)]
+        get_value = lambda row: row[len(key_attnames):]
+    else:
+        # Iterate the queryset itself so that the results of an evaluated queryset are reused
+        rows = queryset
+        get_key = lambda obj: _get_unique_key(obj, key_attnames)
+        get_value = lambda obj: obj
+
+    if chunk_size is not None:
+        rows = rows.iterator(chunk_size=chunk_size)
+
+    if isinstance(key, str):
+        return {get_key(row)[0]: get_value(row) for row in rows}
+    return {get_key(row): get_value(row) for row in rows}
+
+
+def _get_unique_key(model_obj, unique_attnames):
+    """
+    Gets the tuple of unique field values that identifies a model obj in an upsert.
+    """
+    return tuple(getattr(model_obj, attname) for attname in unique_attnames)
+
+
+def _fetch_extant_model_objs(queryset, model_objs, unique_attnames, only_fields=None, batch_size=1000):
     """
-    return {obj.pk: obj for obj in queryset}
+    Used by bulk_upsert to fetch the objects in the queryset that match the unique keys of model_objs.
+    Returns a dictionary of the matching objects keyed on their unique keys.
+    """
+    unique_keys = list(dict.fromkeys(_get_unique_key(model_obj, unique_attnames) for model_obj in model_objs))
+
+    extant_model_objs = {}
+    for i in range(0, len(unique_keys), batch_size):
+        batch_queryset = upsert2._filter_by_unique_keys(queryset, unique_attnames, unique_keys[i:i + batch_size])
+        if only_fields is not None:
+            batch_queryset = batch_queryset.only(*only_fields)
+
+        extant_model_objs.update(
+            (_get_unique_key(extant_model_obj, unique_attnames), extant_model_obj)
+            for extant_model_obj in batch_queryset
+        )
+
+    return extant_model_objs
 
 
-def _get_model_objs_to_update_and_create(model_objs, unique_fields, update_fields, extant_model_objs):
+def _get_model_objs_to_update_and_create(model_objs, unique_attnames, update_fields, extant_model_objs):
     """
     Used by bulk_upsert to gather lists of models that should be updated and created.
     """
@@ -46,7 +376,7 @@ def _get_model_objs_to_update_and_create(model_objs, unique_fields, update_field
     # Find all of the objects to update and all of the objects to create
     model_objs_to_update, model_objs_to_create = list(), list()
     for model_obj in model_objs:
-        extant_model_obj = extant_model_objs.get(tuple(getattr(model_obj, field) for field in unique_fields), None)
+        extant_model_obj = extant_model_objs.get(_get_unique_key(model_obj, unique_attnames), None)
         if extant_model_obj is None:
             # If the object needs to be created, make a new instance of it
             model_objs_to_create.append(model_obj)
@@ -86,6 +416,98 @@ def _fetch_models_by_pk(queryset: QuerySet, models: List[Model]) -> List[Model]:
     )
 
 
+def _bulk_create_returning(queryset, model_objs, batch_size=1000):
+    """
+    Bulk creates a list of model objects with INSERT ... RETURNING statements in batches. The returned models
+    are hydrated from the inserted rows, and the primary keys of the provided model objects are set.
+    """
+    if not model_objs:
+        return []
+
+    created_models = []
+    for i in range(0, len(model_objs), batch_size):
+        created_models.extend(_insert_returning(queryset, model_objs[i:i + batch_size]))
+
+    post_bulk_operation.send(sender=queryset.model, model=queryset.model)
+    return created_models
+
+
+def _insert_returning(queryset, model_objs):
+    """
+    Used by _bulk_create_returning to insert a batch of model objects with a single INSERT ... RETURNING statement.
+    """
+    model = queryset.model
+    fields = model._meta.local_concrete_fields
+
+    # Build the row values, letting the database generate any primary keys that are not set
+    row_values, sql_args = [], []
+    for model_obj in model_objs:
+        row_sql = []
+        for field in fields:
+            if field.primary_key and getattr(model_obj, field.attname) is None:
+                row_sql.append('DEFAULT')
+            else:
+                row_sql.append('%s')
+                sql_args.append(field.get_db_prep_save(field.pre_save(model_obj, True), connection))
+        row_values.append('({0})'.format(', '.join(row_sql)))
+
+    fields_sql = ', '.join('"{0}"'.format(field.column) for field in fields)
+    insert_sql = 'INSERT INTO "{table}" ({fields_sql}) VALUES {values_sql} RETURNING {fields_sql}'.format(
+        table=model._meta.db_table,
+        fields_sql=fields_sql,
+        values_sql=', '.join(row_values)
+    )
+
+    # Postgres returns the inserted rows in the order of the values list
+    created_models = list(queryset.raw(insert_sql, sql_args))
+    for model_obj, created_model in zip(model_objs, created_models):
+        model_obj.pk = created_model.pk
+        model_obj._state.adding = False
+        model_obj._state.db = created_model._state.db
+
+    return created_models
+
+
+def _create_model_objs(queryset, model_objs, return_models):
+    """
+    Used by bulk_upsert to create model objects. When the created models are returned, postgres returns
+    them from the insert itself unless the queryset filters them or hydrates relationships. Otherwise the
+    newly created models are fetched through the queryset by their primary keys.
+    """
+    query = queryset.query
+    if (
+        return_models and connection.vendor == 'postgresql' and not query.has_filters() and
+        not query.select_related and not query.annotations and not queryset._prefetch_related_lookups
+    ):
+        return _bulk_create_returning(queryset, model_objs)
+
+    created_models = queryset.bulk_create(model_objs)
+    return _fetch_models_by_pk(queryset, created_models) if return_models else created_models
+
+
+def _bulk_upsert_native(
+    queryset, model_objs, unique_fields, update_fields, return_upserts, return_upserts_distinct, sync
+):
+    """
+    Used by bulk_upsert to perform a postgres insert on conflict (upsert) with the upsert2 engine.
+    Matched objects are returned as updated models whether or not their values changed.
+    """
+    model = queryset.model
+    if model_objs:
+        unique_fields = [model._meta.get_field(field).attname for field in unique_fields]
+        update_fields = [model._meta.get_field(field).attname for field in update_fields]
+    return_models = return_upserts or return_upserts_distinct or sync
+    results = upsert2.upsert(
+        queryset, model_objs, unique_fields, update_fields=update_fields, sync=sync,
+        return_untouched=return_models, return_models=return_models
+    )
+    post_bulk_operation.send(sender=queryset.model, model=queryset.model)
+
+    if return_upserts_distinct:
+        return list(itertools.chain(results.updated, results.untouched)), list(results.created)
+    return [result for result in results if result.status_ != 'd']
+
+
 def bulk_upsert(
     queryset, model_objs, unique_fields, update_fields=None, return_upserts=False, return_upserts_distinct=False,
     sync=False, native=False
@@ -97,7 +519,8 @@ def bulk_upsert(
     that don't match anything are bulk created.
     A user can provide a list update_fields so that any changed values on those fields will be updated.
     However, if update_fields is not provided, this function reduces down to performing a bulk_create
-    on any non extant objects.
+    on any non extant objects. Only the objects in the queryset whose unique field values match the
+    provided objects are fetched.
 
     :type model_objs: list of :class:`Models<django:django.db.models.Model>`
     :param model_objs: A list of models to upsert.
@@ -113,12 +536,14 @@ def bulk_upsert(
 
     :type return_upserts_distinct: bool
     :param return_upserts_distinct: A flag specifying whether to return the upserted values as a list of distinct lists,
-            one containing the updated models and the other containing the new models. If True, this performs an
-            additional query to fetch any bulk created values.
+            one containing the updated models and the other containing the new models. On postgres, the new
+            models are hydrated from the insert itself unless the queryset is filtered or hydrates relationships.
+            Otherwise an additional query fetches any bulk created values through the queryset.
 
     :type return_upserts: bool
-    :param return_upserts: A flag specifying whether to return the upserted values. If True, this performs
-            an additional query to fetch any bulk created values.
+    :param return_upserts: A flag specifying whether to return the upserted values. On postgres, the new
+            models are hydrated from the insert itself unless the queryset is filtered or hydrates relationships.
+            Otherwise an additional query fetches any bulk created values through the queryset.
 
     :type sync: bool
     :param sync: A flag specifying whether a sync operation should be applied to the bulk_upsert. If this
@@ -126,7 +551,8 @@ def bulk_upsert(
             entire list of model objects is synced to the queryset.
 
     :type native: bool
-    :param native: A flag specifying whether to use postgres insert on conflict (upsert).
+    :param native: A flag specifying whether to use postgres insert on conflict (upsert). The upsert and
+            the returned models are handled in a single statement.
 
     :signals: Emits a post_bulk_operation when a bulk_update or a bulk_create occurs.
 
@@ -191,55 +617,45 @@ def bulk_upsert(
     update_fields = update_fields or []
 
     if native:
-        if return_upserts_distinct:
-            raise NotImplementedError('return upserts distinct not supported with native postgres upsert')
-        return_value = Query().from_table(table=queryset.model).upsert(
-            model_objs, unique_fields, update_fields, return_models=return_upserts or sync
-        ) or []
-        if sync:
-            orig_ids = frozenset(queryset.values_list('pk', flat=True))
-            queryset.filter(pk__in=orig_ids - frozenset([m.pk for m in return_value])).delete()
-
-        post_bulk_operation.send(sender=queryset.model, model=queryset.model)
-        return return_value
-
-    # Create a look up table for all of the objects in the queryset keyed on the unique_fields
-    extant_model_objs = {
-        tuple(getattr(extant_model_obj, field) for field in unique_fields): extant_model_obj
-        for extant_model_obj in queryset
-    }
+        return _bulk_upsert_native(
+            queryset, model_objs, unique_fields, update_fields, return_upserts, return_upserts_distinct, sync)
+
+    # Only fetch the objects in the queryset that match the unique keys of the model objs. When the
+    # upserted models are not returned, only the fields needed to match and update them are loaded
+    model = queryset.model
+    unique_attnames = [model._meta.get_field(field).attname for field in unique_fields] if model_objs else []
+    only_fields = None
+    if not return_upserts and not return_upserts_distinct:
+        only_fields = [model._meta.pk.attname] + unique_attnames + list(update_fields)
+    extant_model_objs = _fetch_extant_model_objs(queryset, model_objs, unique_attnames, only_fields=only_fields)
 
     # Find all of the objects to update and all of the objects to create
     model_objs_to_update, model_objs_to_create = _get_model_objs_to_update_and_create(
-        model_objs, unique_fields, update_fields, extant_model_objs)
+        model_objs, unique_attnames, update_fields, extant_model_objs)
 
-    # Find all objects in the queryset that will not be updated. These will be deleted if the sync option is
-    # True
+    # Delete all objects in the queryset that will not be updated if the sync option is True
     if sync:
-        model_objs_to_update_set = frozenset(model_objs_to_update)
-        model_objs_to_delete = [
-            model_obj.pk for model_obj in extant_model_objs.values() if model_obj not in model_objs_to_update_set
-        ]
-        if model_objs_to_delete:
-            queryset.filter(pk__in=model_objs_to_delete).delete()
+        queryset.exclude(pk__in=[model_obj.pk for model_obj in model_objs_to_update]).delete()
 
     # Apply bulk updates and creates
     if update_fields:
         bulk_update(queryset, model_objs_to_update, update_fields)
-    created_models = queryset.bulk_create(model_objs_to_create)
+    created_models = _create_model_objs(queryset, model_objs_to_create, return_upserts or return_upserts_distinct)
 
     # Optionally return the bulk upserted values
     if return_upserts_distinct:
         # return a list of lists, the first being the updated models, the second being the newly created objects
-        return model_objs_to_update, _fetch_models_by_pk(queryset, created_models)
+        return model_objs_to_update, created_models
     if return_upserts:
         # return a union list of created and updated models
-        return model_objs_to_update + _fetch_models_by_pk(queryset, created_models)
+        return model_objs_to_update + created_models
 
 
 def bulk_upsert2(
     queryset, model_objs, unique_fields, update_fields=None, returning=False,
-    ignore_duplicate_updates=True, return_untouched=False
+    ignore_duplicate_updates=True, return_untouched=False, retry_policy=None, hash_field=None,
+    exclude_unchanged=False, on_duplicate_input=None, update_condition=None, unique_constraint=None,
+    unique_condition=None, dry_run=False, natural_keys=None, on_unresolved='error'
 ):
     """
     Performs a bulk update or insert on a list of model objects. Matches all objects in the queryset
@@ -257,19 +673,53 @@ def bulk_upsert2(
             if sync=True.
         unique_fields (List[str]): A list of fields that define the uniqueness of the model. The
             model must have a unique constraint on these fields
-        update_fields (List[str], default=None): A list of fields to update whenever objects
-            already exist. If an empty list is provided, it is equivalent to doing a bulk
-            insert on the objects that don't exist. If ``None``, all fields will be updated.
+        update_fields (List[str]|Dict[str, str|Expression], default=None): A list of fields to update whenever
+            objects already exist. If an empty list is provided, it is equivalent to doing a bulk
+            insert on the objects that don't exist. If ``None``, all fields will be updated. A dictionary maps
+            fields to merges with the existing row, either an expression using ``F`` for the existing row and
+            ``Excluded`` for the proposed row, or one of ``'add'``, ``'greatest'``, ``'least'``, or ``'concat'``
         returning (bool|List[str]): If ``True``, returns all fields. If a list, only returns
             fields in the list. Return values are split in a tuple of created and updated models
         ignore_duplicate_updates (bool, default=False): Ignore updating a row in the upsert if all of the update fields
             are duplicates
         return_untouched (bool, default=False): Return values that were not touched by the upsert operation
+        retry_policy (RetryPolicy, default=None): Retry the upsert when it fails because of a deadlock or
+            a serialization failure
+        hash_field (str, default=None): A field that stores a hash of the update fields. The hash is computed
+            for every model and duplicate updates are detected by only comparing hashes, which is cheaper
+            for wide json and array fields. The field must hold 64 characters
+        exclude_unchanged (bool, default=False): Prefetch the stored values of the rows and don't send the
+            models that are unchanged. With a ``hash_field``, the hashes of the matching rows are fetched.
+            Otherwise the unique and update fields of the queryset are streamed in one query and compared
+            in Python. Unchanged rows are returned as untouched with the same fields as the upserted rows
+        on_duplicate_input (str, default=None): Collapse models with the same unique fields, keeping the
+            ``'first'`` or ``'last'`` one, or raise a ``ValueError`` with ``'error'``. If ``None``, postgres
+            fails the upsert when it updates a row twice
+        update_condition (Q|Expression|str, default=None): A condition that existing rows must meet to be
+            updated, such as ``Q(updated_at__lt=Excluded('updated_at'))`` to only apply newer data. ``F``
+            references the existing row and ``Excluded`` the proposed row. A string is used as raw sql. Rows
+            that don't meet the condition are untouched
+        unique_constraint (str, default=None): The name of the unique constraint to use as the conflict target
+            instead of the unique fields. The unique fields must still be the fields of the constraint
+        unique_condition (Q|Expression|str, default=None): The predicate of a partial unique index on the
+            unique fields, such as ``Q(deleted_at__isnull=True)``. A string is used as raw sql
+        dry_run (bool, default=False): Compute what the upsert would do without writing anything. The models
+            are joined against the table in a single read only query that takes no locks
+        natural_keys (Dict[str, str|List[str]], default=None): Maps foreign keys to the fields of their parents
+            that form a natural key, such as ``{'test_model': 'int_field'}``. The natural key is read from the
+            unsaved parent assigned to the foreign key of each model, and the foreign key is resolved by joining
+            the parent table in the upsert statement. Models without a parent assigned keep their foreign key
+        on_unresolved (str, default='error'): How models whose natural keys don't match a parent are handled.
+            ``'error'`` raises a ``ValueError`` before writing, ``'skip'`` leaves them out, and ``'null'``
+            upserts them with a null foreign key
 
     Returns:
         UpsertResult: A list of results if ``returning`` is not ``False``. created, updated, and untouched,
             results can be obtained by accessing the ``created``, ``updated``, and ``untouched`` properties
-            of the result.
+            of the result. The number of retries is available in ``retries`` and the number of collapsed
+            duplicate models is available in ``collapsed``.
+            In a dry run, a ``Counter`` of the statuses is returned, or an ``UpsertResult`` of the unique
+            fields of each model with its status if ``returning`` is not ``False``.
 
     Examples:
 
@@ -337,11 +787,32 @@ def bulk_upsert2(
         # All four objects should be updated
         print(len(updated))
         4
+
+        # Add to the float fields of existing objects instead of overwriting them
+        bulk_upsert2(TestModel.objects.all(), [
+            TestModel(float_field=1.0, int_field=1),
+        ], ['int_field'], {'float_field': 'add'})
     """
-    results = upsert2.upsert(queryset, model_objs, unique_fields,
-                             update_fields=update_fields, returning=returning,
-                             ignore_duplicate_updates=ignore_duplicate_updates,
-                             return_untouched=return_untouched)
+    if dry_run:
+        return upsert2.upsert(
+            queryset, model_objs, unique_fields,
+            update_fields=update_fields, returning=returning,
+            ignore_duplicate_updates=ignore_duplicate_updates, hash_field=hash_field,
+            on_duplicate_input=on_duplicate_input, update_condition=update_condition,
+            unique_constraint=unique_constraint, unique_condition=unique_condition, dry_run=True,
+            natural_keys=natural_keys
+        )
+
+    results, retries = _run_with_retries(retry_policy, lambda: upsert2.upsert(
+        queryset, model_objs, unique_fields,
+        update_fields=update_fields, returning=returning,
+        ignore_duplicate_updates=ignore_duplicate_updates,
+        return_untouched=return_untouched, hash_field=hash_field, exclude_unchanged=exclude_unchanged,
+        on_duplicate_input=on_duplicate_input, update_condition=update_condition,
+        unique_constraint=unique_constraint, unique_condition=unique_condition,
+        natural_keys=natural_keys, on_unresolved=on_unresolved
+    ))
+    results.retries = retries
     post_bulk_operation.send(sender=queryset.model, model=queryset.model)
     return results
 
@@ -372,7 +843,43 @@ def sync(queryset, model_objs, unique_fields, update_fields=None, **kwargs):
     return bulk_upsert(queryset, model_objs, unique_fields, update_fields=update_fields, sync=True, **kwargs)
 
 
-def sync2(queryset, model_objs, unique_fields, update_fields=None, returning=False, ignore_duplicate_updates=True):
+def _get_advisory_lock_keys(model, lock_scope):
+    """
+    Gets the pair of 32 bit advisory lock keys for a scope of a model.
+    """
+    def to_int4(value):
+        key = zlib.crc32(value.encode('utf-8'))
+        return key - 2 ** 32 if key >= 2 ** 31 else key
+
+    return [to_int4(model._meta.label), to_int4(str(lock_scope))]
+
+
+@contextmanager
+def _advisory_lock(model, lock_scope, skip_locked=False):
+    """
+    Holds a transaction level postgres advisory lock on a scope of a model. Yields whether the lock was acquired,
+    which is only False when skip_locked is True and the lock is already held.
+    """
+    if lock_scope is None:
+        yield True
+        return
+
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT pg_{0}advisory_xact_lock(%s, %s)'.format('try_' if skip_locked else ''),
+                _get_advisory_lock_keys(model, lock_scope)
+            )
+            acquired = cursor.fetchone()[0] if skip_locked else True
+        yield acquired
+
+
+def sync2(
+    queryset, model_objs, unique_fields, update_fields=None, returning=False, ignore_duplicate_updates=True,
+    retry_policy=None, lock_scope=None, skip_locked=False, hash_field=None, exclude_unchanged=False,
+    on_duplicate_input=None, update_condition=None, unique_constraint=None, unique_condition=None, on_missing=None,
+    revive=False, dry_run=False, natural_keys=None, on_unresolved='error'
+):
     """
     Performs a sync operation on a queryset, making the contents of the
     queryset match the contents of model_objs.
@@ -395,16 +902,521 @@ def sync2(queryset, model_objs, unique_fields, update_fields=None, returning=Fal
             deleted models.
         ignore_duplicate_updates (bool, default=False): Ignore updating a row in the upsert if all
             of the update fields are duplicates
+        retry_policy (RetryPolicy, default=None): Retry the sync when it fails because of a deadlock or
+            a serialization failure
+        lock_scope (str, default=None): A key for the scope of the queryset, such as a tenant id. When provided,
+            the sync runs in a transaction that holds a postgres advisory lock on the model and scope, so that
+            concurrent syncs of the same scope run one at a time. Syncs of other scopes are not blocked.
+        skip_locked (bool, default=False): Skip the sync instead of waiting when another sync holds the lock
+            on the scope
+        hash_field (str, default=None): A field that stores a hash of the update fields. Duplicate updates
+            are detected by only comparing hashes. See ``bulk_upsert2``
+        exclude_unchanged (bool, default=False): Stream the unique and update fields of the queryset (or the
+            hashes of the matching rows with a ``hash_field``) and don't send the models that are unchanged.
+            They are kept and returned as untouched with the same fields as the upserted rows
+        on_duplicate_input (str, default=None): Collapse models with the same unique fields, keeping the
+            ``'first'`` or ``'last'`` one, or raise a ``ValueError`` with ``'error'``
+        update_condition (Q|Expression|str, default=None): A condition that existing rows must meet to be
+            updated. Rows that don't meet it are untouched and kept. See ``bulk_upsert2``
+        unique_constraint (str, default=None): The name of the unique constraint to use as the conflict target
+        unique_condition (Q|Expression|str, default=None): The predicate of a partial unique index on the
+            unique fields
+        on_missing (dict, default=None): Values that rows missing from model_objs are updated with instead of
+            being deleted, such as ``{'deleted_at': Now()}``. The updated rows are returned as deleted. Filter
+            the queryset to the unmarked rows to avoid marking rows again on every sync
+        revive (bool, default=False): Overwrite the fields of on_missing with the values of model_objs when
+            marked rows reappear. Otherwise the fields of on_missing are never updated by the sync
+        dry_run (bool, default=False): Compute what the sync would do without writing anything or taking the
+            lock. See ``bulk_upsert2``
+        natural_keys (Dict[str, str|List[str]], default=None): Maps foreign keys to the fields of their parents
+            that form a natural key. See ``bulk_upsert2``
+        on_unresolved (str, default='error'): How models whose natural keys don't match a parent are handled.
+            Rows of the queryset that only match skipped models are deleted
 
     Returns:
         UpsertResult: A list of results if ``returning`` is not ``False``. created, updated, untouched,
             and deleted results can be obtained by accessing the ``created``, ``updated``, ``untouched``,
-            and ``deleted`` properties of the result.
+            and ``deleted`` properties of the result. The number of retries is available in ``retries`` and
+            the number of collapsed duplicate models is available in ``collapsed``.
+            ``None`` is returned when the sync is skipped because the scope is locked.
+            In a dry run, a ``Counter`` of the statuses is returned, or an ``UpsertResult`` of the unique
+            fields with the statuses if ``returning`` is not ``False``.
     """
-    results = upsert2.upsert(queryset, model_objs, unique_fields,
-                             update_fields=update_fields, returning=returning, sync=True,
-                             ignore_duplicate_updates=ignore_duplicate_updates)
-    post_bulk_operation.send(sender=queryset.model, model=queryset.model)
+    model = queryset.model
+    if dry_run:
+        return upsert2.upsert(
+            queryset, model_objs, unique_fields,
+            update_fields=update_fields, returning=returning, sync=True,
+            ignore_duplicate_updates=ignore_duplicate_updates, hash_field=hash_field,
+            on_duplicate_input=on_duplicate_input, update_condition=update_condition,
+            unique_constraint=unique_constraint, unique_condition=unique_condition,
+            on_missing=on_missing, revive=revive, dry_run=True, natural_keys=natural_keys
+        )
+
+    with _advisory_lock(model, lock_scope, skip_locked=skip_locked) as acquired:
+        if not acquired:
+            return None
+
+        results, retries = _run_with_retries(retry_policy, lambda: upsert2.upsert(
+            queryset, model_objs, unique_fields,
+            update_fields=update_fields, returning=returning, sync=True,
+            ignore_duplicate_updates=ignore_duplicate_updates, hash_field=hash_field,
+            exclude_unchanged=exclude_unchanged, on_duplicate_input=on_duplicate_input,
+            update_condition=update_condition, unique_constraint=unique_constraint,
+            unique_condition=unique_condition, on_missing=on_missing, revive=revive,
+            natural_keys=natural_keys, on_unresolved=on_unresolved
+        ))
+
+    results.retries = retries
+    post_bulk_operation.send(sender=model, model=model)
+    return results
+
+
+def _record_touched_pks(cursor, touched_table, pks):
+    """
+    Used by stream_sync2 to insert the primary keys of touched rows into its temporary table.
+    """
+    if pks:
+        cursor.execute(
+            'INSERT INTO {0} (pk) VALUES {1} ON CONFLICT DO NOTHING'.format(
+                touched_table, ', '.join(['(%s)'] * len(pks))
+            ),
+            pks
+        )
+
+
+def stream_sync2(
+    queryset, model_objs, unique_fields, update_fields=None, chunk_size=1000, ignore_duplicate_updates=True,
+    lock_scope=None, skip_locked=False, on_missing=None, revive=False
+):
+    """
+    Performs a sync operation on a queryset from an iterable of models, such as a generator, that does not
+    fit in memory. The models are upserted in chunks, and the primary keys of the rows they touch are recorded
+    in a temporary table. Rows of the queryset that are not in the temporary table are deleted at the end.
+    Only one chunk of models is held in memory at a time. The sync runs in a single transaction.
+
+    Args:
+        queryset (Model|QuerySet): A model or a queryset that defines the collection to sync
+        model_objs (Iterable[Model]): An iterable of Django models to sync.
+        unique_fields (List[str]): A list of fields that define the uniqueness of the model. The
+            model must have a unique constraint on these fields
+        update_fields (List[str], default=None): A list of fields to update whenever objects
+            already exist. If `None`, all fields will be updated.
+        chunk_size (int, default=1000): The number of models upserted in each statement
+        ignore_duplicate_updates (bool, default=True): Ignore updating a row in the upsert if all
+            of the update fields are duplicates
+        lock_scope (str, default=None): A key for the scope of the queryset that is locked during the sync.
+            See ``sync2``
+        skip_locked (bool, default=False): Skip the sync instead of waiting when another sync holds the lock
+            on the scope
+        on_missing (dict, default=None): Values that rows which were not touched are updated with instead of
+            being deleted. They are counted as deleted. See ``sync2``
+        revive (bool, default=False): Overwrite the fields of on_missing with the values of the models when
+            marked rows reappear
+
+    Returns:
+        Counter: The number of created, updated, untouched, and deleted rows, keyed by their status
+            (``'c'``, ``'u'``, ``'n'``, and ``'d'``). ``None`` is returned when the sync is skipped because
+            the scope is locked.
+
+    Examples:
+
+    .. code-block:: python
+
+        def read_feed():
+            for line in open('feed.csv'):
+                int_field, char_field = line.strip().split(',')
+                yield TestModel(int_field=int(int_field), char_field=char_field)
+
+        counts = stream_sync2(TestModel.objects.all(), read_feed(), ['int_field'], ['char_field'])
+        print(counts['c'], counts['d'])
+    """
+    queryset = queryset if isinstance(queryset, QuerySet) else queryset.objects.all()
+    model = queryset.model
+    pk_column = model._meta.pk.column
+    touched_table = 'manager_utils_touched_{0}'.format(uuid.uuid4().hex)
+    counts = Counter()
+    if on_missing:
+        update_fields = upsert2._get_sync_update_fields(
+            model, upsert2._get_update_fields(model, unique_fields, update_fields), on_missing, revive
+        )
+
+    with transaction.atomic(), _advisory_lock(model, lock_scope, skip_locked=skip_locked) as acquired:
+        if not acquired:
+            return None
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'CREATE TEMPORARY TABLE {0} ON COMMIT DROP AS SELECT "{1}" AS pk FROM {2} WITH NO DATA'.format(
+                    touched_table, model._meta.pk.column, model._meta.db_table
+                )
+            )
+            # A row may be touched by more than one chunk. The primary key makes the anti-join an index lookup
+            cursor.execute('ALTER TABLE {0} ADD PRIMARY KEY (pk)'.format(touched_table))
+
+            model_objs = iter(model_objs)
+            chunk = list(itertools.islice(model_objs, chunk_size))
+            while chunk:
+                results = upsert2.upsert(
+                    queryset, chunk, unique_fields, update_fields=update_fields, return_untouched=True,
+                    ignore_duplicate_updates=ignore_duplicate_updates
+                )
+                counts.update(result.status_ for result in results)
+                _record_touched_pks(cursor, touched_table, [getattr(result, pk_column) for result in results])
+                chunk = list(itertools.islice(model_objs, chunk_size))
+
+            cursor.execute('ANALYZE {0}'.format(touched_table))
+
+        # Delete or mark the rows of the queryset that were not touched with an anti-join on the touched rows
+        missing = queryset.filter(RawSQL(
+            'NOT EXISTS (SELECT 1 FROM {0} t WHERE t.pk = "{1}"."{2}")'.format(
+                touched_table, model._meta.db_table, model._meta.pk.column
+            ), [], output_field=BooleanField()
+        ))
+        if on_missing:
+            counts['d'] = missing.update(**on_missing)
+        else:
+            num_deleted, num_deleted_by_model = missing.delete()
+            counts['d'] = num_deleted_by_model.get(model._meta.label, 0)
+
+        # The table is also dropped on commit if the sync fails, but the sync may run in an outer transaction
+        with connection.cursor() as cursor:
+            cursor.execute('DROP TABLE {0}'.format(touched_table))
+
+    post_bulk_operation.send(sender=model, model=model)
+    return counts
+
+
+def _delete_returning_pks(queryset):
+    """
+    Used by _sync_partitions to delete the rows of a queryset in one statement and return their primary keys. Rows
+    with cascades or delete signals are deleted by a collector, which fetches them in one query.
+    """
+    model = queryset.model
+    collector = Collector(using=queryset.db)
+    if not collector.can_fast_delete(queryset):
+        collector.collect(queryset)
+        deleted = [model_obj.pk for model_obj in collector.data.get(model, [])]
+        collector.delete()
+        return deleted
+
+    try:
+        delete_sql, delete_sql_params = queryset.query.chain(DeleteQuery).get_compiler(queryset.db).as_sql()
+    except EmptyResultSet:
+        return []
+
+    with connection.cursor() as cursor:
+        cursor.execute('{0} RETURNING "{1}"'.format(delete_sql, model._meta.pk.column), delete_sql_params)
+        return [row[0] for row in cursor.fetchall()]
+
+
+def _sync_partitions(queryset, model_objs, unique_fields, partition_field, update_fields, returning,
+                     ignore_duplicate_updates, partitions=None):
+    """
+    Used by sync_partitioned to upsert the models and delete the missing rows of their partitions in one transaction.
+    The partitions are the partitions of the models unless they are provided.
+    """
+    model = queryset.model
+    pk_column = model._meta.pk.column
+    if partitions is None:
+        partition_attname = model._meta.get_field(partition_field).attname
+        partitions = {getattr(model_obj, partition_attname) for model_obj in model_objs}
+
+    with transaction.atomic():
+        results = upsert2.upsert(
+            queryset, model_objs, unique_fields, update_fields=update_fields, returning=returning,
+            ignore_duplicate_updates=ignore_duplicate_updates, return_untouched=True
+        )
+
+        # Delete the rows of every partition in the input that were not touched with one anti-join. The touched
+        # primary keys are sent as a single array parameter
+        partition_q = Q(**{'{0}__in'.format(partition_field): partitions - {None}})
+        if None in partitions:
+            partition_q |= Q(**{'{0}__isnull'.format(partition_field): True})
+        missing = queryset.filter(partition_q, RawSQL(
+            'NOT EXISTS (SELECT 1 FROM unnest(%s::{0}[]) AS t(pk) WHERE t.pk = "{1}"."{2}")'.format(
+                model._meta.pk.rel_db_type(connection), model._meta.db_table, model._meta.pk.column
+            ), ([getattr(result, pk_column) for result in results],), output_field=BooleanField()
+        ))
+        deleted = _delete_returning_pks(missing)
+
+    nt_deleted_result = namedtuple('DeletedResult', [pk_column, 'status_'])
+    results.extend(nt_deleted_result(**{pk_column: pk, 'status_': 'd'}) for pk in deleted)
+    return results
+
+
+def sync_partitioned(
+    queryset, model_objs, unique_fields, partition_field, update_fields=None, returning=False,
+    ignore_duplicate_updates=True, retry_policy=None
+):
+    """
+    Performs a sync operation on many partitions of a queryset at once, such as the rows of every tenant. All models
+    are upserted in one statement, and the rows missing from the models are deleted only from the partitions that
+    have models. Partitions without any models are left alone. This is equivalent to calling ``sync2`` with
+    ``queryset.filter(partition_field=value)`` for every partition value in the models, but the delete phase is a
+    single anti-join for all partitions.
+
+    Args:
+        queryset (Model|QuerySet): A model or a queryset that defines the collection to sync
+        model_objs (List[Model]): A list of Django models to sync. All models in this list
+            will be bulk upserted and any rows of their partitions that are not in this list will be deleted
+        unique_fields (List[str]): A list of fields that define the uniqueness of the model. The
+            model must have a unique constraint on these fields
+        partition_field (str): The field that partitions the rows, such as a tenant. Rows with a null value
+            form a partition
+        update_fields (List[str], default=None): A list of fields to update whenever objects
+            already exist. If an empty list is provided, it is equivalent to doing a bulk
+            insert on the objects that don't exist. If `None`, all fields will be updated.
+        returning (bool|List[str]): If True, returns all fields. If a list, only returns
+            fields in the list
+        ignore_duplicate_updates (bool, default=True): Ignore updating a row in the upsert if all
+            of the update fields are duplicates
+        retry_policy (RetryPolicy, default=None): Retry the sync in a savepoint when it fails with a
+            retryable database error, such as a deadlock or a serialization failure
+
+    Returns:
+        UpsertResult: A list of results. created, updated, untouched, and deleted results can be obtained
+            by accessing the ``created``, ``updated``, ``untouched``, and ``deleted`` properties of the result.
+            The number of retries is available in ``retries``.
+
+    Examples:
+
+    .. code-block:: python
+
+        # Sync the rows with a char_field of 'a' or 'b'. The rows of every other char_field are not touched
+        sync_partitioned(TestModel.objects.all(), [
+            TestModel(char_field='a', int_field=1),
+            TestModel(char_field='b', int_field=2),
+        ], ['int_field'], 'char_field')
+    """
+    queryset = queryset if isinstance(queryset, QuerySet) else queryset.objects.all()
+    model = queryset.model
+    results, retries = _run_with_retries(retry_policy, lambda: _sync_partitions(
+        queryset, model_objs, unique_fields, partition_field, update_fields, returning, ignore_duplicate_updates
+    ))
+
+    results.retries = retries
+    post_bulk_operation.send(sender=model, model=model)
+    return results
+
+
+def _get_graph_fk(model, child_model, fk_field):
+    """
+    Gets the foreign key of a child model to its parent model in a graph upsert.
+    """
+    if fk_field is not None:
+        return child_model._meta.get_field(fk_field)
+
+    fks = [field for field in child_model._meta.fields if field.many_to_one and field.related_model == model]
+    if len(fks) != 1:
+        raise ValueError('{0} must have exactly one foreign key to {1} unless fk_field is provided'.format(
+            child_model._meta.label, model._meta.label
+        ))
+    return fks[0]
+
+
+def _upsert_graph(queryset, model_objs, unique_fields, child_queryset, child_objs, child_unique_fields, fk,
+                  update_fields, child_update_fields, sync):
+    """
+    Used by upsert_graph to upsert the parents and then the children in one transaction.
+    """
+    model = queryset.model
+    key_fields = [model._meta.get_field(unique_field) for unique_field in unique_fields]
+    target_field = fk.target_field
+
+    with transaction.atomic():
+        results = upsert2.upsert(
+            queryset, model_objs, unique_fields, update_fields=update_fields, sync=sync, return_untouched=True,
+            returning=[target_field.column] + [field.column for field in key_fields]
+        )
+
+        # Map the natural key of every parent to the value its children reference. Deleted parents only have a pk
+        target_values = {
+            tuple(field.to_python(getattr(result, field.column)) for field in key_fields): getattr(
+                result, target_field.column
+            )
+            for result in results if result.status_ != 'd'
+        }
+        # Children of saved parents already reference them
+        for child_obj in child_objs:
+            parent = fk.get_cached_value(child_obj, None)
+            if parent is not None and parent._state.adding:
+                key = tuple(field.to_python(getattr(parent, field.attname)) for field in key_fields)
+                if key not in target_values:
+                    raise ValueError('The parent {0} of {1} is not in model_objs'.format(key, child_obj))
+                setattr(child_obj, fk.attname, target_values[key])
+
+        if sync:
+            # Children are only synced within the parents in the graph
+            child_results = _sync_partitions(
+                child_queryset, child_objs, child_unique_fields, fk.name, update_fields=child_update_fields,
+                returning=False, ignore_duplicate_updates=True, partitions=set(target_values.values())
+            )
+        else:
+            child_results = upsert2.upsert(
+                child_queryset, child_objs, child_unique_fields, update_fields=child_update_fields,
+                return_untouched=True
+            )
+
+    return results, child_results
+
+
+def upsert_graph(
+    queryset, model_objs, unique_fields, child_queryset, child_objs, child_unique_fields, update_fields=None,
+    child_update_fields=None, fk_field=None, sync=False, retry_policy=None
+):
+    """
+    Performs a bulk upsert of parent models and their children, such as orders and their line items. Children
+    reference their parent by assigning the unsaved parent model to their foreign key. The parents are upserted
+    first, and the foreign keys of the children are resolved from the natural keys of their parents in the
+    returned rows before the children are upserted. Children of saved parents keep their foreign key. The number
+    of statements does not depend on the number of parents.
+
+    Args:
+        queryset (Model|QuerySet): A model or a queryset of the parents
+        model_objs (List[Model]): A list of parent models to upsert
+        unique_fields (List[str]): A list of fields that define the uniqueness of the parents. They are
+            the natural key that children are matched to their parents with
+        child_queryset (Model|QuerySet): A model or a queryset of the children
+        child_objs (List[Model]): A list of child models to upsert. The foreign key of each child is
+            either an unsaved parent model with the unique fields of a model in model_objs, or a saved parent
+        child_unique_fields (List[str]): A list of fields that define the uniqueness of the children
+        update_fields (List[str], default=None): A list of parent fields to update whenever parents
+            already exist. If `None`, all fields will be updated.
+        child_update_fields (List[str], default=None): A list of child fields to update whenever children
+            already exist. If `None`, all fields will be updated.
+        fk_field (str, default=None): The foreign key of the children to their parents. Only required when
+            the children have more than one foreign key to the parent model
+        sync (bool, default=False): Sync the parents with the queryset and sync the children of every parent
+            in model_objs. Children of other parents are left alone
+        retry_policy (RetryPolicy, default=None): Retry the upsert in a savepoint when it fails with a
+            retryable database error, such as a deadlock or a serialization failure
+
+    Returns:
+        tuple(UpsertResult, UpsertResult): The results of the parents and the results of the children. The
+            number of retries is available in ``retries`` of both.
+
+    Examples:
+
+    .. code-block:: python
+
+        orders = [Order(number=1), Order(number=2)]
+        line_items = [
+            LineItem(order=orders[0], position=1, sku='a'),
+            LineItem(order=orders[0], position=2, sku='b'),
+            LineItem(order=orders[1], position=1, sku='c'),
+        ]
+        order_results, line_item_results = upsert_graph(
+            Order, orders, ['number'], LineItem, line_items, ['order', 'position'], sync=True)
+    """
+    queryset = queryset if isinstance(queryset, QuerySet) else queryset.objects.all()
+    child_queryset = child_queryset if isinstance(child_queryset, QuerySet) else child_queryset.objects.all()
+    model = queryset.model
+    child_model = child_queryset.model
+    fk = _get_graph_fk(model, child_model, fk_field)
+
+    (results, child_results), retries = _run_with_retries(retry_policy, lambda: _upsert_graph(
+        queryset, model_objs, unique_fields, child_queryset, child_objs, child_unique_fields, fk,
+        update_fields, child_update_fields, sync
+    ))
+
+    results.retries = child_results.retries = retries
+    post_bulk_operation.send(sender=model, model=model)
+    post_bulk_operation.send(sender=child_model, model=child_model)
+    return results, child_results
+
+
+def _group_members(pairs):
+    """
+    Used by sync_m2m to group pairs of parent and member primary keys into sets of members by parent.
+    """
+    members = {}
+    for parent_pk, member_pk in pairs:
+        members.setdefault(parent_pk, set()).add(member_pk)
+
+    return members
+
+
+def sync_m2m(relation, memberships):
+    """
+    Syncs the members of many to many relations for many parents at once, like calling ``set`` on the relation
+    of every parent. Missing rows of the through table are inserted with ``ON CONFLICT DO NOTHING`` in one
+    statement, and the stale rows of the parents are deleted with one anti-join. Parents that are not in
+    memberships are left alone. The ``post_bulk_operation`` signal of the through model provides the
+    ``added`` and ``removed`` members of every parent, like the ``pk_set`` of ``m2m_changed``.
+
+    Args:
+        relation (ManyToManyDescriptor): The many to many relation, such as ``Pizza.toppings`` or its reverse
+            relation ``Topping.pizza_set``
+        memberships (Dict[Any, List[Any]]): Maps the primary key of every parent to the primary keys of
+            all of its members
+
+    Returns:
+        UpsertResult: The rows of the through table that were created and deleted. They can be obtained by
+            accessing the ``created`` and ``deleted`` properties of the result.
+
+    Examples:
+
+    .. code-block:: python
+
+        sync_m2m(Pizza.toppings, {pizza1.id: [cheese.id, ham.id], pizza2.id: []})
+    """
+    field = relation.field
+    through = relation.through
+    source_name, target_name = field.m2m_field_name(), field.m2m_reverse_field_name()
+    if relation.reverse:
+        source_name, target_name = target_name, source_name
+    source_field = through._meta.get_field(source_name)
+    target_field = through._meta.get_field(target_name)
+
+    through_objs = [
+        through(**{source_field.attname: parent_pk, target_field.attname: member_pk})
+        for parent_pk, member_pks in memberships.items()
+        for member_pk in member_pks
+    ]
+
+    with transaction.atomic():
+        # The members that already exist conflict and are not returned
+        results = upsert2.upsert(
+            through, through_objs, [source_field.attname, target_field.attname], update_fields=[],
+            returning=[source_field.column, target_field.column]
+        )
+
+        removed = []
+        if memberships:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    'DELETE FROM {table} AS t'
+                    ' WHERE t.{source} = ANY(%s::{source_type}[])'
+                    ' AND NOT EXISTS ('
+                    '     SELECT 1 FROM unnest(%s::{source_type}[], %s::{target_type}[]) AS m(source, target)'
+                    '     WHERE m.source = t.{source} AND m.target = t.{target}'
+                    ' )'
+                    ' RETURNING t.{source}, t.{target}'.format(
+                        table=upsert2._quote(through._meta.db_table),
+                        source=upsert2._quote(source_field.column),
+                        target=upsert2._quote(target_field.column),
+                        source_type=source_field.db_type(connection),
+                        target_type=target_field.db_type(connection)
+                    ),
+                    (
+                        list(memberships),
+                        [getattr(through_obj, source_field.attname) for through_obj in through_objs],
+                        [getattr(through_obj, target_field.attname) for through_obj in through_objs],
+                    )
+                )
+                removed = cursor.fetchall()
+
+    nt_deleted_result = namedtuple('DeletedResult', [source_field.column, target_field.column, 'status_'])
+    results.extend(nt_deleted_result(source_pk, target_pk, 'd') for source_pk, target_pk in removed)
+
+    post_bulk_operation.send(
+        sender=through, model=through,
+        added=_group_members(
+            (getattr(result, source_field.column), getattr(result, target_field.column)) for result in results.created
+        ),
+        removed=_group_members(removed)
+    )
     return results
 
 
@@ -430,18 +1442,117 @@ def get_or_none(queryset, **query_params):
         1
 
     """
-    try:
-        obj = queryset.get(**query_params)
-    except queryset.model.DoesNotExist:
-        obj = None
-    return obj
+    def get():
+        try:
+            obj = queryset.get(**query_params)
+        except queryset.model.DoesNotExist:
+            obj = None
+        return obj
+
+    return _get_from_identity_map(queryset, get, **query_params)
+
+
+def _get_key_lookup_rows(queryset, attnames, lookup_keys, only=None, values=None, batch_size=1000):
+    """
+    Used by get_or_none_many to fetch the rows matching the lookup keys in batches. Yields tuples of
+    the key and the object or values of each row.
+    """
+    if values is not None:
+        queryset = queryset.values(*dict.fromkeys(attnames + list(values)))
+        get_key = lambda row: tuple(row[attname] for attname in attnames)
+    else:
+        if only is not None:
+            queryset = queryset.only(*dict.fromkeys(attnames + list(only)))
+        get_key = lambda row: _get_unique_key(row, attnames)
+
+    for i in range(0, len(lookup_keys), batch_size):
+        for row in upsert2._filter_by_unique_keys(queryset, attnames, lookup_keys[i:i + batch_size]):
+            yield get_key(row), row
+
+
+def get_or_none_many(queryset, field_or_fields, keys, only=None, values=None, batch_size=1000):
+    """
+    Gets the objects for many lookup keys with one query per batch of keys.
+
+    :type field_or_fields: str or list of str
+    :param field_or_fields: The field or list of fields that are used to look up objects. The fields
+            should identify a single object.
+
+    :type keys: list
+    :param keys: The lookup keys. Keys are values when a single field is provided and tuples of values
+            when a list of fields is provided.
+
+    :type only: list of str
+    :param only: Only load these fields of the objects.
+
+    :type values: list of str
+    :param values: Return dictionaries of these fields instead of objects.
+
+    :type batch_size: int
+    :param batch_size: The number of keys that are looked up in each query.
+
+    :returns: A dictionary keyed on the provided keys with the object for each key, or None if there is
+            no object for the key.
+
+    :raises: :class:`MultipleObjectsReturned <django:django.core.exceptions.MultipleObjectsReturned>`
+            error when more than one object matches a key.
+
+    Examples:
+
+    .. code-block:: python
+
+        TestModel.objects.create(int_field=1)
+        model_objs = get_or_none_many(TestModel.objects, 'int_field', [1, 2])
+        print(model_objs[1].int_field, model_objs[2])
+        1, None
+
+    """
+    model = queryset.model
+    single_field = isinstance(field_or_fields, str)
+    fields = [model._meta.get_field(field) for field in ([field_or_fields] if single_field else field_or_fields)]
+
+    # Normalize the keys to the values that are returned from the database. Different keys, such as 1 and '1',
+    # can normalize to the same value
+    keys_by_lookup_key = {}
+    for key in keys:
+        lookup_key = tuple(field.to_python(value) for field, value in zip(fields, (key,) if single_field else key))
+        keys_by_lookup_key.setdefault(lookup_key, []).append(key)
+
+    objs = dict.fromkeys(keys)
+    rows = _get_key_lookup_rows(
+        queryset, [field.attname for field in fields], list(keys_by_lookup_key), only=only, values=values,
+        batch_size=batch_size
+    )
+    for lookup_key, row in rows:
+        for key in keys_by_lookup_key[lookup_key]:
+            if objs[key] is not None:
+                raise model.MultipleObjectsReturned('More than one {0} matches {1}'.format(model.__name__, key))
+            objs[key] = row
+
+    return objs
 
 
-def single(queryset):
+def single(queryset, cached=False, ttl=None, cache_alias=None):
     """
     Assumes that this model only has one element in the table and returns it.
     If the table has more than one or no value, an exception is raised.
 
+    :type cached: bool
+    :param cached: A flag specifying whether to cache the object in the process. A copy of the cached
+            object is returned. The cache of the model is invalidated when a post_bulk_operation, post_save,
+            or post_delete signal is sent for the model.
+
+    :type ttl: float
+    :param ttl: The number of seconds that a cached object is kept. If None, it is kept until invalidated.
+
+    :type cache_alias: str
+    :param cache_alias: The alias of a Django cache that is used to invalidate the cached object across
+            processes. Processes that cache the model with the same alias notify each other when they change
+            the model, at the cost of a cache lookup on every call. A process only notifies others once it has
+            called single with the alias or registered the alias with ``register_cached_single``. Processes
+            that only write the model, such as the admin or workers, must register it when they start, or
+            readers keep serving their cached object until the ttl expires.
+
     :returns: The only model object in the queryset.
 
     :raises: :class:`DoesNotExist <django:django.core.exceptions.ObjectDoesNotExist>`
@@ -458,11 +1569,16 @@ def single(queryset):
         print(model_obj.int_field)
         1
 
+        # Cache the object in the process for up to a minute
+        model_obj = single(TestModel.objects, cached=True, ttl=60)
+
     """
-    return queryset.get()
+    if cached:
+        return _get_cached_single(queryset, ttl, cache_alias)
+    return _get_from_identity_map(queryset, queryset.get)
 
 
-def bulk_update(manager, model_objs, fields_to_update):
+def bulk_update(manager, model_objs, fields_to_update, retry_policy=None):
     """
     Bulk updates a list of model objects that are already saved.
 
@@ -470,6 +1586,9 @@ def bulk_update(manager, model_objs, fields_to_update):
     :param model_objs: A list of model objects that have been updated.
         fields_to_update: A list of fields to be updated. Only these fields will be updated
 
+    :type retry_policy: :class:`RetryPolicy`
+    :param retry_policy: Retries the update when it fails because of a deadlock or a serialization failure.
+
 
     :signals: Emits a post_bulk_operation signal when completed.
 
@@ -566,14 +1685,97 @@ def bulk_update(manager, model_objs, fields_to_update):
     update_sql_params = list(itertools.chain(*row_values))
 
     # Run the update query
-    with connection.cursor() as cursor:
-        cursor.execute(update_sql, update_sql_params)
+    def execute_update():
+        with connection.cursor() as cursor:
+            cursor.execute(update_sql, update_sql_params)
+
+    _run_with_retries(retry_policy, execute_update)
 
     # call the bulk operation signal
     post_bulk_operation.send(sender=manager.model, model=manager.model)
 
 
-def upsert(manager, defaults=None, updates=None, **kwargs):
+def claim(queryset, limit, updates):
+    """
+    Atomically claims up to limit unlocked rows of the queryset by updating them, and returns the claimed models.
+    Rows that are locked by other transactions are skipped, allowing many workers to claim rows from the
+    same queryset without contention. The claim is a single UPDATE ... RETURNING statement that selects
+    the rows with FOR UPDATE SKIP LOCKED.
+
+    :type limit: int
+    :param limit: The maximum number of rows to claim. Rows are claimed in the order of the queryset.
+
+    :type updates: dict
+    :param updates: The values to update on the claimed rows. Values can be expressions.
+
+    :returns: A list of the claimed models with their updated values, in no particular order.
+
+    :signals: Emits a post_bulk_operation signal when completed.
+
+    Examples:
+
+    .. code-block:: python
+
+        # Claim two pending jobs for this worker
+        jobs = claim(Job.objects.filter(status='pending').order_by('id'), 2, {'status': 'running'})
+        print([job.status for job in jobs])
+        ['running', 'running']
+
+    """
+    model = queryset.model
+    with transaction.atomic(using=queryset.db):
+        # Lock the rows in a CTE so that they are selected once. A subquery with a limit can be rescanned
+        # by the update and claim more rows than the limit
+        locked_pks = queryset.select_for_update(skip_locked=True, of=('self',)).values('pk')[:limit]
+        try:
+            locked_sql, locked_sql_params = locked_pks.query.sql_with_params()
+        except EmptyResultSet:
+            # The queryset can't match any rows, so there is nothing to claim
+            return []
+
+        update_query = UpdateQuery(model)
+        update_query.add_update_values(updates)
+        update_query.add_q(Q(pk__in=RawSQL('SELECT "{0}" FROM claimed_'.format(model._meta.pk.column), [])))
+        update_sql, update_sql_params = update_query.get_compiler(queryset.db).as_sql()
+
+        claimed_models = list(queryset.raw(
+            'WITH claimed_ AS ({locked_sql}) {update_sql} RETURNING {return_fields_sql}'.format(
+                locked_sql=locked_sql,
+                update_sql=update_sql,
+                return_fields_sql=', '.join(
+                    '"{0}"."{1}"'.format(model._meta.db_table, field.column)
+                    for field in model._meta.concrete_fields
+                )
+            ),
+            tuple(locked_sql_params) + tuple(update_sql_params)
+        ))
+
+    post_bulk_operation.send(sender=model, model=model)
+    return claimed_models
+
+
+def _upsert_native(manager, defaults, updates, **kwargs):
+    """
+    Used by upsert to perform the upsert with a single postgres insert on conflict statement.
+    """
+    model = manager.model
+    values = dict(defaults or {}, **(updates or {}))
+    values.update(kwargs)
+
+    results = upsert2.upsert(
+        manager.all(), [model(**values)], list(kwargs),
+        update_fields=[model._meta.get_field(field).attname for field in updates or []],
+        return_untouched=True, return_models=True
+    )
+    post_bulk_operation.send(sender=model, model=model)
+
+    # A row inserted by a concurrent transaction that was not updated is not visible to the statement
+    if not results:
+        return manager.get(**kwargs), False
+    return results[0], results[0].status_ == 'c'
+
+
+def upsert(manager, defaults=None, updates=None, native=False, **kwargs):
     """
     Performs an update on an object or an insert if the object does not exist.
 
@@ -586,6 +1788,12 @@ def upsert(manager, defaults=None, updates=None, **kwargs):
     :param updates: These values are updated when the object is updated. They also override any
             values provided in the defaults when inserting the object.
 
+    :type native: bool
+    :param native: A flag specifying whether to use a single postgres insert on conflict statement instead
+            of a get_or_create followed by a save. The kwargs must be the fields of a unique constraint, and
+            the object is not saved with save, so a post_bulk_operation signal is emitted instead of the
+            model's save signals.
+
     :param kwargs: These values provide the arguments used when checking for the existence of
             the object. They are used in a similar manner to Django's get_or_create function.
 
@@ -625,6 +1833,9 @@ def upsert(manager, defaults=None, updates=None, **kwargs):
         2, 4.0
 
     """
+    if native:
+        return _upsert_native(manager, defaults, updates, **kwargs)
+
     defaults = defaults or {}
     # Override any defaults with updates
     defaults.update(updates or {})
@@ -641,12 +1852,145 @@ def upsert(manager, defaults=None, updates=None, **kwargs):
     return obj, created
 
 
+class UpsertBuffer(object):
+    """
+    Buffers upserts and writes them with bulk_upsert2. Upserts of the same object are coalesced, so
+    the buffer holds at most one pending upsert per object. The buffer is flushed when it holds max_size
+    objects, when its oldest upsert is older than max_age seconds, when flush is called, or when a
+    with block that uses the buffer exits without an exception.
+
+    Coalesced upserts give the same result as performing them one after another with upsert. The
+    defaults of the first upsert are used when the object is created, and the updates are merged with
+    the last value of each field winning.
+
+    :type queryset: QuerySet
+    :param queryset: The queryset on which the upserts are performed.
+
+    :type max_size: int
+    :param max_size: The number of buffered objects at which the buffer is flushed.
+
+    :type max_age: float
+    :param max_age: The number of seconds after which buffered upserts are flushed. The age is checked when
+            an upsert is added. If None, the buffer is only flushed on size.
+
+    :type retry_policy: RetryPolicy
+    :param retry_policy: Retry the upserts when they fail because of a deadlock or a serialization failure.
+
+    Examples:
+
+    .. code-block:: python
+
+        with TestModel.objects.upsert_buffer(max_size=500, max_age=1) as buffer:
+            for message in messages:
+                buffer.upsert(int_field=message['id'], updates={'char_field': message['value']})
+    """
+    def __init__(self, queryset, max_size=1000, max_age=None, retry_policy=None):
+        self.queryset = queryset
+        self.max_size = max_size
+        self.max_age = max_age
+        self.retry_policy = retry_policy
+        self._lock = threading.Lock()
+        self._upserts = {}
+        self._first_upserted_at = None
+
+    def __len__(self):
+        return len(self._upserts)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    def upsert(self, defaults=None, updates=None, **kwargs):
+        """
+        Buffers an upsert. The arguments are the same as the ones of upsert, and the kwargs must be
+        the fields of a unique constraint.
+        """
+        key = self._get_key(kwargs)
+        with self._lock:
+            if key in self._upserts:
+                kwargs, defaults, prev_updates = self._upserts.pop(key)
+                updates = dict(prev_updates, **(updates or {}))
+            self._upserts[key] = (kwargs, defaults or {}, updates or {})
+
+            if self._first_upserted_at is None:
+                self._first_upserted_at = time.monotonic()
+            is_full = len(self._upserts) >= self.max_size or (
+                self.max_age is not None and time.monotonic() - self._first_upserted_at >= self.max_age
+            )
+
+        if is_full:
+            self.flush()
+
+    def _get_key(self, kwargs):
+        """
+        Gets the key of the object of an upsert. Fields are keyed by their attnames with values converted
+        to python, so a foreign key given as a model or as its primary key is the same object.
+        """
+        model = self.queryset.model
+        key = []
+        for name, value in kwargs.items():
+            field = model._meta.get_field(name)
+            if isinstance(value, Model) and field.is_relation:
+                value = getattr(value, field.target_field.attname)
+            key.append((field.attname, field.to_python(value)))
+        return tuple(sorted(key))
+
+    def _restore(self, upserts, first_upserted_at):
+        """
+        Puts back upserts that failed to be written. Upserts buffered since then are coalesced with them.
+        """
+        with self._lock:
+            for key, (kwargs, defaults, updates) in self._upserts.items():
+                if key in upserts:
+                    prev_kwargs, prev_defaults, prev_updates = upserts.pop(key)
+                    upserts[key] = (prev_kwargs, prev_defaults, dict(prev_updates, **updates))
+                else:
+                    upserts[key] = (kwargs, defaults, updates)
+            self._upserts = upserts
+            self._first_upserted_at = first_upserted_at
+
+    def flush(self):
+        """
+        Writes the buffered upserts. Upserts are written with one bulk_upsert2 for every distinct set of
+        unique and updated fields. Upserts that are not written because of an error stay in the buffer.
+        """
+        with self._lock:
+            upserts = self._upserts
+            first_upserted_at = self._first_upserted_at
+            self._upserts = {}
+            self._first_upserted_at = None
+
+        model = self.queryset.model
+        model_objs_by_fields = {}
+        for key, (kwargs, defaults, updates) in upserts.items():
+            fields = (
+                tuple(sorted(model._meta.get_field(field).attname for field in kwargs)),
+                tuple(sorted(model._meta.get_field(field).attname for field in updates)),
+            )
+            model_objs_by_fields.setdefault(fields, {})[key] = model(**{**defaults, **updates, **kwargs})
+
+        try:
+            for (unique_fields, update_fields), model_objs in model_objs_by_fields.items():
+                bulk_upsert2(
+                    self.queryset, list(model_objs.values()), list(unique_fields), update_fields=list(update_fields),
+                    retry_policy=self.retry_policy
+                )
+                for key in model_objs:
+                    del upserts[key]
+        except Exception:
+            self._restore(upserts, first_upserted_at)
+            raise
+
+
 class ManagerUtilsQuerySet(QuerySet):
     """
     Defines the methods in the manager utils that can also be applied to querysets.
     """
-    def id_dict(self):
-        return id_dict(self)
+    def id_dict(self, key='pk', fields=None, chunk_size=None):
+        return id_dict(self, key=key, fields=fields, chunk_size=chunk_size)
 
     def bulk_upsert(self, model_objs, unique_fields, update_fields=None, return_upserts=False, native=False):
         return bulk_upsert(
@@ -654,11 +1998,18 @@ class ManagerUtilsQuerySet(QuerySet):
         )
 
     def bulk_upsert2(self, model_objs, unique_fields, update_fields=None, returning=False,
-                     ignore_duplicate_updates=True, return_untouched=False):
+                     ignore_duplicate_updates=True, return_untouched=False, retry_policy=None, hash_field=None,
+                     exclude_unchanged=False, on_duplicate_input=None, update_condition=None,
+                     unique_constraint=None, unique_condition=None, dry_run=False, natural_keys=None,
+                     on_unresolved='error'):
         return bulk_upsert2(self, model_objs, unique_fields,
                             update_fields=update_fields, returning=returning,
                             ignore_duplicate_updates=ignore_duplicate_updates,
-                            return_untouched=return_untouched)
+                            return_untouched=return_untouched, retry_policy=retry_policy,
+                            hash_field=hash_field, exclude_unchanged=exclude_unchanged,
+                            on_duplicate_input=on_duplicate_input, update_condition=update_condition,
+                            unique_constraint=unique_constraint, unique_condition=unique_condition,
+                            dry_run=dry_run, natural_keys=natural_keys, on_unresolved=on_unresolved)
 
     def bulk_create(self, *args, **kwargs):
         """
@@ -672,15 +2023,50 @@ class ManagerUtilsQuerySet(QuerySet):
     def sync(self, model_objs, unique_fields, update_fields=None, native=False):
         return sync(self, model_objs, unique_fields, update_fields=update_fields, native=native)
 
-    def sync2(self, model_objs, unique_fields, update_fields=None, returning=False, ignore_duplicate_updates=True):
+    def sync2(self, model_objs, unique_fields, update_fields=None, returning=False, ignore_duplicate_updates=True,
+              retry_policy=None, lock_scope=None, skip_locked=False, hash_field=None, exclude_unchanged=False,
+              on_duplicate_input=None, update_condition=None, unique_constraint=None, unique_condition=None,
+              on_missing=None, revive=False, dry_run=False, natural_keys=None, on_unresolved='error'):
         return sync2(self, model_objs, unique_fields, update_fields=update_fields, returning=returning,
-                     ignore_duplicate_updates=ignore_duplicate_updates)
+                     ignore_duplicate_updates=ignore_duplicate_updates, retry_policy=retry_policy,
+                     lock_scope=lock_scope, skip_locked=skip_locked, hash_field=hash_field,
+                     exclude_unchanged=exclude_unchanged, on_duplicate_input=on_duplicate_input,
+                     update_condition=update_condition, unique_constraint=unique_constraint,
+                     unique_condition=unique_condition, on_missing=on_missing, revive=revive, dry_run=dry_run,
+                     natural_keys=natural_keys, on_unresolved=on_unresolved)
+
+    def stream_sync2(self, model_objs, unique_fields, update_fields=None, chunk_size=1000,
+                     ignore_duplicate_updates=True, lock_scope=None, skip_locked=False, on_missing=None, revive=False):
+        return stream_sync2(self, model_objs, unique_fields, update_fields=update_fields, chunk_size=chunk_size,
+                            ignore_duplicate_updates=ignore_duplicate_updates, lock_scope=lock_scope,
+                            skip_locked=skip_locked, on_missing=on_missing, revive=revive)
+
+    def sync_partitioned(self, model_objs, unique_fields, partition_field, update_fields=None, returning=False,
+                         ignore_duplicate_updates=True, retry_policy=None):
+        return sync_partitioned(self, model_objs, unique_fields, partition_field, update_fields=update_fields,
+                                returning=returning, ignore_duplicate_updates=ignore_duplicate_updates,
+                                retry_policy=retry_policy)
+
+    def upsert_graph(self, model_objs, unique_fields, child_queryset, child_objs, child_unique_fields,
+                     update_fields=None, child_update_fields=None, fk_field=None, sync=False, retry_policy=None):
+        return upsert_graph(self, model_objs, unique_fields, child_queryset, child_objs, child_unique_fields,
+                            update_fields=update_fields, child_update_fields=child_update_fields,
+                            fk_field=fk_field, sync=sync, retry_policy=retry_policy)
 
     def get_or_none(self, **query_params):
         return get_or_none(self, **query_params)
 
-    def single(self):
-        return single(self)
+    def get_or_none_many(self, field_or_fields, keys, only=None, values=None, batch_size=1000):
+        return get_or_none_many(self, field_or_fields, keys, only=only, values=values, batch_size=batch_size)
+
+    def single(self, cached=False, ttl=None, cache_alias=None):
+        return single(self, cached=cached, ttl=ttl, cache_alias=cache_alias)
+
+    def claim(self, limit, updates):
+        return claim(self, limit, updates)
+
+    def upsert_buffer(self, max_size=1000, max_age=None, retry_policy=None):
+        return UpsertBuffer(self, max_size=max_size, max_age=max_age, retry_policy=retry_policy)
 
     def update(self, **kwargs):
         """
@@ -699,8 +2085,8 @@ class ManagerUtilsMixin(object):
     def get_queryset(self):
         return ManagerUtilsQuerySet(self.model)
 
-    def id_dict(self):
-        return id_dict(self.get_queryset())
+    def id_dict(self, key='pk', fields=None, chunk_size=None):
+        return id_dict(self.get_queryset(), key=key, fields=fields, chunk_size=chunk_size)
 
     def bulk_upsert(
             self, model_objs, unique_fields, update_fields=None, return_upserts=False, return_upserts_distinct=False,
@@ -710,32 +2096,76 @@ class ManagerUtilsMixin(object):
             return_upserts_distinct=return_upserts_distinct, native=native)
 
     def bulk_upsert2(self, model_objs, unique_fields, update_fields=None, returning=False,
-                     ignore_duplicate_updates=True, return_untouched=False):
+                     ignore_duplicate_updates=True, return_untouched=False, retry_policy=None, hash_field=None,
+                     exclude_unchanged=False, on_duplicate_input=None, update_condition=None,
+                     unique_constraint=None, unique_condition=None, dry_run=False, natural_keys=None,
+                     on_unresolved='error'):
         return bulk_upsert2(
             self.get_queryset(), model_objs, unique_fields,
             update_fields=update_fields, returning=returning,
             ignore_duplicate_updates=ignore_duplicate_updates,
-            return_untouched=return_untouched)
+            return_untouched=return_untouched, retry_policy=retry_policy,
+            hash_field=hash_field, exclude_unchanged=exclude_unchanged, on_duplicate_input=on_duplicate_input,
+            update_condition=update_condition, unique_constraint=unique_constraint, unique_condition=unique_condition,
+            dry_run=dry_run, natural_keys=natural_keys, on_unresolved=on_unresolved)
 
     def sync(self, model_objs, unique_fields, update_fields=None, native=False):
         return sync(self.get_queryset(), model_objs, unique_fields, update_fields=update_fields, native=native)
 
-    def sync2(self, model_objs, unique_fields, update_fields=None, returning=False, ignore_duplicate_updates=True):
+    def sync2(self, model_objs, unique_fields, update_fields=None, returning=False, ignore_duplicate_updates=True,
+              retry_policy=None, lock_scope=None, skip_locked=False, hash_field=None, exclude_unchanged=False,
+              on_duplicate_input=None, update_condition=None, unique_constraint=None, unique_condition=None,
+              on_missing=None, revive=False, dry_run=False, natural_keys=None, on_unresolved='error'):
         return sync2(
             self.get_queryset(), model_objs, unique_fields, update_fields=update_fields, returning=returning,
-            ignore_duplicate_updates=ignore_duplicate_updates)
-
-    def bulk_update(self, model_objs, fields_to_update):
-        return bulk_update(self.get_queryset(), model_objs, fields_to_update)
-
-    def upsert(self, defaults=None, updates=None, **kwargs):
-        return upsert(self.get_queryset(), defaults=defaults, updates=updates, **kwargs)
+            ignore_duplicate_updates=ignore_duplicate_updates, retry_policy=retry_policy,
+            lock_scope=lock_scope, skip_locked=skip_locked, hash_field=hash_field,
+            exclude_unchanged=exclude_unchanged, on_duplicate_input=on_duplicate_input,
+            update_condition=update_condition, unique_constraint=unique_constraint,
+            unique_condition=unique_condition, on_missing=on_missing, revive=revive, dry_run=dry_run,
+            natural_keys=natural_keys, on_unresolved=on_unresolved)
+
+    def stream_sync2(self, model_objs, unique_fields, update_fields=None, chunk_size=1000,
+                     ignore_duplicate_updates=True, lock_scope=None, skip_locked=False, on_missing=None, revive=False):
+        return stream_sync2(
+            self.get_queryset(), model_objs, unique_fields, update_fields=update_fields, chunk_size=chunk_size,
+            ignore_duplicate_updates=ignore_duplicate_updates, lock_scope=lock_scope, skip_locked=skip_locked,
+            on_missing=on_missing, revive=revive)
+
+    def sync_partitioned(self, model_objs, unique_fields, partition_field, update_fields=None, returning=False,
+                         ignore_duplicate_updates=True, retry_policy=None):
+        return sync_partitioned(
+            self.get_queryset(), model_objs, unique_fields, partition_field, update_fields=update_fields,
+            returning=returning, ignore_duplicate_updates=ignore_duplicate_updates, retry_policy=retry_policy)
+
+    def upsert_graph(self, model_objs, unique_fields, child_queryset, child_objs, child_unique_fields,
+                     update_fields=None, child_update_fields=None, fk_field=None, sync=False, retry_policy=None):
+        return upsert_graph(
+            self.get_queryset(), model_objs, unique_fields, child_queryset, child_objs, child_unique_fields,
+            update_fields=update_fields, child_update_fields=child_update_fields, fk_field=fk_field, sync=sync,
+            retry_policy=retry_policy)
+
+    def bulk_update(self, model_objs, fields_to_update, retry_policy=None):
+        return bulk_update(self.get_queryset(), model_objs, fields_to_update, retry_policy=retry_policy)
+
+    def upsert(self, defaults=None, updates=None, native=False, **kwargs):
+        return upsert(self.get_queryset(), defaults=defaults, updates=updates, native=native, **kwargs)
 
     def get_or_none(self, **query_params):
         return get_or_none(self.get_queryset(), **query_params)
 
-    def single(self):
-        return single(self.get_queryset())
+    def get_or_none_many(self, field_or_fields, keys, only=None, values=None, batch_size=1000):
+        return get_or_none_many(
+            self.get_queryset(), field_or_fields, keys, only=only, values=values, batch_size=batch_size)
+
+    def single(self, cached=False, ttl=None, cache_alias=None):
+        return single(self.get_queryset(), cached=cached, ttl=ttl, cache_alias=cache_alias)
+
+    def claim(self, limit, updates):
+        return claim(self.get_queryset(), limit, updates)
+
+    def upsert_buffer(self, max_size=1000, max_age=None, retry_policy=None):
+        return UpsertBuffer(self.get_queryset(), max_size=max_size, max_age=max_age, retry_policy=retry_policy)
 
 
 class ManagerUtilsManager(ManagerUtilsMixin, Manager):
@@ -0,0 +1,13 @@
+from .manager_utils import identity_map
+
+
+class IdentityMapMiddleware(object):
+    """
+    Memoizes the results of get_or_none and single for the duration of each request.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with identity_map():
+            return self.get_response(request)
@@ -1,11 +1,28 @@
+from collections import Counter
+import contextvars
 import datetime as dt
 
-from django.test import TestCase
+from django.core.cache import caches
+from django.db import connection
+from django.db.backends.utils import CursorWrapper
+from django.db.utils import DatabaseError, IntegrityError, OperationalError
+from django.db.models import F, Q, QuerySet, Value
+from django.db.models.functions import Concat, Now
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
 from django_dynamic_fixture import G
 import freezegun
-from manager_utils import post_bulk_operation
-from manager_utils.manager_utils import _get_prepped_model_field
-from unittest.mock import patch
+from django.db.models.signals import post_delete, post_save
+from manager_utils import (
+    Excluded, id_dict, identity_map, post_bulk_operation, register_cached_single, RetryPolicy, stream_sync2,
+    sync_m2m, sync_partitioned, upsert, upsert2, upsert_graph, UpsertBuffer
+)
+from manager_utils import manager_utils as manager_utils_module
+from manager_utils.middleware import IdentityMapMiddleware
+from manager_utils.manager_utils import (
+    _fetch_extant_model_objs, _get_advisory_lock_keys, _get_prepped_model_field, _record_touched_pks
+)
+from unittest.mock import call, patch
 from parameterized import parameterized
 from pytz import timezone
 
@@ -49,6 +66,25 @@ class SyncTest(TestCase):
         test_model = models.TestPkChar.objects.get(pk=extant_obj3.pk)
         self.assertEqual(test_model.char_field, '2')
 
+    @parameterized.expand([(True,), (False,)])
+    def test_existing_objs_wo_update_fields(self, native):
+        """
+        Tests that matched objects are not deleted when there are no fields to update.
+        """
+        extant_obj1 = G(models.TestModel, int_field=1, float_field=1)
+        extant_obj2 = G(models.TestModel, int_field=2, float_field=1)
+
+        models.TestModel.objects.sync([
+            models.TestModel(int_field=1, float_field=2), models.TestModel(int_field=3, float_field=2),
+        ], ['int_field'], native=native)
+
+        self.assertEqual(
+            list(models.TestModel.objects.order_by('int_field').values_list('int_field', 'float_field')),
+            [(1, 1), (3, 2)]
+        )
+        self.assertEqual(models.TestModel.objects.get(int_field=1).id, extant_obj1.id)
+        self.assertFalse(models.TestModel.objects.filter(id=extant_obj2.id).exists())
+
     @parameterized.expand([(True,), (False,)])
     def test_no_existing_objs(self, native):
         """
@@ -344,6 +380,64 @@ class Sync2Test(TestCase):
         self.assertEqual(list(results.deleted)[0].id, objs[0].id)
 
 
+class Sync2LockScopeTest(TestCase):
+    """
+    Tests scoping concurrent sync2 operations with advisory locks.
+    """
+    def get_advisory_lock_count(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT COUNT(*) FROM pg_locks WHERE locktype = \'advisory\' AND pid = pg_backend_pid()')
+            return cursor.fetchone()[0]
+
+    def hold_lock_in_other_session(self, model, lock_scope):
+        other_connection = connection.copy()
+        self.addCleanup(other_connection.close)
+        with other_connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_lock(%s, %s)', _get_advisory_lock_keys(model, lock_scope))
+
+    def test_lock_held_during_sync(self):
+        G(models.TestModel, int_field=2)
+        results = models.TestModel.objects.sync2(
+            [models.TestModel(int_field=1)], ['int_field'], returning=True, lock_scope='tenant-1')
+
+        self.assertEqual(len(list(results.created)), 1)
+        self.assertEqual(len(list(results.deleted)), 1)
+        # The lock is held until the end of the transaction of the test
+        self.assertEqual(self.get_advisory_lock_count(), 1)
+
+    def test_no_lock_scope(self):
+        models.TestModel.objects.sync2([models.TestModel(int_field=1)], ['int_field'])
+        self.assertEqual(self.get_advisory_lock_count(), 0)
+
+    def test_skip_locked(self):
+        G(models.TestModel, int_field=2)
+        self.hold_lock_in_other_session(models.TestModel, 'tenant-1')
+
+        results = models.TestModel.objects.sync2(
+            [models.TestModel(int_field=1)], ['int_field'], lock_scope='tenant-1', skip_locked=True)
+
+        self.assertIsNone(results)
+        self.assertEqual(list(models.TestModel.objects.values_list('int_field', flat=True)), [2])
+
+    def test_skip_locked_other_scope(self):
+        self.hold_lock_in_other_session(models.TestModel, 'tenant-2')
+
+        results = models.TestModel.objects.sync2(
+            [models.TestModel(int_field=1)], ['int_field'], lock_scope='tenant-1', skip_locked=True)
+
+        self.assertEqual(results.retries, 0)
+        self.assertEqual(list(models.TestModel.objects.values_list('int_field', flat=True)), [1])
+
+    def test_lock_keys(self):
+        keys = _get_advisory_lock_keys(models.TestModel, 1)
+        self.assertEqual(keys, _get_advisory_lock_keys(models.TestModel, '1'))
+        self.assertNotEqual(keys, _get_advisory_lock_keys(models.TestModel, 2))
+        self.assertNotEqual(keys, _get_advisory_lock_keys(models.TestPkChar, 1))
+        for key in keys + _get_advisory_lock_keys(models.TestModel, 'tenant-1'):
+            self.assertTrue(-2 ** 31 <= key < 2 ** 31)
+
+
 class BulkUpsertTest(TestCase):
     """
     Tests the bulk_upsert function.
@@ -374,11 +468,11 @@ class BulkUpsertTest(TestCase):
 
     def test_return_upserts_distinct_none_native(self):
         """
-        verifies that return_upserts_distinct flag with native is not supported
+        Tests the return_upserts_distinct flag on native bulk upserts when there is no data.
         """
-        with self.assertRaises(NotImplementedError):
-            models.TestModel.objects.bulk_upsert(
-                [], ['float_field'], ['float_field'], return_upserts_distinct=True, native=True)
+        return_values = models.TestModel.objects.bulk_upsert(
+            [], ['float_field'], ['float_field'], return_upserts_distinct=True, native=True)
+        self.assertEqual(return_values, ([], []))
 
     def test_return_created_values(self):
         """
@@ -451,6 +545,98 @@ class BulkUpsertTest(TestCase):
             self.assertIsNotNone(test_model.id)
         self.assertEqual(models.TestModel.objects.count(), 3)
 
+    def test_return_created_values_hydrated_from_insert(self):
+        """
+        Tests that created values are hydrated from the insert without an additional query to fetch them.
+        """
+        G(models.TestModel, int_field=2, float_field=1.0)
+        model_objs = [
+            models.TestModel(int_field=1, float_field=3.0, json_field={'a': 1}),
+            models.TestModel(int_field=2, float_field=3.0),
+            models.TestModel(int_field=3, float_field=3.0, time_zone='US/Eastern'),
+        ]
+
+        # One query to fetch the matching objects, one to update them and one to insert the new ones
+        with self.assertNumQueries(3):
+            updated, created = models.TestModel.objects.bulk_upsert(
+                model_objs, ['int_field'], ['float_field'], return_upserts_distinct=True)
+
+        self.assertEqual([obj.int_field for obj in updated], [2])
+        self.assertEqual([obj.int_field for obj in created], [1, 3])
+        self.assertEqual(created[0].json_field, {'a': 1})
+        self.assertEqual(created[1].time_zone, timezone('US/Eastern'))
+        self.assertEqual([obj.get_deferred_fields() for obj in created], [set(), set()])
+        self.assertEqual(
+            [created[0].id, created[1].id], list(models.TestModel.objects.filter(int_field__in=[1, 3]).order_by(
+                'int_field').values_list('id', flat=True)))
+
+        # The primary keys of the provided objects are set
+        self.assertEqual(model_objs[0].id, created[0].id)
+        self.assertFalse(model_objs[0]._state.adding)
+
+    def test_return_created_values_batches(self):
+        """
+        Tests that created values are inserted in batches.
+        """
+        model_objs = [models.TestModel(int_field=i) for i in range(3)]
+
+        with self.assertNumQueries(2):
+            created = manager_utils_module._bulk_create_returning(models.TestModel.objects.all(), model_objs, 2)
+
+        self.assertEqual([obj.int_field for obj in created], [0, 1, 2])
+        self.assertEqual([obj.id for obj in model_objs], [obj.id for obj in created])
+
+    def test_return_created_values_filtered_queryset(self):
+        """
+        Tests that created values are fetched through a filtered queryset, which leaves out the created
+        values it doesn't match.
+        """
+        return_values = models.TestModel.objects.filter(char_field='1').bulk_upsert([
+            models.TestModel(int_field=1, char_field='1'),
+            models.TestModel(int_field=2, char_field='2'),
+        ], ['int_field'], ['char_field'], return_upserts=True)
+
+        self.assertEqual([obj.int_field for obj in return_values], [1])
+        self.assertEqual(models.TestModel.objects.count(), 2)
+
+    def test_return_created_values_select_related(self):
+        """
+        Tests that created values are fetched through a queryset that hydrates relationships.
+        """
+        test_model = G(models.TestModel)
+
+        return_values = models.TestForeignKeyModel.objects.select_related('test_model').bulk_upsert(
+            [models.TestForeignKeyModel(int_field=1, test_model=test_model)], ['int_field'], return_upserts=True)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(return_values[0].test_model.id, test_model.id)
+
+    def test_return_created_values_w_pk(self):
+        """
+        Tests that created values with a provided primary key are hydrated from the insert.
+        """
+        return_values = models.TestPkChar.objects.bulk_upsert(
+            [models.TestPkChar(my_key='1', char_field='1'), models.TestPkChar(my_key='2', char_field='2')],
+            ['my_key'], ['char_field'], return_upserts=True)
+
+        self.assertEqual([(obj.my_key, obj.char_field) for obj in return_values], [('1', '1'), ('2', '2')])
+        self.assertEqual(models.TestPkChar.objects.count(), 2)
+
+    def test_return_created_values_wo_insert_returning(self):
+        """
+        Tests that created values are fetched by their primary keys on databases other than postgres.
+        """
+        with patch('manager_utils.manager_utils.connection') as mock_connection:
+            mock_connection.vendor = 'sqlite'
+            return_values = models.TestModel.objects.bulk_upsert(
+                [models.TestModel(int_field=1, float_field=3.0)], ['int_field'], ['float_field'], return_upserts=True)
+            empty_return_values = models.TestModel.objects.bulk_upsert(
+                [], ['int_field'], ['float_field'], return_upserts=True)
+
+        self.assertEqual(empty_return_values, [])
+        self.assertEqual([(obj.int_field, obj.float_field) for obj in return_values], [(1, 3.0)])
+        self.assertIsNotNone(return_values[0].id)
+
     def test_return_created_updated_values(self):
         """
         Tests returning values when the items are either updated or created.
@@ -498,6 +684,30 @@ class BulkUpsertTest(TestCase):
             self.assertIsNotNone(test_model.id)
         self.assertEqual(models.TestModel.objects.count(), 4)
 
+    def test_return_created_updated_values_distinct_native(self):
+        """
+        Tests returning distinct sets of hydrated values from a single native upsert statement.
+        """
+        G(models.TestModel, int_field=2, float_field=1.0)
+        G(models.TestModel, int_field=3, float_field=3.0)
+        model_objects = [
+            models.TestModel(int_field=1, float_field=3.0, json_field={'a': 1}),
+            models.TestModel(int_field=2, float_field=3.0),
+            models.TestModel(int_field=3, float_field=3.0),
+        ]
+
+        with self.assertNumQueries(1):
+            updated, created = models.TestModel.objects.bulk_upsert(
+                model_objects, ['int_field'], ['float_field'], return_upserts_distinct=True, native=True)
+
+        self.assertEqual(
+            [(2, 3.0), (3, 3.0)],
+            [(obj.int_field, obj.float_field) for obj in sorted(updated, key=lambda k: k.int_field)]
+        )
+        self.assertEqual([(1, 3.0, {'a': 1})], [(obj.int_field, obj.float_field, obj.json_field) for obj in created])
+        self.assertEqual(created[0].id, models.TestModel.objects.get(int_field=1).id)
+        self.assertFalse(created[0]._state.adding)
+
     def test_return_created_updated_values_distinct(self):
         """
         Tests returning distinct sets of values when the items are either updated or created.
@@ -941,6 +1151,126 @@ class BulkUpsertTest(TestCase):
             self.assertEqual(model_obj.int_field, i)
             self.assertEqual(model_obj.char_field, '-1')
 
+    def test_fk_pk_native(self):
+        """
+        Tests a native upsert that returns the upserts of a model whose primary key is a foreign key.
+        """
+        test_model1 = G(models.TestModel)
+        test_model2 = G(models.TestModel)
+        G(models.TestPkForeignKey, my_key=test_model1, char_field='0')
+
+        upserts = models.TestPkForeignKey.objects.bulk_upsert([
+            models.TestPkForeignKey(my_key=test_model1, char_field='1'),
+            models.TestPkForeignKey(my_key=test_model2, char_field='2'),
+        ], ['my_key'], ['char_field'], return_upserts=True, native=True)
+
+        self.assertEqual(sorted((obj.my_key_id, obj.char_field) for obj in upserts), sorted([
+            (test_model1.id, '1'), (test_model2.id, '2')
+        ]))
+        self.assertEqual(
+            sorted(models.TestPkForeignKey.objects.values_list('my_key', 'char_field')),
+            sorted([(test_model1.id, '1'), (test_model2.id, '2')])
+        )
+
+    def test_fk_pk_sync_native(self):
+        """
+        Tests a native sync of a model whose primary key is a foreign key.
+        """
+        test_model1 = G(models.TestModel)
+        test_model2 = G(models.TestModel)
+        G(models.TestPkForeignKey, my_key=test_model1, char_field='0')
+
+        models.TestPkForeignKey.objects.sync([
+            models.TestPkForeignKey(my_key=test_model2, char_field='2'),
+        ], ['my_key'], ['char_field'], native=True)
+
+        self.assertEqual(list(models.TestPkForeignKey.objects.values_list('my_key', 'char_field')), [
+            (test_model2.id, '2')
+        ])
+
+    def test_fk_update_field_native(self):
+        """
+        Tests a native upsert with the name of a foreign key in the unique and update fields.
+        """
+        test_model = G(models.TestModel)
+        G(models.TestChildModel, test_model=test_model, int_field=1, char_field='0')
+
+        models.TestChildModel.objects.bulk_upsert([
+            models.TestChildModel(test_model=test_model, int_field=1, char_field='1'),
+            models.TestChildModel(test_model=test_model, int_field=2, char_field='2'),
+        ], ['test_model', 'int_field'], ['test_model', 'char_field'], native=True)
+
+        self.assertEqual(
+            list(models.TestChildModel.objects.order_by('int_field').values_list(
+                'test_model', 'int_field', 'char_field'
+            )),
+            [(test_model.id, 1, '1'), (test_model.id, 2, '2')]
+        )
+
+    def test_some_updates_unique_int_field_null_value(self):
+        """
+        Tests that an object with a null unique value is matched with the stored object that has a null value.
+        """
+        G(models.TestModel, int_field=None, char_field='-1', float_field=-1)
+        G(models.TestModel, int_field=1, char_field='-1', float_field=-1)
+
+        models.TestModel.objects.bulk_upsert([
+            models.TestModel(int_field=None, float_field=0),
+            models.TestModel(int_field=2, float_field=2),
+        ], ['int_field'], ['float_field'])
+
+        self.assertEqual(models.TestModel.objects.count(), 3)
+        self.assertAlmostEqual(models.TestModel.objects.get(int_field__isnull=True).float_field, 0)
+        self.assertAlmostEqual(models.TestModel.objects.get(int_field=1).float_field, -1)
+        self.assertAlmostEqual(models.TestModel.objects.get(int_field=2).float_field, 2)
+
+
+class FetchExtantModelObjsTest(TestCase):
+    """
+    Tests the key scoped fetch of extant objects used by bulk_upsert.
+    """
+    def test_only_matching_objs_fetched(self):
+        for i in range(5):
+            G(models.TestModel, int_field=i, char_field=str(i), float_field=i)
+
+        extant_model_objs = _fetch_extant_model_objs(models.TestModel.objects.all(), [
+            models.TestModel(int_field=1), models.TestModel(int_field=3), models.TestModel(int_field=10),
+        ], ['int_field'])
+
+        self.assertEqual(sorted(extant_model_objs.keys()), [(1,), (3,)])
+        self.assertEqual(extant_model_objs[(3,)].char_field, '3')
+
+    def test_composite_keys_batched(self):
+        for i in range(5):
+            G(models.TestModel, int_field=i, char_field=str(i), float_field=i)
+
+        with self.assertNumQueries(4):
+            extant_model_objs = _fetch_extant_model_objs(models.TestModel.objects.all(), [
+                models.TestModel(int_field=0, char_field='0'),
+                models.TestModel(int_field=1, char_field='-1'),
+                models.TestModel(int_field=2, char_field='2'),
+                models.TestModel(int_field=4, char_field='4'),
+                models.TestModel(int_field=4, char_field='4'),
+            ], ['int_field', 'char_field'], batch_size=1)
+
+        self.assertEqual(sorted(extant_model_objs.keys()), [(0, '0'), (2, '2'), (4, '4')])
+
+    def test_only_fields(self):
+        G(models.TestModel, int_field=1, char_field='1', float_field=1)
+
+        extant_model_objs = _fetch_extant_model_objs(
+            models.TestModel.objects.all(), [models.TestModel(int_field=1)], ['int_field'],
+            only_fields=['id', 'int_field', 'float_field'])
+
+        self.assertEqual(
+            extant_model_objs[(1,)].get_deferred_fields(), {'char_field', 'json_field', 'array_field', 'time_zone'})
+
+    def test_no_model_objs(self):
+        G(models.TestModel, int_field=1)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(_fetch_extant_model_objs(models.TestModel.objects.all(), [], ['int_field']), {})
+
 
 class BulkUpsert2Test(TestCase):
     """
@@ -1401,149 +1731,1658 @@ class BulkUpsert2Test(TestCase):
             self.assertEqual(model_obj.char_field, '-1')
 
 
-class PostBulkOperationSignalTest(TestCase):
+def _get_db_error(error_class, sqlstate, sqlstate_attr='pgcode'):
+    cause = Exception('error')
+    setattr(cause, sqlstate_attr, sqlstate)
+    error = error_class('error')
+    error.__cause__ = cause
+    return error
+
+
+class BulkUpsert2HashFieldTest(TestCase):
     """
-    Tests that the post_bulk_operation signal is emitted on all functions that emit the signal.
+    Tests bulk_upsert2 and sync2 with a hash field for detecting duplicate updates.
     """
-    def setUp(self):
-        """
-        Defines a siangl handler that collects information about fired signals
-        """
-        class SignalHandler(object):
-            num_times_called = 0
-            model = None
+    def test_hash_filled(self):
+        models.TestHashModel.objects.bulk_upsert2([
+            models.TestHashModel(int_field=1, json_field={'a': 1, 'b': [1, 2]}, array_field=['1']),
+            models.TestHashModel(int_field=2, json_field={'b': [1, 2], 'a': 1}, array_field=['1']),
+            models.TestHashModel(int_field=3, json_field={'a': 2}, array_field=['1']),
+        ], ['int_field'], hash_field='content_hash')
+
+        hashes = dict(models.TestHashModel.objects.values_list('int_field', 'content_hash'))
+        self.assertEqual(len(hashes[1]), 64)
+        self.assertEqual(hashes[1], hashes[2])
+        self.assertNotEqual(hashes[1], hashes[3])
+
+    def test_hash_all_fields(self):
+        # All fields of the test model are hashed, including its time zone field
+        models.TestModel.objects.bulk_upsert2(
+            [models.TestModel(int_field=1, json_field={'a': 1}, time_zone='US/Eastern')], ['int_field'],
+            hash_field='char_field')
+        results = models.TestModel.objects.bulk_upsert2(
+            [models.TestModel(int_field=1, json_field={'a': 1}, time_zone='US/Eastern')], ['int_field'],
+            returning=True, return_untouched=True, hash_field='char_field')
+
+        self.assertEqual([r.int_field for r in results.untouched], [1])
+        self.assertEqual(len(models.TestModel.objects.get().char_field), 64)
+
+    def test_duplicate_updates_compare_hash(self):
+        models.TestHashModel.objects.bulk_upsert2([
+            models.TestHashModel(int_field=1, json_field={'a': 1}, array_field=['1']),
+            models.TestHashModel(int_field=2, json_field={'a': 2}, array_field=['2']),
+        ], ['int_field'], hash_field='content_hash')
+        orig_hash = models.TestHashModel.objects.get(int_field=2).content_hash
+
+        with CaptureQueriesContext(connection) as queries:
+            results = models.TestHashModel.objects.bulk_upsert2([
+                models.TestHashModel(int_field=1, json_field={'a': 1}, array_field=['1']),
+                models.TestHashModel(int_field=2, json_field={'a': 3}, array_field=['2']),
+            ], ['int_field'], returning=True, return_untouched=True, hash_field='content_hash')
+
+        self.assertEqual([r.int_field for r in results.untouched], [1])
+        self.assertEqual([r.int_field for r in results.updated], [2])
+        self.assertEqual(models.TestHashModel.objects.get(int_field=2).json_field, {'a': 3})
+        self.assertNotEqual(models.TestHashModel.objects.get(int_field=2).content_hash, orig_hash)
+        self.assertIn('WHERE (tests_testhashmodel."content_hash") IS DISTINCT FROM (EXCLUDED."content_hash")',
+                      queries[0]['sql'])
+
+    def test_hash_only_covers_update_fields(self):
+        models.TestHashModel.objects.bulk_upsert2([
+            models.TestHashModel(int_field=1, char_field='1', json_field={'a': 1}),
+        ], ['int_field'], ['json_field'], hash_field='content_hash')
+
+        results = models.TestHashModel.objects.bulk_upsert2([
+            models.TestHashModel(int_field=1, char_field='2', json_field={'a': 1}),
+        ], ['int_field'], ['json_field'], returning=True, return_untouched=True, hash_field='content_hash')
 
-            def __call__(self, *args, **kwargs):
-                self.num_times_called += 1
-                self.model = kwargs['model']
+        self.assertEqual(len(list(results.untouched)), 1)
+        self.assertEqual(models.TestHashModel.objects.get().char_field, '1')
+
+    def test_no_update_fields(self):
+        models.TestHashModel.objects.bulk_upsert2([
+            models.TestHashModel(int_field=1, json_field={'a': 1}),
+        ], ['int_field'], [], hash_field='content_hash')
+        models.TestHashModel.objects.bulk_upsert2([
+            models.TestHashModel(int_field=1, json_field={'a': 2}),
+        ], ['int_field'], [], hash_field='content_hash')
+
+        self.assertEqual(models.TestHashModel.objects.get().json_field, {'a': 1})
+
+    def test_exclude_unchanged(self):
+        models.TestHashModel.objects.bulk_upsert2([
+            models.TestHashModel(int_field=1, json_field={'a': 1}),
+            models.TestHashModel(int_field=2, json_field={'a': 2}),
+        ], ['int_field'], hash_field='content_hash')
+        extant_obj = models.TestHashModel.objects.get(int_field=1)
+
+        with CaptureQueriesContext(connection) as queries:
+            results = models.TestHashModel.objects.bulk_upsert2([
+                models.TestHashModel(int_field=1, json_field={'a': 1}),
+                models.TestHashModel(int_field=2, json_field={'a': 3}),
+                models.TestHashModel(int_field=3, json_field={'a': 3}),
+            ], ['int_field'], returning=['id', 'int_field'], return_untouched=True, hash_field='content_hash',
+                exclude_unchanged=True)
+
+        self.assertEqual(len(queries), 2)
+        self.assertNotIn('"json_field"', queries[0]['sql'])
+        self.assertNotIn('{"a": 1}', str(queries[1]['sql']))
+        self.assertEqual([(r.id, r.int_field, r.status_) for r in results.untouched], [(extant_obj.id, 1, 'n')])
+        self.assertEqual([r.int_field for r in results.updated], [2])
+        self.assertEqual([r.int_field for r in results.created], [3])
+
+    def test_exclude_unchanged_queryset_scope(self):
+        models.TestHashModel.objects.bulk_upsert2([
+            models.TestHashModel(int_field=1, json_field={'a': 1}),
+        ], ['int_field'], hash_field='content_hash')
+
+        # The row is outside of the queryset, so the model is upserted like it is without a hash field
+        with CaptureQueriesContext(connection) as queries:
+            models.TestHashModel.objects.filter(int_field=2).bulk_upsert2([
+                models.TestHashModel(int_field=1, json_field={'a': 1}),
+            ], ['int_field'], hash_field='content_hash', exclude_unchanged=True)
+
+        self.assertIn('"tests_testhashmodel"."int_field" = 2', queries[0]['sql'])
+        self.assertIn('"tests_testhashmodel"."int_field" IN (1)', queries[0]['sql'])
+        self.assertEqual(len(queries), 2)
+
+    def test_exclude_unchanged_all_unchanged(self):
+        models.TestHashModel.objects.bulk_upsert2([
+            models.TestHashModel(int_field=1, json_field={'a': 1}),
+        ], ['int_field'], hash_field='content_hash')
+
+        with self.assertNumQueries(1):
+            results = upsert2.upsert(models.TestHashModel, [
+                models.TestHashModel(int_field=1, json_field={'a': 1}),
+            ], ['int_field'], hash_field='content_hash', exclude_unchanged=True)
+
+        self.assertEqual(results, [])
+
+    def test_exclude_unchanged_null_unique_field(self):
+        models.TestHashModel.objects.bulk_upsert2([
+            models.TestHashModel(int_field=None, json_field={'a': 1}),
+        ], ['int_field'], hash_field='content_hash')
+
+        models.TestHashModel.objects.bulk_upsert2([
+            models.TestHashModel(int_field=None, json_field={'a': 1}),
+        ], ['int_field'], hash_field='content_hash', exclude_unchanged=True)
+
+        self.assertEqual(models.TestHashModel.objects.count(), 2)
+
+    def test_exclude_unchanged_batches(self):
+        models.TestHashModel.objects.bulk_upsert2([
+            models.TestHashModel(int_field=i, json_field={'a': i}) for i in range(3)
+        ], ['int_field'], hash_field='content_hash')
+
+        model_objs = [models.TestHashModel(int_field=i, json_field={'a': i}) for i in range(3)]
+        upsert2._fill_hash_field(models.TestHashModel, model_objs, ['json_field'], 'content_hash')
+        with self.assertNumQueries(2):
+            to_upsert, unchanged_pks = upsert2._exclude_unchanged(
+                models.TestHashModel.objects.all(), model_objs, ['int_field'], ['json_field', 'content_hash'],
+                hash_field='content_hash', batch_size=2)
+
+        self.assertEqual(len(to_upsert), 3)
+        self.assertEqual(unchanged_pks, [])
+
+    def test_sync_exclude_unchanged(self):
+        models.TestHashModel.objects.bulk_upsert2([
+            models.TestHashModel(int_field=1, json_field={'a': 1}),
+            models.TestHashModel(int_field=2, json_field={'a': 2}),
+        ], ['int_field'], hash_field='content_hash')
+
+        results = models.TestHashModel.objects.sync2([
+            models.TestHashModel(int_field=1, json_field={'a': 1}),
+        ], ['int_field'], hash_field='content_hash', exclude_unchanged=True)
+
+        self.assertEqual(list(models.TestHashModel.objects.values_list('int_field', flat=True)), [1])
+        self.assertEqual(len(list(results.untouched)), 1)
+        self.assertEqual(len(list(results.deleted)), 1)
 
-        self.signal_handler = SignalHandler()
-        post_bulk_operation.connect(self.signal_handler)
+    def test_exclude_unchanged_return_models(self):
+        with self.assertRaises(ValueError):
+            upsert2.upsert(models.TestHashModel, [], ['int_field'], hash_field='content_hash',
+                           exclude_unchanged=True, return_models=True)
 
-    def tearDown(self):
-        """
-        Disconnect the siangl to make sure it doesn't get connected multiple times.
-        """
-        post_bulk_operation.disconnect(self.signal_handler)
 
-    def test_custom_field_bulk_update(self):
-        model_obj = models.TestModel.objects.create(int_field=2)
-        model_obj.time_zone = timezone('US/Eastern')
-        models.TestModel.objects.bulk_update([model_obj], ['time_zone'])
-        model_obj = models.TestModel.objects.get(id=model_obj.id)
-        self.assertEqual(model_obj.time_zone, timezone('US/Eastern'))
+class ExcludeUnchangedTest(TestCase):
+    """
+    Tests bulk_upsert2 and sync2 excluding unchanged models by comparing them with the stored rows.
+    """
+    def test_sync(self):
+        extant_obj1 = G(models.TestModel, int_field=1, char_field='1', float_field=1.0, json_field={'a': [1]})
+        G(models.TestModel, int_field=2, char_field='1', float_field=1.0)
+        extant_obj3 = G(models.TestModel, int_field=3, char_field='1', float_field=1.0)
+
+        with CaptureQueriesContext(connection) as queries:
+            results = models.TestModel.objects.sync2([
+                models.TestModel(int_field=1, char_field='1', float_field=1, json_field={'a': [1]}),
+                models.TestModel(int_field=2, char_field='2', float_field=1.0),
+                models.TestModel(int_field=4, char_field='4', float_field=4.0),
+            ], ['int_field'], ['char_field', 'float_field', 'json_field'], returning=True, exclude_unchanged=True)
+
+        self.assertIn('"tests_testmodel"."char_field"', queries[0]['sql'])
+        self.assertNotIn('VALUES', queries[0]['sql'])
+        self.assertIn('VALUES', queries[1]['sql'])
+        # Only the changed and new rows are sent
+        self.assertIn("('1', ", queries[1]['sql'])
+        self.assertNotIn("('2', ", queries[1]['sql'])
+        # Unchanged rows have the same fields as the upserted rows
+        self.assertEqual(
+            [(r.id, r.int_field, r.char_field, r.float_field, r.json_field, r.status_) for r in results.untouched],
+            [(extant_obj1.id, 1, '1', 1.0, {'a': [1]}, 'n')]
+        )
+        self.assertEqual(set(next(results.untouched)._fields), set(next(results.updated)._fields))
+        self.assertEqual([r.int_field for r in results.updated], [2])
+        self.assertEqual([r.int_field for r in results.created], [4])
+        self.assertEqual([r.id for r in results.deleted], [extant_obj3.id])
+        self.assertEqual(
+            list(models.TestModel.objects.order_by('int_field').values_list('int_field', 'char_field')),
+            [(1, '1'), (2, '2'), (4, '4')]
+        )
 
-    def test_post_bulk_operation_queryset_update(self):
-        """
-        Tests that the update operation on a queryset emits the post_bulk_operation signal.
-        """
-        models.TestModel.objects.all().update(int_field=1)
+    def test_all_unchanged(self):
+        G(models.TestModel, int_field=1, char_field='1')
 
-        self.assertEqual(self.signal_handler.model, models.TestModel)
-        self.assertEqual(self.signal_handler.num_times_called, 1)
+        with self.assertNumQueries(1):
+            results = models.TestModel.objects.bulk_upsert2([
+                models.TestModel(int_field=1, char_field='1'),
+            ], ['int_field'], ['char_field'], exclude_unchanged=True)
 
-    def test_post_bulk_operation_manager_update(self):
-        """
-        Tests that the update operation on a manager emits the post_bulk_operation signal.
-        """
-        models.TestModel.objects.update(int_field=1)
+        self.assertEqual(results, [])
 
-        self.assertEqual(self.signal_handler.model, models.TestModel)
-        self.assertEqual(self.signal_handler.num_times_called, 1)
+    def test_no_update_fields(self):
+        G(models.TestModel, int_field=1, char_field='1')
 
-    def test_post_bulk_operation_bulk_update(self):
-        """
-        Tests that the bulk_update operation emits the post_bulk_operation signal.
-        """
-        model_obj = models.TestModel.objects.create(int_field=2)
-        models.TestModel.objects.bulk_update([model_obj], ['int_field'])
+        with self.assertNumQueries(1):
+            results = models.TestModel.objects.bulk_upsert2([
+                models.TestModel(int_field=1, char_field='2'),
+            ], ['int_field'], [], return_untouched=True, exclude_unchanged=True)
 
-        self.assertEqual(self.signal_handler.model, models.TestModel)
-        self.assertEqual(self.signal_handler.num_times_called, 1)
+        self.assertEqual([r.status_ for r in results], ['n'])
+        self.assertEqual(models.TestModel.objects.get().char_field, '1')
 
-    def test_post_bulk_operation_bulk_upsert2(self):
-        """
-        Tests that the bulk_upsert2 operation emits the post_bulk_operation signal.
-        """
-        model_obj = models.TestModel.objects.create(int_field=2)
-        models.TestModel.objects.bulk_upsert2([model_obj], ['int_field'])
+    def test_queryset_scope(self):
+        G(models.TestModel, int_field=1, char_field='1')
 
-        self.assertEqual(self.signal_handler.model, models.TestModel)
-        self.assertEqual(self.signal_handler.num_times_called, 1)
+        models.TestModel.objects.filter(char_field='2').bulk_upsert2([
+            models.TestModel(int_field=1, char_field='1', float_field=1.0),
+        ], ['int_field'], ['char_field', 'float_field'], exclude_unchanged=True)
 
-    def test_post_bulk_operation_bulk_create(self):
-        """
-        Tests that the bulk_create operation emits the post_bulk_operation signal.
-        """
-        models.TestModel.objects.bulk_create([models.TestModel(int_field=2)])
+        self.assertEqual(models.TestModel.objects.get().float_field, 1.0)
 
-        self.assertEqual(self.signal_handler.model, models.TestModel)
-        self.assertEqual(self.signal_handler.num_times_called, 1)
+    def test_null_unique_field(self):
+        G(models.TestModel, int_field=None, char_field='1')
 
-    def test_post_bulk_operation_bulk_create_queryset(self):
-        """
-        Tests that the bulk_create operation emits the post_bulk_operation signal.
-        """
-        models.TestModel.objects.all().bulk_create([models.TestModel(int_field=2)])
+        models.TestModel.objects.bulk_upsert2([
+            models.TestModel(int_field=None, char_field='1'),
+        ], ['int_field'], ['char_field'], exclude_unchanged=True)
 
-        self.assertEqual(self.signal_handler.model, models.TestModel)
-        self.assertEqual(self.signal_handler.num_times_called, 1)
+        self.assertEqual(models.TestModel.objects.count(), 2)
 
-    def test_save_doesnt_emit_signal(self):
-        """
-        Tests that a non-bulk operation doesn't emit the signal.
-        """
-        model_obj = models.TestModel.objects.create(int_field=2)
-        model_obj.save()
+    def test_auto_now_not_compared(self):
+        models.TestAutoDateTimeModel.objects.bulk_upsert2([
+            models.TestAutoDateTimeModel(int_field=1),
+        ], ['int_field'])
 
-        self.assertEqual(self.signal_handler.num_times_called, 0)
+        results = models.TestAutoDateTimeModel.objects.bulk_upsert2([
+            models.TestAutoDateTimeModel(int_field=1),
+        ], ['int_field'], return_untouched=True, exclude_unchanged=True)
 
+        self.assertEqual([r.status_ for r in results], ['n'])
 
-class IdDictTest(TestCase):
+
+class OnDuplicateInputTest(TestCase):
     """
-    Tests the id_dict function.
+    Tests collapsing models with the same unique fields in bulk_upsert2 and sync2.
     """
-    def test_no_objects_manager(self):
-        """
-        Tests the output when no objects are present in the manager.
-        """
-        self.assertEqual(models.TestModel.objects.id_dict(), {})
+    def test_no_collapse(self):
+        with self.assertRaises(Exception):
+            models.TestModel.objects.bulk_upsert2([
+                models.TestModel(int_field=1, char_field='1'),
+                models.TestModel(int_field=1, char_field='2'),
+            ], ['int_field'], ['char_field'])
 
-    def test_objects_manager(self):
-        """
-        Tests retrieving a dict of objects keyed on their ID from the manager.
-        """
-        model_obj1 = G(models.TestModel, int_field=1)
-        model_obj2 = G(models.TestModel, int_field=2)
-        self.assertEqual(models.TestModel.objects.id_dict(), {model_obj1.id: model_obj1, model_obj2.id: model_obj2})
+    def test_last(self):
+        results = models.TestModel.objects.bulk_upsert2([
+            models.TestModel(int_field=1, char_field='1'),
+            models.TestModel(int_field=2, char_field='1'),
+            models.TestModel(int_field=1, char_field='2'),
+            models.TestModel(int_field=1, char_field='3'),
+        ], ['int_field'], ['char_field'], on_duplicate_input='last')
 
-    def test_no_objects_queryset(self):
-        """
-        Tests the case when no objects are returned via a queryset.
-        """
-        G(models.TestModel, int_field=1)
-        G(models.TestModel, int_field=2)
-        self.assertEqual(models.TestModel.objects.filter(int_field__gte=3).id_dict(), {})
+        self.assertEqual(results.collapsed, 2)
+        self.assertEqual(
+            list(models.TestModel.objects.order_by('int_field').values_list('int_field', 'char_field')),
+            [(1, '3'), (2, '1')]
+        )
 
-    def test_objects_queryset(self):
-        """
-        Tests the case when objects are returned via a queryset.
-        """
-        G(models.TestModel, int_field=1)
-        model_obj = G(models.TestModel, int_field=2)
-        self.assertEqual(models.TestModel.objects.filter(int_field__gte=2).id_dict(), {model_obj.id: model_obj})
+    def test_first(self):
+        results = models.TestModel.objects.sync2([
+            models.TestModel(int_field=1, char_field='1'),
+            models.TestModel(int_field=1, char_field='2'),
+        ], ['int_field'], ['char_field'], on_duplicate_input='first')
 
+        self.assertEqual(results.collapsed, 1)
+        self.assertEqual(list(models.TestModel.objects.values_list('int_field', 'char_field')), [(1, '1')])
 
-class GetOrNoneTest(TestCase):
-    """
-    Tests the get_or_none function in the manager utils
-    """
-    def test_existing_using_objects(self):
-        """
-        Tests get_or_none on an existing object from Model.objects.
-        """
-        # Create an existing model
-        model_obj = G(models.TestModel)
+    def test_error(self):
+        with self.assertRaisesRegex(ValueError, 'Duplicate values'):
+            models.TestModel.objects.bulk_upsert2([
+                models.TestModel(int_field=1, char_field='1'),
+                models.TestModel(int_field=1, char_field='2'),
+            ], ['int_field'], ['char_field'], on_duplicate_input='error')
+
+        self.assertFalse(models.TestModel.objects.exists())
+
+    def test_no_duplicates(self):
+        results = models.TestModel.objects.bulk_upsert2([
+            models.TestModel(int_field=2, char_field='1'),
+            models.TestModel(int_field=1, char_field='2'),
+        ], ['int_field'], ['char_field'], on_duplicate_input='error')
+
+        self.assertEqual(results.collapsed, 0)
+        self.assertEqual(models.TestModel.objects.count(), 2)
+
+    def test_composite_unique_fields(self):
+        results = models.TestModel.objects.bulk_upsert2([
+            models.TestModel(int_field=1, char_field='1', float_field=1.0),
+            models.TestModel(int_field=2, char_field='1', float_field=1.0),
+            models.TestModel(int_field=1, char_field='1', float_field=2.0),
+        ], ['int_field', 'char_field'], ['float_field'], on_duplicate_input='last')
+
+        self.assertEqual(results.collapsed, 1)
+        self.assertEqual(
+            list(models.TestModel.objects.order_by('int_field').values_list('int_field', 'float_field')),
+            [(1, 2.0), (2, 1.0)]
+        )
+
+    def test_null_values_not_collapsed(self):
+        results = models.TestModel.objects.bulk_upsert2([
+            models.TestModel(int_field=None, char_field='1'),
+            models.TestModel(int_field=None, char_field='2'),
+        ], ['int_field'], ['char_field'], on_duplicate_input='error')
+
+        self.assertEqual(results.collapsed, 0)
+        self.assertEqual(models.TestModel.objects.count(), 2)
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            models.TestModel.objects.bulk_upsert2([], ['int_field'], on_duplicate_input='invalid')
+
+
+class BulkUpsert2MergeTest(TestCase):
+    """
+    Tests bulk_upsert2 with update fields that are merged with the existing rows.
+    """
+    def test_add(self):
+        G(models.TestModel, int_field=1, float_field=1.5, char_field='1')
+
+        with self.assertNumQueries(1):
+            results = models.TestModel.objects.bulk_upsert2([
+                models.TestModel(int_field=1, float_field=2.0, char_field='2'),
+                models.TestModel(int_field=2, float_field=2.0, char_field='2'),
+            ], ['int_field'], {'float_field': 'add', 'char_field': None}, returning=True)
+
+        self.assertEqual(sorted((r.int_field, r.float_field, r.status_) for r in results), [
+            (1, 3.5, 'u'), (2, 2.0, 'c')
+        ])
+        self.assertEqual(
+            list(models.TestModel.objects.order_by('int_field').values_list('float_field', 'char_field')),
+            [(3.5, '2'), (2.0, '2')]
+        )
+
+    def test_add_equal_values_not_ignored(self):
+        G(models.TestModel, int_field=1, float_field=2.0)
+
+        results = models.TestModel.objects.bulk_upsert2([
+            models.TestModel(int_field=1, float_field=2.0),
+        ], ['int_field'], {'float_field': 'add'}, returning=True, return_untouched=True)
+
+        self.assertEqual([(r.float_field, r.status_) for r in results], [(4.0, 'u')])
+
+    def test_greatest_least(self):
+        G(models.TestModel, int_field=1, float_field=2.0, char_field='b')
+        G(models.TestModel, int_field=2, float_field=2.0, char_field='b')
+
+        results = models.TestModel.objects.bulk_upsert2([
+            models.TestModel(int_field=1, float_field=1.0, char_field='c'),
+            models.TestModel(int_field=2, float_field=3.0, char_field='a'),
+        ], ['int_field'], {'float_field': 'greatest', 'char_field': 'least'}, returning=True, return_untouched=True)
+
+        self.assertEqual(sorted((r.int_field, r.float_field, r.char_field, r.status_) for r in results), [
+            (1, 2.0, 'b', 'n'), (2, 3.0, 'a', 'u')
+        ])
+
+    def test_merged_values_unchanged_ignored(self):
+        G(models.TestModel, int_field=1, float_field=2.0)
+
+        results = models.TestModel.objects.bulk_upsert2([
+            models.TestModel(int_field=1, float_field=1.0),
+        ], ['int_field'], {'float_field': 'greatest'}, returning=True, return_untouched=True)
+
+        self.assertEqual([(r.float_field, r.status_) for r in results], [(2.0, 'n')])
+
+    def test_concat(self):
+        G(models.TestModel, int_field=1, json_field={'a': 1, 'b': 1}, array_field=['a'])
+
+        models.TestModel.objects.sync2([
+            models.TestModel(int_field=1, json_field={'b': 2, 'c': 2}, array_field=['b', 'c']),
+        ], ['int_field'], {'json_field': 'concat', 'array_field': 'concat'})
+
+        model_obj = models.TestModel.objects.get()
+        self.assertEqual(model_obj.json_field, {'a': 1, 'b': 2, 'c': 2})
+        self.assertEqual(model_obj.array_field, ['a', 'b', 'c'])
+
+    def test_expression(self):
+        G(models.TestModel, int_field=1, float_field=2.0, char_field='a')
+
+        models.TestModel.objects.bulk_upsert2([
+            models.TestModel(int_field=1, float_field=3.0, char_field='b'),
+        ], ['int_field'], {
+            'float_field': F('float_field') * Excluded('float_field') + Value(1.0),
+            'char_field': Concat(F('char_field'), Value('-'), Excluded('char_field')),
+        })
+
+        self.assertEqual(
+            list(models.TestModel.objects.values_list('float_field', 'char_field')), [(7.0, 'a-b')]
+        )
+
+    def test_expression_not_ignoring_duplicates(self):
+        G(models.TestModel, int_field=1, char_field='a')
+
+        results = models.TestModel.objects.bulk_upsert2([
+            models.TestModel(int_field=1, char_field='a'),
+        ], ['int_field'], {'char_field': Concat(F('char_field'), Value('-'))}, returning=True,
+            ignore_duplicate_updates=False)
+
+        self.assertEqual([(r.char_field, r.status_) for r in results], [('a-', 'u')])
+
+    def test_unique_field_merge_ignored(self):
+        G(models.TestModel, int_field=1, float_field=1.0)
+
+        models.TestModel.objects.bulk_upsert2([
+            models.TestModel(int_field=1, float_field=1.0),
+        ], ['int_field'], {'int_field': 'add', 'float_field': 'add'})
+
+        self.assertEqual(list(models.TestModel.objects.values_list('int_field', 'float_field')), [(1, 2.0)])
+
+    def test_invalid_merger(self):
+        with self.assertRaisesRegex(ValueError, 'Invalid merger'):
+            models.TestModel.objects.bulk_upsert2([], ['int_field'], {'float_field': 'multiply'})
+
+    def test_hash_field(self):
+        with self.assertRaises(ValueError):
+            models.TestHashModel.objects.bulk_upsert2([], ['int_field'], {'json_field': 'concat'},
+                                                      hash_field='content_hash')
+
+
+class BulkUpsert2UpdateConditionTest(TestCase):
+    """
+    Tests bulk_upsert2 and sync2 with a condition that existing rows must meet to be updated.
+    """
+    def test_only_newer_applied(self):
+        G(models.TestModel, int_field=1, float_field=2.0, char_field='1')
+        G(models.TestModel, int_field=2, float_field=2.0, char_field='1')
+
+        with CaptureQueriesContext(connection) as queries:
+            results = models.TestModel.objects.bulk_upsert2([
+                models.TestModel(int_field=1, float_field=1.0, char_field='2'),
+                models.TestModel(int_field=2, float_field=3.0, char_field='2'),
+                models.TestModel(int_field=3, float_field=1.0, char_field='2'),
+            ], ['int_field'], ['float_field', 'char_field'], returning=True, return_untouched=True,
+                update_condition=Q(float_field__lt=Excluded('float_field')))
+
+        self.assertEqual(sorted((r.int_field, r.status_) for r in results), [(1, 'n'), (2, 'u'), (3, 'c')])
+        self.assertEqual(
+            list(models.TestModel.objects.order_by('int_field').values_list('float_field', 'char_field')),
+            [(2.0, '1'), (3.0, '2'), (1.0, '2')]
+        )
+        self.assertIn(
+            'IS DISTINCT FROM (EXCLUDED."float_field", EXCLUDED."char_field") AND '
+            '("tests_testmodel"."float_field" < (EXCLUDED."float_field"))',
+            queries[0]['sql']
+        )
+
+    def test_without_ignoring_duplicates(self):
+        G(models.TestModel, int_field=1, float_field=2.0, char_field='1')
+
+        results = models.TestModel.objects.bulk_upsert2([
+            models.TestModel(int_field=1, float_field=2.0, char_field='1'),
+        ], ['int_field'], ['float_field', 'char_field'], returning=True, ignore_duplicate_updates=False,
+            update_condition=Q(float_field__lte=Excluded('float_field')) & Q(char_field='1'))
+
+        self.assertEqual([r.status_ for r in results], ['u'])
+
+    def test_condition_args(self):
+        G(models.TestModel, int_field=1, float_field=2.0, char_field='1')
+        G(models.TestModel, int_field=2, float_field=2.0, char_field='2')
+
+        models.TestModel.objects.bulk_upsert2([
+            models.TestModel(int_field=1, float_field=3.0, char_field='3'),
+            models.TestModel(int_field=2, float_field=3.0, char_field='3'),
+        ], ['int_field'], {'float_field': 'add', 'char_field': None}, update_condition=Q(char_field='2'))
+
+        self.assertEqual(
+            list(models.TestModel.objects.order_by('int_field').values_list('float_field', 'char_field')),
+            [(2.0, '1'), (5.0, '3')]
+        )
+
+    def test_raw_sql(self):
+        G(models.TestModel, int_field=1, float_field=2.0)
+
+        models.TestModel.objects.bulk_upsert2([
+            models.TestModel(int_field=1, float_field=1.0),
+        ], ['int_field'], ['float_field'], update_condition='EXCLUDED."float_field" > tests_testmodel."float_field"')
+
+        self.assertEqual(models.TestModel.objects.get().float_field, 2.0)
+
+    def test_sync_rejected_kept(self):
+        G(models.TestModel, int_field=1, float_field=2.0, char_field='1')
+        G(models.TestModel, int_field=2, float_field=2.0, char_field='1')
+
+        results = models.TestModel.objects.sync2([
+            models.TestModel(int_field=1, float_field=1.0, char_field='2'),
+        ], ['int_field'], ['float_field', 'char_field'], returning=True,
+            update_condition=Q(float_field__lt=Excluded('float_field')))
+
+        self.assertEqual(sorted(r.status_ for r in results), ['d', 'n'])
+        self.assertEqual(list(models.TestModel.objects.values_list('int_field', 'char_field')), [(1, '1')])
+
+
+class BulkUpsert2ConflictTargetTest(TestCase):
+    """
+    Tests bulk_upsert2 and sync2 with partial unique indexes and named unique constraints.
+    """
+    def setUp(self):
+        super().setUp()
+        self.deleted_obj = G(models.TestPartialUniqueModel, int_field=1, float_field=0.0, char_field=None,
+                             deleted_at=dt.datetime(2020, 1, 1))
+        self.extant_obj = G(models.TestPartialUniqueModel, int_field=1, float_field=1.0, char_field=None)
+
+    def test_partial_unique_index(self):
+        with self.assertNumQueries(1):
+            results = models.TestPartialUniqueModel.objects.bulk_upsert2([
+                models.TestPartialUniqueModel(int_field=1, float_field=2.0),
+                models.TestPartialUniqueModel(int_field=2, float_field=2.0),
+            ], ['int_field'], ['float_field'], returning=True, unique_condition=Q(deleted_at__isnull=True))
+
+        self.assertEqual(sorted((r.int_field, r.status_) for r in results), [(1, 'u'), (2, 'c')])
+        self.assertEqual(
+            list(models.TestPartialUniqueModel.objects.order_by('id').values_list('int_field', 'float_field')),
+            [(1, 0.0), (1, 2.0), (2, 2.0)]
+        )
+
+    def test_partial_unique_index_untouched(self):
+        results = models.TestPartialUniqueModel.objects.bulk_upsert2([
+            models.TestPartialUniqueModel(int_field=1, float_field=1.0),
+        ], ['int_field'], ['float_field'], returning=True, return_untouched=True,
+            unique_condition=Q(deleted_at__isnull=True))
+
+        self.assertEqual([(r.id, r.status_) for r in results], [(self.extant_obj.id, 'n')])
+
+    def test_partial_unique_index_raw_sql(self):
+        results = models.TestPartialUniqueModel.objects.bulk_upsert2([
+            models.TestPartialUniqueModel(int_field=1, float_field=3.0),
+        ], ['int_field'], ['float_field'], returning=True, return_untouched=True,
+            unique_condition='deleted_at IS NULL')
+
+        self.assertEqual([(r.id, r.float_field, r.status_) for r in results], [(self.extant_obj.id, 3.0, 'u')])
+
+    def test_partial_unique_index_required(self):
+        with self.assertRaises(Exception):
+            models.TestPartialUniqueModel.objects.bulk_upsert2([
+                models.TestPartialUniqueModel(int_field=1, float_field=2.0),
+            ], ['int_field'], ['float_field'])
+
+    def test_sync_partial_unique_index(self):
+        results = models.TestPartialUniqueModel.objects.filter(deleted_at__isnull=True).sync2([
+            models.TestPartialUniqueModel(int_field=2, float_field=2.0),
+        ], ['int_field'], ['float_field'], returning=True, unique_condition=Q(deleted_at__isnull=True))
+
+        self.assertEqual(sorted(r.status_ for r in results), ['c', 'd'])
+        self.assertEqual(
+            list(models.TestPartialUniqueModel.objects.order_by('id').values_list('id', flat=True))[0],
+            self.deleted_obj.id
+        )
+        self.assertEqual(models.TestPartialUniqueModel.objects.count(), 2)
+
+    def test_named_constraint(self):
+        self.extant_obj.char_field = 'a'
+        self.extant_obj.save()
+
+        results = models.TestPartialUniqueModel.objects.bulk_upsert2([
+            models.TestPartialUniqueModel(int_field=3, char_field='a', float_field=3.0),
+            models.TestPartialUniqueModel(int_field=4, char_field='b', float_field=4.0),
+        ], ['char_field'], ['float_field'], returning=True, return_untouched=True,
+            unique_constraint='unique_char_field')
+
+        self.assertEqual(sorted((r.char_field, r.int_field, r.status_) for r in results), [
+            ('a', 1, 'u'), ('b', 4, 'c')
+        ])
+
+    def test_invalid_combinations(self):
+        with self.assertRaises(ValueError):
+            models.TestPartialUniqueModel.objects.bulk_upsert2(
+                [], ['int_field'], unique_constraint='unique_char_field', unique_condition=Q(deleted_at__isnull=True))
+
+        with self.assertRaises(ValueError):
+            models.TestPartialUniqueModel.objects.sync2(
+                [], ['int_field'], exclude_unchanged=True, unique_condition=Q(deleted_at__isnull=True))
+
+
+class StreamSync2Test(TestCase):
+    """
+    Tests syncing a queryset from an iterable of models with stream_sync2.
+    """
+    def test_sync(self):
+        G(models.TestModel, int_field=1, char_field='1')
+        G(models.TestModel, int_field=2, char_field='1')
+        G(models.TestModel, int_field=3, char_field='1')
+
+        def generate_model_objs():
+            yield models.TestModel(int_field=1, char_field='1')
+            yield models.TestModel(int_field=2, char_field='2')
+            for i in range(4, 9):
+                yield models.TestModel(int_field=i, char_field='2')
+
+        counts = models.TestModel.objects.stream_sync2(
+            generate_model_objs(), ['int_field'], ['char_field'], chunk_size=3)
+
+        self.assertEqual(counts, {'n': 1, 'u': 1, 'c': 5, 'd': 1})
+        self.assertEqual(
+            list(models.TestModel.objects.order_by('int_field').values_list('int_field', 'char_field')),
+            [(1, '1'), (2, '2'), (4, '2'), (5, '2'), (6, '2'), (7, '2'), (8, '2')]
+        )
+
+    def test_chunks(self):
+        model_objs = (models.TestModel(int_field=i) for i in range(5))
+
+        with patch('manager_utils.manager_utils.upsert2.upsert', wraps=upsert2.upsert) as mock_upsert:
+            stream_sync2(models.TestModel, model_objs, ['int_field'], chunk_size=2)
+
+        self.assertEqual([len(call[0][1]) for call in mock_upsert.call_args_list], [2, 2, 1])
+        self.assertEqual(models.TestModel.objects.count(), 5)
+
+    def test_queryset_scope(self):
+        G(models.TestModel, int_field=1, char_field='1')
+        G(models.TestModel, int_field=2, char_field='2')
+
+        counts = models.TestModel.objects.filter(char_field='1').stream_sync2(iter([]), ['int_field'])
+
+        self.assertEqual(counts, {'d': 1})
+        self.assertEqual(list(models.TestModel.objects.values_list('int_field', flat=True)), [2])
+
+    def test_temporary_table_dropped(self):
+        stream_sync2(models.TestModel.objects.all(), [models.TestModel(int_field=1)], ['int_field'])
+
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM pg_tables WHERE tablename LIKE 'manager_utils_touched_%%'")
+            self.assertEqual(cursor.fetchone()[0], 0)
+
+    def test_char_pk(self):
+        G(models.TestPkChar, my_key='1', char_field='1')
+        G(models.TestPkChar, my_key='2', char_field='1')
+
+        counts = models.TestPkChar.objects.stream_sync2(
+            [models.TestPkChar(my_key='2', char_field='2')], ['my_key'], ['char_field'])
+
+        self.assertEqual(counts, {'u': 1, 'd': 1})
+        self.assertEqual(list(models.TestPkChar.objects.values_list('my_key', 'char_field')), [('2', '2')])
+
+    def test_not_exists_anti_join(self):
+        G(models.TestModel, int_field=1, char_field='1')
+        G(models.TestModel, int_field=2, char_field='1')
+
+        # The same row is touched by both chunks
+        with CaptureQueriesContext(connection) as queries:
+            counts = models.TestModel.objects.stream_sync2([
+                models.TestModel(int_field=1, char_field='2'),
+                models.TestModel(int_field=1, char_field='3'),
+            ], ['int_field'], ['char_field'], chunk_size=1)
+
+        self.assertEqual(counts, {'u': 2, 'd': 1})
+        self.assertEqual(list(models.TestModel.objects.values_list('int_field', 'char_field')), [(1, '3')])
+        self.assertTrue(any('ADD PRIMARY KEY' in query['sql'] for query in queries))
+        self.assertTrue(any('NOT EXISTS (SELECT 1 FROM manager_utils_touched_' in query['sql'] for query in queries))
+
+    def test_record_no_touched_pks(self):
+        with connection.cursor() as cursor, self.assertNumQueries(0):
+            _record_touched_pks(cursor, 'manager_utils_touched', [])
+
+    @patch.object(post_bulk_operation, 'send', spec_set=True)
+    def test_signal(self, mock_send):
+        models.TestModel.objects.stream_sync2([models.TestModel(int_field=1)], ['int_field'])
+        mock_send.assert_called_once_with(sender=models.TestModel, model=models.TestModel)
+
+    @patch('manager_utils.manager_utils._advisory_lock', spec_set=True)
+    def test_skip_locked(self, mock_advisory_lock):
+        mock_advisory_lock.return_value.__enter__.return_value = False
+
+        self.assertIsNone(models.TestModel.objects.stream_sync2(
+            [models.TestModel(int_field=1)], ['int_field'], lock_scope='scope', skip_locked=True))
+        self.assertFalse(models.TestModel.objects.exists())
+        mock_advisory_lock.assert_called_once_with(models.TestModel, 'scope', skip_locked=True)
+
+
+class Sync2OnMissingTest(TestCase):
+    """
+    Tests marking missing rows instead of deleting them with the on_missing argument of sync2.
+    """
+    def test_mark_missing(self):
+        kept = G(models.TestPartialUniqueModel, int_field=1, char_field='1', deleted_at=None)
+        missing = G(models.TestPartialUniqueModel, int_field=2, char_field='2', deleted_at=None)
+
+        results = models.TestPartialUniqueModel.objects.sync2(
+            [models.TestPartialUniqueModel(int_field=1, char_field='1', float_field=1.0)], ['char_field'],
+            ['float_field'], returning=True, on_missing={'deleted_at': Now()})
+
+        self.assertEqual([obj.id for obj in results.updated], [kept.id])
+        self.assertEqual([obj.id for obj in results.deleted], [missing.id])
+        self.assertIsNone(models.TestPartialUniqueModel.objects.get(id=kept.id).deleted_at)
+        self.assertIsNotNone(models.TestPartialUniqueModel.objects.get(id=missing.id).deleted_at)
+
+    def test_mark_missing_with_value(self):
+        deleted_at = dt.datetime(2020, 1, 1)
+        missing = G(models.TestPartialUniqueModel, int_field=1, char_field='1', deleted_at=None)
+
+        models.TestPartialUniqueModel.objects.sync2([], ['char_field'], on_missing={'deleted_at': deleted_at})
+
+        self.assertEqual(models.TestPartialUniqueModel.objects.get(id=missing.id).deleted_at, deleted_at)
+
+    def test_no_missing(self):
+        G(models.TestPartialUniqueModel, int_field=1, char_field='1', deleted_at=None)
+
+        results = models.TestPartialUniqueModel.objects.sync2(
+            [models.TestPartialUniqueModel(int_field=1, char_field='1')], ['char_field'], ['int_field'],
+            returning=True, on_missing={'deleted_at': Now()})
+
+        self.assertEqual(list(results.deleted), [])
+
+    def test_marked_rows_not_revived(self):
+        deleted_at = dt.datetime(2020, 1, 1)
+        marked = G(models.TestPartialUniqueModel, int_field=1, char_field='1', float_field=1.0, deleted_at=deleted_at)
+
+        models.TestPartialUniqueModel.objects.sync2(
+            [models.TestPartialUniqueModel(int_field=1, char_field='1', float_field=2.0)], ['char_field'],
+            on_missing={'deleted_at': Now()})
+
+        marked.refresh_from_db()
+        self.assertEqual(marked.float_field, 2.0)
+        self.assertEqual(marked.deleted_at, deleted_at)
+
+    def test_revive(self):
+        marked = G(
+            models.TestPartialUniqueModel, int_field=1, char_field='1', float_field=1.0,
+            deleted_at=dt.datetime(2020, 1, 1))
+
+        results = models.TestPartialUniqueModel.objects.sync2(
+            [models.TestPartialUniqueModel(int_field=1, char_field='1', float_field=1.0)], ['char_field'],
+            returning=True, on_missing={'deleted_at': Now()}, revive=True)
+
+        self.assertEqual([obj.id for obj in results.updated], [marked.id])
+        marked.refresh_from_db()
+        self.assertIsNone(marked.deleted_at)
+
+    def test_stream_sync2(self):
+        G(models.TestPartialUniqueModel, int_field=1, char_field='1', deleted_at=None)
+        missing = G(models.TestPartialUniqueModel, int_field=2, char_field='2', deleted_at=None)
+        marked = G(
+            models.TestPartialUniqueModel, int_field=3, char_field='3',
+            deleted_at=dt.datetime(2020, 1, 1))
+
+        counts = models.TestPartialUniqueModel.objects.stream_sync2(
+            iter([
+                models.TestPartialUniqueModel(int_field=1, char_field='1'),
+                models.TestPartialUniqueModel(int_field=3, char_field='3'),
+            ]),
+            ['char_field'], ['int_field'], on_missing={'deleted_at': Now()}, revive=True)
+
+        self.assertEqual(counts, {'n': 1, 'u': 1, 'd': 1})
+        self.assertEqual(models.TestPartialUniqueModel.objects.count(), 3)
+        self.assertIsNotNone(models.TestPartialUniqueModel.objects.get(id=missing.id).deleted_at)
+        self.assertIsNone(models.TestPartialUniqueModel.objects.get(id=marked.id).deleted_at)
+
+    def test_on_missing_without_sync(self):
+        with self.assertRaises(ValueError):
+            upsert2.upsert(
+                models.TestPartialUniqueModel, [], ['char_field'], on_missing={'deleted_at': Now()})
+
+    @patch('manager_utils.upsert2._mark_missing', spec_set=True)
+    def test_mark_missing_atomic(self, mock_mark_missing):
+        mock_mark_missing.side_effect = DatabaseError
+        G(models.TestPartialUniqueModel, int_field=1, char_field='1', deleted_at=None)
+
+        with self.assertRaises(DatabaseError):
+            models.TestPartialUniqueModel.objects.sync2([
+                models.TestPartialUniqueModel(int_field=2, char_field='2'),
+            ], ['char_field'], on_missing={'deleted_at': Now()})
+
+        # The upsert is rolled back with the failed mark phase
+        self.assertEqual(list(models.TestPartialUniqueModel.objects.values_list('char_field', flat=True)), ['1'])
+
+    def test_mark_no_pks(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(upsert2._mark_missing(models.TestPartialUniqueModel, [], {'deleted_at': Now()}), [])
+
+
+class DryRunTest(TestCase):
+    """
+    Tests computing what bulk_upsert2 and sync2 would do with dry_run.
+    """
+    def setUp(self):
+        super().setUp()
+        G(models.TestModel, int_field=1, char_field='1', float_field=1.0)
+        G(models.TestModel, int_field=2, char_field='1', float_field=1.0)
+        G(models.TestModel, int_field=3, char_field='1', float_field=1.0)
+        self.model_objs = [
+            models.TestModel(int_field=1, char_field='1', float_field=1.0),
+            models.TestModel(int_field=2, char_field='2', float_field=1.0),
+            models.TestModel(int_field=4, char_field='2', float_field=1.0),
+        ]
+
+    def assert_unchanged(self):
+        self.assertEqual(
+            list(models.TestModel.objects.order_by('int_field').values_list('int_field', 'char_field')),
+            [(1, '1'), (2, '1'), (3, '1')]
+        )
+
+    def test_bulk_upsert2_counts(self):
+        with self.assertNumQueries(1):
+            counts = models.TestModel.objects.bulk_upsert2(
+                self.model_objs, ['int_field'], ['char_field', 'float_field'], dry_run=True)
+
+        self.assertEqual(counts, {'c': 1, 'u': 1, 'n': 1})
+        self.assert_unchanged()
+
+    def test_bulk_upsert2_keys(self):
+        results = models.TestModel.objects.bulk_upsert2(
+            self.model_objs, ['int_field'], ['char_field'], returning=True, dry_run=True)
+
+        self.assertEqual([r.int_field for r in results.created], [4])
+        self.assertEqual([r.int_field for r in results.updated], [2])
+        self.assertEqual([r.int_field for r in results.untouched], [1])
+        self.assert_unchanged()
+
+    def test_no_update_fields(self):
+        counts = models.TestModel.objects.bulk_upsert2(self.model_objs, ['int_field'], [], dry_run=True)
+        self.assertEqual(counts, {'c': 1, 'n': 2})
+
+    def test_duplicate_updates(self):
+        counts = models.TestModel.objects.bulk_upsert2(
+            self.model_objs, ['int_field'], ['char_field'], ignore_duplicate_updates=False, dry_run=True)
+        self.assertEqual(counts, {'c': 1, 'u': 2})
+
+    def test_update_condition(self):
+        counts = models.TestModel.objects.bulk_upsert2(
+            self.model_objs, ['int_field'], ['char_field'], ignore_duplicate_updates=False,
+            update_condition=Q(int_field__gt=1), dry_run=True)
+        self.assertEqual(counts, {'c': 1, 'u': 1, 'n': 1})
+
+    def test_merge(self):
+        counts = models.TestModel.objects.bulk_upsert2(
+            self.model_objs, ['int_field'], {'float_field': 'greatest'}, dry_run=True)
+        self.assertEqual(counts, {'c': 1, 'n': 2})
+
+    def test_hash_field(self):
+        models.TestHashModel.objects.bulk_upsert2(
+            [models.TestHashModel(int_field=1, char_field='1')], ['int_field'], hash_field='content_hash')
+
+        counts = models.TestHashModel.objects.bulk_upsert2([
+            models.TestHashModel(int_field=1, char_field='1'),
+            models.TestHashModel(int_field=2, char_field='2'),
+        ], ['int_field'], hash_field='content_hash', dry_run=True)
+
+        self.assertEqual(counts, {'c': 1, 'n': 1})
+
+    def test_unique_condition(self):
+        G(models.TestPartialUniqueModel, int_field=1, char_field='1', deleted_at=dt.datetime(2020, 1, 1))
+        G(models.TestPartialUniqueModel, int_field=2, char_field='2', float_field=1.0, deleted_at=None)
+
+        counts = models.TestPartialUniqueModel.objects.bulk_upsert2([
+            models.TestPartialUniqueModel(int_field=1, char_field='3'),
+            models.TestPartialUniqueModel(int_field=2, char_field='2', float_field=2.0),
+        ], ['int_field'], ['float_field'], unique_condition=Q(deleted_at__isnull=True), dry_run=True)
+
+        self.assertEqual(counts, {'c': 1, 'u': 1})
+
+    def test_sync2(self):
+        with self.assertNumQueries(1):
+            results = models.TestModel.objects.sync2(
+                self.model_objs, ['int_field'], ['char_field'], returning=True, dry_run=True)
+
+        self.assertEqual(Counter(r.status_ for r in results), {'c': 1, 'u': 1, 'n': 1, 'd': 1})
+        self.assertEqual([r.int_field for r in results.deleted], [3])
+        self.assert_unchanged()
+
+    def test_sync2_matches_sync(self):
+        counts = models.TestModel.objects.filter(int_field__gt=1).sync2(
+            self.model_objs, ['int_field'], ['char_field'], dry_run=True)
+        results = models.TestModel.objects.filter(int_field__gt=1).sync2(
+            self.model_objs, ['int_field'], ['char_field'], returning=True)
+
+        self.assertEqual(counts, Counter(r.status_ for r in results))
+
+    def test_sync2_empty(self):
+        counts = models.TestModel.objects.sync2([], ['int_field'], dry_run=True)
+
+        self.assertEqual(counts, {'d': 3})
+        self.assertEqual(models.TestModel.objects.count(), 3)
+
+    def test_sync2_empty_queryset(self):
+        counts = models.TestModel.objects.none().sync2(self.model_objs, ['int_field'], ['char_field'], dry_run=True)
+        self.assertEqual(counts, {'c': 1, 'u': 1, 'n': 1})
+
+    @patch.object(post_bulk_operation, 'send', spec_set=True)
+    def test_no_signal(self, mock_send):
+        models.TestModel.objects.bulk_upsert2(self.model_objs, ['int_field'], dry_run=True)
+        models.TestModel.objects.sync2(self.model_objs, ['int_field'], dry_run=True, lock_scope='scope')
+        self.assertFalse(mock_send.called)
+
+    def test_return_models(self):
+        with self.assertRaises(ValueError):
+            upsert2.upsert(models.TestModel, self.model_objs, ['int_field'], return_models=True, dry_run=True)
+
+
+class SyncPartitionedTest(TestCase):
+    """
+    Tests syncing many partitions of a queryset with sync_partitioned.
+    """
+    def setUp(self):
+        super().setUp()
+        G(models.TestModel, int_field=1, char_field='a', float_field=1.0)
+        G(models.TestModel, int_field=2, char_field='a', float_field=1.0)
+        G(models.TestModel, int_field=3, char_field='b', float_field=1.0)
+        G(models.TestModel, int_field=4, char_field='c', float_field=1.0)
+
+    def get_rows(self):
+        return list(
+            models.TestModel.objects.order_by('int_field').values_list('int_field', 'char_field', 'float_field')
+        )
+
+    def test_sync(self):
+        deleted_ids = sorted(models.TestModel.objects.filter(int_field__in=[2, 3]).values_list('id', flat=True))
+
+        results = models.TestModel.objects.sync_partitioned([
+            models.TestModel(int_field=1, char_field='a', float_field=2.0),
+            models.TestModel(int_field=5, char_field='b', float_field=1.0),
+        ], ['int_field'], 'char_field', ['float_field'], returning=True)
+
+        self.assertEqual([r.int_field for r in results.updated], [1])
+        self.assertEqual([r.int_field for r in results.created], [5])
+        self.assertEqual(sorted(r.id for r in results.deleted), deleted_ids)
+        self.assertEqual(self.get_rows(), [(1, 'a', 2.0), (4, 'c', 1.0), (5, 'b', 1.0)])
+
+    def test_untouched_not_deleted(self):
+        results = sync_partitioned(models.TestModel, [
+            models.TestModel(int_field=3, char_field='b', float_field=1.0),
+        ], ['int_field'], 'char_field', ['float_field'])
+
+        self.assertEqual([r.status_ for r in results], ['n'])
+        self.assertEqual(len(self.get_rows()), 4)
+
+    def test_queryset_scope(self):
+        models.TestModel.objects.filter(int_field__gt=1).sync_partitioned([
+            models.TestModel(int_field=3, char_field='b'),
+            models.TestModel(int_field=4, char_field='a'),
+        ], ['int_field'], 'char_field', [])
+
+        # Row 1 is outside of the queryset and row 4 moved partitions
+        self.assertEqual([row[:2] for row in self.get_rows()], [(1, 'a'), (3, 'b'), (4, 'c')])
+
+    def test_null_partition(self):
+        G(models.TestModel, int_field=5, char_field=None)
+        G(models.TestModel, int_field=6, char_field=None)
+
+        models.TestModel.objects.sync_partitioned(
+            [models.TestModel(int_field=5, char_field=None)], ['int_field'], 'char_field')
+
+        self.assertEqual([row[0] for row in self.get_rows()], [1, 2, 3, 4, 5])
+
+    def test_char_pk(self):
+        G(models.TestPkChar, my_key='1', char_field='a')
+        G(models.TestPkChar, my_key='2', char_field='a')
+
+        results = models.TestPkChar.objects.sync_partitioned(
+            [models.TestPkChar(my_key='1', char_field='a')], ['my_key'], 'char_field', ['char_field'])
+
+        self.assertEqual([r.my_key for r in results.deleted], ['2'])
+        self.assertEqual(list(models.TestPkChar.objects.values_list('my_key', flat=True)), ['1'])
+
+    def test_single_delete_statement(self):
+        parent = G(models.TestModel, int_field=5)
+        other_parent = G(models.TestModel, int_field=6)
+        G(models.TestChildModel, test_model=parent, int_field=1)
+        deleted = G(models.TestChildModel, test_model=parent, int_field=2)
+        G(models.TestChildModel, test_model=other_parent, int_field=1)
+
+        with CaptureQueriesContext(connection) as queries:
+            results = models.TestChildModel.objects.sync_partitioned(
+                [models.TestChildModel(test_model=parent, int_field=1)], ['test_model', 'int_field'], 'test_model')
+
+        # The missing rows are found and deleted with one anti-join
+        delete_queries = [query['sql'] for query in queries if 'tests_testchildmodel' in query['sql']][1:]
+        self.assertEqual(len(delete_queries), 1)
+        self.assertTrue(delete_queries[0].startswith('DELETE'))
+        self.assertIn('NOT EXISTS (SELECT 1 FROM unnest(', delete_queries[0])
+        self.assertEqual([r.id for r in results.deleted], [deleted.id])
+        self.assertEqual(models.TestChildModel.objects.count(), 2)
+
+    def test_empty_without_cascades(self):
+        G(models.TestPkChar, my_key='1', char_field='a')
+
+        results = models.TestPkChar.objects.sync_partitioned([], ['my_key'], 'char_field')
+
+        self.assertEqual(list(results), [])
+        self.assertEqual(models.TestPkChar.objects.count(), 1)
+
+    def test_empty(self):
+        results = models.TestModel.objects.sync_partitioned([], ['int_field'], 'char_field')
+
+        self.assertEqual(list(results), [])
+        self.assertEqual(len(self.get_rows()), 4)
+
+    @patch.object(post_bulk_operation, 'send', spec_set=True)
+    def test_signal(self, mock_send):
+        models.TestModel.objects.sync_partitioned([models.TestModel(int_field=1)], ['int_field'], 'char_field')
+        mock_send.assert_called_once_with(sender=models.TestModel, model=models.TestModel)
+
+    def test_retry(self):
+        with patch('manager_utils.manager_utils.upsert2.upsert', spec_set=True) as mock_upsert:
+            mock_upsert.side_effect = [_get_db_error(OperationalError, '40P01'), upsert2.UpsertResult()]
+            with patch('manager_utils.manager_utils.time.sleep', spec_set=True):
+                results = models.TestModel.objects.sync_partitioned(
+                    [], ['int_field'], 'char_field', retry_policy=RetryPolicy(max_attempts=2))
+
+        self.assertEqual(results.retries, 1)
+
+
+class UpsertGraphTest(TestCase):
+    """
+    Tests upserting parents and children with upsert_graph.
+    """
+    def get_graph(self, num_parents):
+        parents = [models.TestModel(int_field=i, char_field=str(i)) for i in range(num_parents)]
+        children = [
+            models.TestChildModel(test_model=parent, int_field=j, char_field=str(j))
+            for parent in parents for j in range(2)
+        ]
+        return parents, children
+
+    def get_children(self):
+        return list(models.TestChildModel.objects.order_by('test_model__int_field', 'int_field').values_list(
+            'test_model__int_field', 'int_field', 'char_field'
+        ))
+
+    def test_upsert(self):
+        existing = G(models.TestModel, int_field=0, char_field='old')
+        G(models.TestChildModel, test_model=existing, int_field=0, char_field='old')
+        parents, children = self.get_graph(2)
+
+        results, child_results = models.TestModel.objects.upsert_graph(
+            parents, ['int_field'], models.TestChildModel, children, ['test_model', 'int_field'])
+
+        self.assertEqual([r.int_field for r in results.updated], [0])
+        self.assertEqual([r.int_field for r in results.created], [1])
+        self.assertEqual(len(list(child_results.updated)), 1)
+        self.assertEqual(len(list(child_results.created)), 3)
+        self.assertEqual(self.get_children(), [(0, 0, '0'), (0, 1, '1'), (1, 0, '0'), (1, 1, '1')])
+        self.assertEqual(children[0].test_model_id, existing.id)
+
+    def test_bounded_statements(self):
+        parents, children = self.get_graph(2)
+        with CaptureQueriesContext(connection) as small_graph:
+            upsert_graph(models.TestModel, parents, ['int_field'], models.TestChildModel, children,
+                         ['test_model', 'int_field'], sync=True)
+
+        parents, children = self.get_graph(20)
+        with CaptureQueriesContext(connection) as large_graph:
+            upsert_graph(models.TestModel, parents, ['int_field'], models.TestChildModel, children,
+                         ['test_model', 'int_field'], sync=True)
+
+        self.assertEqual(len(small_graph), len(large_graph))
+        self.assertEqual(models.TestChildModel.objects.count(), 40)
+
+    def test_sync(self):
+        kept, synced = G(models.TestModel, int_field=9), G(models.TestModel, int_field=0)
+        G(models.TestChildModel, test_model=kept, int_field=5)
+        G(models.TestChildModel, test_model=synced, int_field=5)
+        parents, children = self.get_graph(2)
+
+        results, child_results = models.TestModel.objects.filter(int_field__lt=9).upsert_graph(
+            parents, ['int_field'], models.TestChildModel, children, ['test_model', 'int_field'], sync=True)
+
+        self.assertEqual(len(list(child_results.deleted)), 1)
+        self.assertEqual(self.get_children(), [
+            (0, 0, '0'), (0, 1, '1'), (1, 0, '0'), (1, 1, '1'), (9, 5, None)
+        ])
+
+    def test_sync_deletes_parents(self):
+        G(models.TestChildModel, test_model=G(models.TestModel, int_field=9), int_field=5)
+        parents, children = self.get_graph(1)
+
+        results, child_results = models.TestModel.objects.upsert_graph(
+            parents, ['int_field'], models.TestChildModel, children, ['test_model', 'int_field'], sync=True)
+
+        self.assertEqual(len(list(results.deleted)), 1)
+        self.assertEqual(self.get_children(), [(0, 0, '0'), (0, 1, '1')])
+
+    def test_sync_parent_without_children(self):
+        parent = G(models.TestModel, int_field=0)
+        G(models.TestChildModel, test_model=parent, int_field=5)
+
+        models.TestModel.objects.upsert_graph(
+            [models.TestModel(int_field=0)], ['int_field'], models.TestChildModel, [],
+            ['test_model', 'int_field'], sync=True)
+
+        self.assertEqual(self.get_children(), [])
+
+    def test_saved_parent(self):
+        parent = G(models.TestModel, int_field=9)
+
+        models.TestModel.objects.upsert_graph(
+            [], ['int_field'], models.TestChildModel, [models.TestChildModel(test_model_id=parent.id, int_field=1)],
+            ['test_model', 'int_field'])
+
+        self.assertEqual(self.get_children(), [(9, 1, None)])
+
+    def test_saved_parent_instance(self):
+        saved_parent = G(models.TestModel, int_field=9)
+        parents, children = self.get_graph(1)
+
+        models.TestModel.objects.upsert_graph(
+            parents, ['int_field'], models.TestChildModel,
+            children + [models.TestChildModel(test_model=saved_parent, int_field=1)], ['test_model', 'int_field'])
+
+        self.assertEqual(self.get_children(), [(0, 0, '0'), (0, 1, '1'), (9, 1, None)])
+
+    def test_missing_parent(self):
+        child = models.TestChildModel(test_model=models.TestModel(int_field=1), int_field=1)
+
+        with self.assertRaises(ValueError):
+            models.TestModel.objects.upsert_graph(
+                [models.TestModel(int_field=2)], ['int_field'], models.TestChildModel, [child],
+                ['test_model', 'int_field'])
+        self.assertFalse(models.TestModel.objects.exists())
+
+    def test_fk_field(self):
+        parents, children = self.get_graph(1)
+
+        models.TestModel.objects.upsert_graph(
+            parents, ['int_field'], models.TestChildModel, children, ['test_model', 'int_field'],
+            fk_field='test_model')
+
+        self.assertEqual(models.TestChildModel.objects.count(), 2)
+
+    def test_no_fk(self):
+        with self.assertRaises(ValueError):
+            models.TestModel.objects.upsert_graph([], ['int_field'], models.TestPkChar, [], ['my_key'])
+
+    @patch.object(post_bulk_operation, 'send', spec_set=True)
+    def test_signal(self, mock_send):
+        models.TestModel.objects.upsert_graph([], ['int_field'], models.TestChildModel, [], ['test_model', 'int_field'])
+
+        self.assertEqual(mock_send.call_args_list, [
+            call(sender=models.TestModel, model=models.TestModel),
+            call(sender=models.TestChildModel, model=models.TestChildModel),
+        ])
+
+    def test_retry(self):
+        with patch('manager_utils.manager_utils.upsert2.upsert', spec_set=True) as mock_upsert:
+            mock_upsert.side_effect = [
+                _get_db_error(OperationalError, '40P01'), upsert2.UpsertResult(), upsert2.UpsertResult()
+            ]
+            with patch('manager_utils.manager_utils.time.sleep', spec_set=True):
+                results, child_results = models.TestModel.objects.upsert_graph(
+                    [], ['int_field'], models.TestChildModel, [], ['test_model', 'int_field'],
+                    retry_policy=RetryPolicy(max_attempts=2))
+
+        self.assertEqual((results.retries, child_results.retries), (1, 1))
+
+
+class NaturalKeyTest(TestCase):
+    """
+    Tests resolving foreign keys from the natural keys of their parents in bulk_upsert2 and sync2.
+    """
+    def setUp(self):
+        super().setUp()
+        self.parent1 = G(models.TestModel, int_field=1, char_field='a')
+        self.parent2 = G(models.TestModel, int_field=2, char_field='b')
+
+    def get_children(self):
+        return list(models.TestChildModel.objects.order_by('int_field').values_list(
+            'int_field', 'test_model_id', 'char_field'
+        ))
+
+    def test_bulk_upsert2(self):
+        models.TestChildModel.objects.bulk_upsert2([
+            models.TestChildModel(int_field=1, test_model=models.TestModel(int_field=1)),
+            models.TestChildModel(int_field=2, test_model=models.TestModel(int_field=2)),
+        ], ['test_model', 'int_field'], natural_keys={'test_model': 'int_field'})
+
+        self.assertEqual(self.get_children(), [(1, self.parent1.id, None), (2, self.parent2.id, None)])
+
+    def test_single_statement(self):
+        with CaptureQueriesContext(connection) as captured:
+            models.TestChildModel.objects.bulk_upsert2(
+                [models.TestChildModel(int_field=1, test_model=models.TestModel(int_field=1))],
+                ['test_model', 'int_field'], natural_keys={'test_model': 'int_field'}, on_unresolved='skip')
+
+        self.assertEqual(len(captured), 1)
+        self.assertIn('JOIN "tests_testmodel" AS p0 ON p0."int_field" = r."nk_0_0"', captured[0]['sql'])
+
+    def test_returning_untouched(self):
+        G(models.TestChildModel, int_field=1, test_model=self.parent1, char_field='1')
+        G(models.TestChildModel, int_field=2, test_model=self.parent2, char_field='2')
+
+        results = models.TestChildModel.objects.bulk_upsert2([
+            models.TestChildModel(int_field=1, char_field='1', test_model=models.TestModel(int_field=1)),
+            models.TestChildModel(int_field=2, char_field='3', test_model=models.TestModel(int_field=2)),
+        ], ['test_model', 'int_field'], ['char_field'], returning=True, return_untouched=True,
+            natural_keys={'test_model': 'int_field'})
+
+        self.assertEqual([r.int_field for r in results.untouched], [1])
+        self.assertEqual([(r.int_field, r.test_model_id) for r in results.updated], [(2, self.parent2.id)])
+
+    def test_composite_natural_key(self):
+        models.TestChildModel.objects.bulk_upsert2([
+            models.TestChildModel(int_field=1, test_model=models.TestModel(int_field=2, char_field='b')),
+        ], ['test_model', 'int_field'], natural_keys={'test_model': ['int_field', 'char_field']})
+
+        self.assertEqual(self.get_children(), [(1, self.parent2.id, None)])
+
+    def test_error(self):
+        with self.assertRaisesRegex(ValueError, r'Unresolved natural keys \[\(3,\)\]'):
+            models.TestChildModel.objects.bulk_upsert2([
+                models.TestChildModel(int_field=1, test_model=models.TestModel(int_field=1)),
+                models.TestChildModel(int_field=2, test_model=models.TestModel(int_field=3)),
+            ], ['test_model', 'int_field'], natural_keys={'test_model': 'int_field'})
+
+        self.assertEqual(self.get_children(), [])
+
+    def test_no_parent(self):
+        # Models without a parent keep their null foreign key, which the test model doesn't allow
+        with self.assertRaisesRegex(IntegrityError, 'test_model_id'):
+            models.TestChildModel.objects.bulk_upsert2(
+                [models.TestChildModel(int_field=1)], ['test_model', 'int_field'],
+                natural_keys={'test_model': 'int_field'})
+
+    def test_direct_ids(self):
+        models.TestChildModel.objects.bulk_upsert2([
+            models.TestChildModel(int_field=1, test_model=models.TestModel(int_field=2)),
+            models.TestChildModel(int_field=2, test_model_id=self.parent1.id),
+            models.TestChildModel(int_field=3, test_model=self.parent2),
+        ], ['test_model', 'int_field'], natural_keys={'test_model': 'int_field'})
+
+        self.assertEqual(
+            self.get_children(), [(1, self.parent2.id, None), (2, self.parent1.id, None), (3, self.parent2.id, None)]
+        )
+
+    def test_direct_ids_skip(self):
+        results = models.TestChildModel.objects.bulk_upsert2([
+            models.TestChildModel(int_field=1, test_model=models.TestModel(int_field=3)),
+            models.TestChildModel(int_field=2, test_model_id=self.parent1.id),
+        ], ['test_model', 'int_field'], returning=True, natural_keys={'test_model': 'int_field'},
+            on_unresolved='skip')
+
+        self.assertEqual([r.int_field for r in results.created], [2])
+        self.assertEqual(self.get_children(), [(2, self.parent1.id, None)])
+
+    def test_skip(self):
+        results = models.TestChildModel.objects.bulk_upsert2([
+            models.TestChildModel(int_field=1, test_model=models.TestModel(int_field=1)),
+            models.TestChildModel(int_field=2, test_model=models.TestModel(int_field=3)),
+        ], ['test_model', 'int_field'], returning=True, natural_keys={'test_model': 'int_field'},
+            on_unresolved='skip')
+
+        self.assertEqual([r.int_field for r in results.created], [1])
+        self.assertEqual(self.get_children(), [(1, self.parent1.id, None)])
+
+    def test_null(self):
+        # The foreign key of the test model is not nullable, so the null foreign key fails the upsert
+        with self.assertRaisesRegex(IntegrityError, 'test_model_id'):
+            models.TestChildModel.objects.bulk_upsert2(
+                [models.TestChildModel(int_field=1, test_model=models.TestModel(int_field=3))],
+                ['test_model', 'int_field'], natural_keys={'test_model': 'int_field'}, on_unresolved='null')
+
+    def test_sync2(self):
+        G(models.TestChildModel, int_field=1, test_model=self.parent1)
+        G(models.TestChildModel, int_field=2, test_model=self.parent1)
+
+        results = models.TestChildModel.objects.sync2([
+            models.TestChildModel(int_field=1, char_field='1', test_model=models.TestModel(int_field=1)),
+            models.TestChildModel(int_field=3, test_model=models.TestModel(int_field=2)),
+        ], ['test_model', 'int_field'], ['char_field'], natural_keys={'test_model': 'int_field'})
+
+        self.assertEqual(len(list(results.deleted)), 1)
+        self.assertEqual(self.get_children(), [(1, self.parent1.id, '1'), (3, self.parent2.id, None)])
+
+    def test_invalid_on_unresolved(self):
+        with self.assertRaises(ValueError):
+            models.TestChildModel.objects.bulk_upsert2(
+                [], ['test_model', 'int_field'], natural_keys={'test_model': 'int_field'}, on_unresolved='ignore')
+
+    def test_dry_run(self):
+        with self.assertRaises(ValueError):
+            models.TestChildModel.objects.sync2(
+                [], ['test_model', 'int_field'], natural_keys={'test_model': 'int_field'}, dry_run=True)
+
+
+class SyncM2MTest(TestCase):
+    """
+    Tests syncing many to many relations with sync_m2m.
+    """
+    def setUp(self):
+        super().setUp()
+        self.parents = [G(models.TestM2MModel) for i in range(3)]
+        self.members = [G(models.TestModel, int_field=i) for i in range(4)]
+
+    def get_members(self, parent):
+        return sorted(parent.test_models.values_list('id', flat=True))
+
+    def test_sync(self):
+        parent1, parent2, parent3 = self.parents
+        member1, member2, member3, member4 = [member.id for member in self.members]
+        parent1.test_models.set([member1, member2])
+        parent2.test_models.set([member1])
+        parent3.test_models.set([member4])
+
+        with CaptureQueriesContext(connection) as captured:
+            results = sync_m2m(models.TestM2MModel.test_models, {
+                parent1.id: [member2, member3],
+                parent2.id: [],
+            })
+
+        self.assertEqual(
+            [query['sql'].split()[0] for query in captured if 'SAVEPOINT' not in query['sql']], ['INSERT', 'DELETE'])
+
+        self.assertEqual(
+            [(r.testm2mmodel_id, r.testmodel_id) for r in results.created], [(parent1.id, member3)])
+        self.assertEqual(
+            sorted((r.testm2mmodel_id, r.testmodel_id) for r in results.deleted),
+            [(parent1.id, member1), (parent2.id, member1)]
+        )
+        self.assertEqual(self.get_members(parent1), [member2, member3])
+        self.assertEqual(self.get_members(parent2), [])
+        self.assertEqual(self.get_members(parent3), [member4])
+
+    def test_reverse(self):
+        member = self.members[0]
+        member.testm2mmodel_set.set([self.parents[0].id])
+
+        sync_m2m(models.TestModel.testm2mmodel_set, {member.id: [self.parents[1].id, self.parents[2].id]})
+
+        self.assertEqual(
+            sorted(member.testm2mmodel_set.values_list('id', flat=True)),
+            [self.parents[1].id, self.parents[2].id]
+        )
+
+    def test_empty(self):
+        self.parents[0].test_models.set([self.members[0].id])
+
+        results = sync_m2m(models.TestM2MModel.test_models, {})
+
+        self.assertEqual(list(results), [])
+        self.assertEqual(self.get_members(self.parents[0]), [self.members[0].id])
+
+    @patch.object(post_bulk_operation, 'send', spec_set=True)
+    def test_signal(self, mock_send):
+        parent = self.parents[0]
+        parent.test_models.set([self.members[0].id])
+
+        sync_m2m(models.TestM2MModel.test_models, {parent.id: [self.members[1].id, self.members[2].id]})
+
+        mock_send.assert_called_once_with(
+            sender=models.TestM2MModel.test_models.through, model=models.TestM2MModel.test_models.through,
+            added={parent.id: {self.members[1].id, self.members[2].id}}, removed={parent.id: {self.members[0].id}}
+        )
+
+
+class RetryPolicyTest(TestCase):
+    """
+    Tests retrying bulk writes with a retry policy.
+    """
+    def setUp(self):
+        super(RetryPolicyTest, self).setUp()
+        patcher = patch('manager_utils.manager_utils.time.sleep')
+        self.mock_sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def fail_then_upsert(self, *errors):
+        errors = list(errors)
+        upsert = upsert2.upsert
+
+        def side_effect(*args, **kwargs):
+            if errors:
+                raise errors.pop(0)
+            return upsert(*args, **kwargs)
+
+        return patch('manager_utils.manager_utils.upsert2.upsert', side_effect=side_effect)
+
+    def test_bulk_upsert2_retried_after_deadlock(self):
+        with self.fail_then_upsert(_get_db_error(OperationalError, '40P01')):
+            results = models.TestModel.objects.bulk_upsert2(
+                [models.TestModel(int_field=1)], ['int_field'], returning=True, retry_policy=RetryPolicy())
+
+        self.assertEqual(results.retries, 1)
+        self.assertEqual(len(list(results.created)), 1)
+        self.assertEqual(models.TestModel.objects.count(), 1)
+        self.assertEqual(self.mock_sleep.call_count, 1)
+
+    def test_sync2_retried_after_serialization_failure(self):
+        G(models.TestModel, int_field=2)
+        errors = [_get_db_error(OperationalError, '40001', 'sqlstate')] * 2
+        with self.fail_then_upsert(*errors):
+            results = models.TestModel.objects.sync2(
+                [models.TestModel(int_field=1)], ['int_field'], returning=True, retry_policy=RetryPolicy())
+
+        self.assertEqual(results.retries, 2)
+        self.assertEqual(len(list(results.deleted)), 1)
+        self.assertEqual(list(models.TestModel.objects.values_list('int_field', flat=True)), [1])
+
+    def test_no_retry_policy(self):
+        with self.fail_then_upsert(_get_db_error(OperationalError, '40P01')):
+            with self.assertRaises(OperationalError):
+                models.TestModel.objects.bulk_upsert2([models.TestModel(int_field=1)], ['int_field'])
+
+        results = models.TestModel.objects.bulk_upsert2([models.TestModel(int_field=1)], ['int_field'])
+        self.assertEqual(results.retries, 0)
+
+    def test_max_attempts_exceeded(self):
+        errors = [_get_db_error(OperationalError, '40P01')] * 3
+        with self.fail_then_upsert(*errors):
+            with self.assertRaises(OperationalError):
+                models.TestModel.objects.sync2(
+                    [models.TestModel(int_field=1)], ['int_field'], retry_policy=RetryPolicy(max_attempts=3))
+
+        self.assertEqual(self.mock_sleep.call_count, 2)
+
+    def test_error_not_retryable(self):
+        with self.fail_then_upsert(_get_db_error(IntegrityError, '23505')):
+            with self.assertRaises(IntegrityError):
+                models.TestModel.objects.bulk_upsert2(
+                    [models.TestModel(int_field=1)], ['int_field'], retry_policy=RetryPolicy())
+
+        self.assertFalse(self.mock_sleep.called)
+
+    def test_bulk_update_retried_after_deadlock(self):
+        test_obj = G(models.TestModel, int_field=1, float_field=1.0)
+        test_obj.float_field = 2.0
+        errors = [_get_db_error(OperationalError, '40P01')]
+        execute = CursorWrapper.execute
+
+        def side_effect(cursor, sql, params=None):
+            if sql.startswith('UPDATE') and errors:
+                raise errors.pop(0)
+            return execute(cursor, sql, params)
+
+        with patch.object(CursorWrapper, 'execute', autospec=True, side_effect=side_effect):
+            models.TestModel.objects.bulk_update([test_obj], ['float_field'], retry_policy=RetryPolicy())
+
+        self.assertEqual(models.TestModel.objects.get(id=test_obj.id).float_field, 2.0)
+        self.assertEqual(self.mock_sleep.call_count, 1)
+
+    def test_get_backoff(self):
+        retry_policy = RetryPolicy(backoff=1, max_backoff=3)
+        for retry in range(1, 10):
+            self.assertTrue(0 <= retry_policy.get_backoff(retry) <= min(3, 2 ** (retry - 1)))
+
+
+class PostBulkOperationSignalTest(TestCase):
+    """
+    Tests that the post_bulk_operation signal is emitted on all functions that emit the signal.
+    """
+    def setUp(self):
+        """
+        Defines a siangl handler that collects information about fired signals
+        """
+        class SignalHandler(object):
+            num_times_called = 0
+            model = None
+
+            def __call__(self, *args, **kwargs):
+                self.num_times_called += 1
+                self.model = kwargs['model']
+
+        self.signal_handler = SignalHandler()
+        post_bulk_operation.connect(self.signal_handler)
+
+    def tearDown(self):
+        """
+        Disconnect the siangl to make sure it doesn't get connected multiple times.
+        """
+        post_bulk_operation.disconnect(self.signal_handler)
+
+    def test_custom_field_bulk_update(self):
+        model_obj = models.TestModel.objects.create(int_field=2)
+        model_obj.time_zone = timezone('US/Eastern')
+        models.TestModel.objects.bulk_update([model_obj], ['time_zone'])
+        model_obj = models.TestModel.objects.get(id=model_obj.id)
+        self.assertEqual(model_obj.time_zone, timezone('US/Eastern'))
+
+    def test_post_bulk_operation_queryset_update(self):
+        """
+        Tests that the update operation on a queryset emits the post_bulk_operation signal.
+        """
+        models.TestModel.objects.all().update(int_field=1)
+
+        self.assertEqual(self.signal_handler.model, models.TestModel)
+        self.assertEqual(self.signal_handler.num_times_called, 1)
+
+    def test_post_bulk_operation_manager_update(self):
+        """
+        Tests that the update operation on a manager emits the post_bulk_operation signal.
+        """
+        models.TestModel.objects.update(int_field=1)
+
+        self.assertEqual(self.signal_handler.model, models.TestModel)
+        self.assertEqual(self.signal_handler.num_times_called, 1)
+
+    def test_post_bulk_operation_bulk_update(self):
+        """
+        Tests that the bulk_update operation emits the post_bulk_operation signal.
+        """
+        model_obj = models.TestModel.objects.create(int_field=2)
+        models.TestModel.objects.bulk_update([model_obj], ['int_field'])
+
+        self.assertEqual(self.signal_handler.model, models.TestModel)
+        self.assertEqual(self.signal_handler.num_times_called, 1)
+
+    def test_post_bulk_operation_bulk_upsert2(self):
+        """
+        Tests that the bulk_upsert2 operation emits the post_bulk_operation signal.
+        """
+        model_obj = models.TestModel.objects.create(int_field=2)
+        models.TestModel.objects.bulk_upsert2([model_obj], ['int_field'])
+
+        self.assertEqual(self.signal_handler.model, models.TestModel)
+        self.assertEqual(self.signal_handler.num_times_called, 1)
+
+    def test_post_bulk_operation_bulk_create(self):
+        """
+        Tests that the bulk_create operation emits the post_bulk_operation signal.
+        """
+        models.TestModel.objects.bulk_create([models.TestModel(int_field=2)])
+
+        self.assertEqual(self.signal_handler.model, models.TestModel)
+        self.assertEqual(self.signal_handler.num_times_called, 1)
+
+    def test_post_bulk_operation_bulk_create_queryset(self):
+        """
+        Tests that the bulk_create operation emits the post_bulk_operation signal.
+        """
+        models.TestModel.objects.all().bulk_create([models.TestModel(int_field=2)])
+
+        self.assertEqual(self.signal_handler.model, models.TestModel)
+        self.assertEqual(self.signal_handler.num_times_called, 1)
+
+    def test_save_doesnt_emit_signal(self):
+        """
+        Tests that a non-bulk operation doesn't emit the signal.
+        """
+        model_obj = models.TestModel.objects.create(int_field=2)
+        model_obj.save()
+
+        self.assertEqual(self.signal_handler.num_times_called, 0)
+
+
+class IdDictTest(TestCase):
+    """
+    Tests the id_dict function.
+    """
+    def test_no_objects_manager(self):
+        """
+        Tests the output when no objects are present in the manager.
+        """
+        self.assertEqual(models.TestModel.objects.id_dict(), {})
+
+    def test_objects_manager(self):
+        """
+        Tests retrieving a dict of objects keyed on their ID from the manager.
+        """
+        model_obj1 = G(models.TestModel, int_field=1)
+        model_obj2 = G(models.TestModel, int_field=2)
+        self.assertEqual(models.TestModel.objects.id_dict(), {model_obj1.id: model_obj1, model_obj2.id: model_obj2})
+
+    def test_no_objects_queryset(self):
+        """
+        Tests the case when no objects are returned via a queryset.
+        """
+        G(models.TestModel, int_field=1)
+        G(models.TestModel, int_field=2)
+        self.assertEqual(models.TestModel.objects.filter(int_field__gte=3).id_dict(), {})
+
+    def test_objects_queryset(self):
+        """
+        Tests the case when objects are returned via a queryset.
+        """
+        G(models.TestModel, int_field=1)
+        model_obj = G(models.TestModel, int_field=2)
+        self.assertEqual(models.TestModel.objects.filter(int_field__gte=2).id_dict(), {model_obj.id: model_obj})
+
+    def test_evaluated_queryset(self):
+        """
+        Tests that the results of an evaluated queryset are used without querying again.
+        """
+        model_obj = G(models.TestModel, int_field=1)
+        queryset = models.TestModel.objects.all()
+        list(queryset)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(queryset.id_dict(), {model_obj.id: model_obj})
+
+    def test_key(self):
+        """
+        Tests keying the objects on another field.
+        """
+        model_obj1 = G(models.TestModel, int_field=1)
+        model_obj2 = G(models.TestModel, int_field=2)
+        self.assertEqual(models.TestModel.objects.id_dict(key='int_field'), {1: model_obj1, 2: model_obj2})
+
+    def test_composite_key_fields(self):
+        """
+        Tests keying the values of fields on a composite key.
+        """
+        G(models.TestModel, int_field=1, char_field='1', float_field=1.0)
+        G(models.TestModel, int_field=2, char_field='2', float_field=2.0)
+        self.assertEqual(
+            models.TestModel.objects.id_dict(key=['int_field', 'char_field'], fields=['float_field', 'char_field']),
+            {(1, '1'): (1.0, '1'), (2, '2'): (2.0, '2')}
+        )
+
+    def test_foreign_key_fields_streamed(self):
+        """
+        Tests streaming the values of fields keyed on a foreign key.
+        """
+        fk_obj1 = G(models.TestForeignKeyModel, int_field=1)
+        fk_obj2 = G(models.TestForeignKeyModel, int_field=2)
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                id_dict(models.TestForeignKeyModel.objects, key='test_model', fields=['int_field'], chunk_size=1),
+                {fk_obj1.test_model_id: (1,), fk_obj2.test_model_id: (2,)}
+            )
+
+    def test_objects_streamed(self):
+        """
+        Tests streaming the objects keyed on their ID.
+        """
+        model_obj1 = G(models.TestModel, int_field=1)
+        model_obj2 = G(models.TestModel, int_field=2)
+        self.assertEqual(
+            models.TestModel.objects.all().id_dict(chunk_size=1),
+            {model_obj1.id: model_obj1, model_obj2.id: model_obj2}
+        )
+
+
+class GetOrNoneTest(TestCase):
+    """
+    Tests the get_or_none function in the manager utils
+    """
+    def test_existing_using_objects(self):
+        """
+        Tests get_or_none on an existing object from Model.objects.
+        """
+        # Create an existing model
+        model_obj = G(models.TestModel)
         # Verify that get_or_none on objects returns the test model
         self.assertEqual(model_obj, models.TestModel.objects.get_or_none(id=model_obj.id))
 
@@ -1582,6 +3421,70 @@ class GetOrNoneTest(TestCase):
         self.assertIsNone(models.TestModel.objects.filter(id=1).get_or_none(id=1))
 
 
+class GetOrNoneManyTest(TestCase):
+    """
+    Tests the get_or_none_many function.
+    """
+    def test_single_field(self):
+        test_obj1 = G(models.TestModel, int_field=1)
+        test_obj2 = G(models.TestModel, int_field=2)
+
+        with self.assertNumQueries(1):
+            model_objs = models.TestModel.objects.get_or_none_many('int_field', [1, 2, 3])
+
+        self.assertEqual(model_objs, {1: test_obj1, 2: test_obj2, 3: None})
+
+    def test_composite_fields_batched(self):
+        test_obj1 = G(models.TestModel, int_field=1, char_field='1')
+        test_obj2 = G(models.TestModel, int_field=2, char_field=None)
+
+        with self.assertNumQueries(2):
+            model_objs = models.TestModel.objects.all().get_or_none_many(
+                ['int_field', 'char_field'], [(1, '1'), (2, None), (1, '2')], batch_size=2)
+
+        self.assertEqual(model_objs, {(1, '1'): test_obj1, (2, None): test_obj2, (1, '2'): None})
+
+    def test_keys_normalized_to_same_value(self):
+        test_obj = G(models.TestModel, int_field=1)
+
+        model_objs = models.TestModel.objects.get_or_none_many('int_field', [1, '1', 2])
+
+        self.assertEqual(model_objs, {1: test_obj, '1': test_obj, 2: None})
+
+    def test_keys_normalized(self):
+        test_fk_obj = G(models.TestForeignKeyModel, int_field=1)
+
+        model_objs = models.TestForeignKeyModel.objects.get_or_none_many('test_model', [str(test_fk_obj.test_model_id)])
+
+        self.assertEqual(model_objs, {str(test_fk_obj.test_model_id): test_fk_obj})
+
+    def test_only(self):
+        G(models.TestModel, int_field=1, char_field='1')
+
+        model_objs = models.TestModel.objects.get_or_none_many('int_field', [1], only=['char_field'])
+
+        self.assertEqual(model_objs[1].get_deferred_fields(), {'float_field', 'json_field', 'array_field', 'time_zone'})
+        self.assertEqual(model_objs[1].char_field, '1')
+
+    def test_values(self):
+        G(models.TestModel, int_field=1, char_field='1')
+
+        model_objs = models.TestModel.objects.get_or_none_many('int_field', [1, 2], values=['char_field'])
+
+        self.assertEqual(model_objs, {1: {'int_field': 1, 'char_field': '1'}, 2: None})
+
+    def test_no_keys(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(models.TestModel.objects.get_or_none_many('int_field', []), {})
+
+    def test_multiple_objects(self):
+        G(models.TestModel, int_field=1, char_field='1')
+        G(models.TestModel, int_field=2, char_field='1')
+
+        with self.assertRaises(models.TestModel.MultipleObjectsReturned):
+            models.TestModel.objects.get_or_none_many('char_field', ['1'])
+
+
 class SingleTest(TestCase):
     """
     Tests the single function in the manager utils.
@@ -1642,6 +3545,342 @@ class SingleTest(TestCase):
         self.assertEqual(model_obj, models.TestModel.objects.filter(id=model_obj.id).single())
 
 
+class CachedSingleTest(TestCase):
+    """
+    Tests caching the object returned by single in the process.
+    """
+    def setUp(self):
+        super().setUp()
+        manager_utils_module._single_cache.clear()
+        caches['default'].clear()
+
+    def tearDown(self):
+        super().tearDown()
+        for model in manager_utils_module._single_cache_aliases:
+            for signal in (post_bulk_operation, post_save, post_delete):
+                signal.disconnect(sender=model, dispatch_uid='manager_utils_single_cache')
+        manager_utils_module._single_cache_aliases.clear()
+
+    def test_cached(self):
+        G(models.TestModel, int_field=1)
+        model_obj = models.TestModel.objects.single(cached=True)
+
+        with self.assertNumQueries(0):
+            cached_obj = models.TestModel.objects.single(cached=True)
+            self.assertIsNot(cached_obj, model_obj)
+            self.assertEqual(cached_obj.int_field, 1)
+            self.assertEqual(models.TestModel.objects.all().single(cached=True), model_obj)
+
+    def test_does_not_exist_not_cached(self):
+        with self.assertRaises(models.TestModel.DoesNotExist):
+            models.TestModel.objects.single(cached=True)
+
+        G(models.TestModel, int_field=1)
+        self.assertEqual(models.TestModel.objects.single(cached=True).int_field, 1)
+
+    def test_empty_lookup_not_cached(self):
+        with self.assertNumQueries(0), self.assertRaises(models.TestModel.DoesNotExist):
+            models.TestModel.objects.filter(id__in=[]).single(cached=True)
+
+    def test_invalidated_on_save(self):
+        G(models.TestModel, int_field=1)
+        model_obj = models.TestModel.objects.single(cached=True)
+        model_obj.int_field = 2
+        model_obj.save()
+
+        self.assertEqual(models.TestModel.objects.single(cached=True).int_field, 2)
+
+    def test_invalidated_on_commit(self):
+        G(models.TestModel, int_field=1)
+        model_obj = models.TestModel.objects.single(cached=True)
+        model_obj.int_field = 2
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            model_obj.save()
+            # A concurrent reader caches the row before the save is committed
+            models.TestModel.objects.single(cached=True)
+
+        for callback in callbacks:
+            callback()
+        with self.assertNumQueries(1):
+            models.TestModel.objects.single(cached=True)
+
+    def test_mutable_values_not_shared(self):
+        G(models.TestModel, int_field=1, json_field={'a': 1})
+        models.TestModel.objects.single(cached=True).json_field['a'] = 2
+
+        self.assertEqual(models.TestModel.objects.single(cached=True).json_field, {'a': 1})
+
+    def test_invalidated_on_bulk_operation(self):
+        G(models.TestModel, int_field=1)
+        models.TestModel.objects.single(cached=True)
+        models.TestModel.objects.update(int_field=2)
+
+        self.assertEqual(models.TestModel.objects.single(cached=True).int_field, 2)
+
+    def test_invalidated_on_delete(self):
+        G(models.TestModel, int_field=1)
+        models.TestModel.objects.single(cached=True).delete()
+
+        with self.assertRaises(models.TestModel.DoesNotExist):
+            models.TestModel.objects.single(cached=True)
+
+    def test_other_models_not_invalidated(self):
+        G(models.TestModel, int_field=1)
+        models.TestModel.objects.single(cached=True)
+        G(models.TestPkChar, my_key='1')
+
+        with self.assertNumQueries(0):
+            models.TestModel.objects.single(cached=True)
+
+    def test_ttl(self):
+        G(models.TestModel, int_field=1)
+
+        with patch('manager_utils.manager_utils.time.monotonic', return_value=100):
+            models.TestModel.objects.single(cached=True, ttl=10)
+        with patch('manager_utils.manager_utils.time.monotonic', return_value=109), self.assertNumQueries(0):
+            models.TestModel.objects.single(cached=True, ttl=10)
+        with patch('manager_utils.manager_utils.time.monotonic', return_value=110), self.assertNumQueries(1):
+            models.TestModel.objects.single(cached=True, ttl=10)
+
+    def test_not_cached_when_invalidated_during_fetch(self):
+        G(models.TestModel, int_field=1)
+        orig_get = QuerySet.get
+
+        def get(queryset, *args, **kwargs):
+            model_obj = orig_get(queryset, *args, **kwargs)
+            post_bulk_operation.send(sender=models.TestModel, model=models.TestModel)
+            return model_obj
+
+        with patch.object(QuerySet, 'get', get):
+            models.TestModel.objects.single(cached=True)
+
+        with self.assertNumQueries(1):
+            models.TestModel.objects.single(cached=True)
+
+    def test_invalidated_across_processes(self):
+        G(models.TestModel, int_field=1)
+        models.TestModel.objects.single(cached=True, cache_alias='default')
+
+        with self.assertNumQueries(0):
+            models.TestModel.objects.single(cached=True, cache_alias='default')
+
+        # Another process changes the model and bumps the shared version
+        caches['default'].set('manager_utils.single.tests.TestModel', 'other')
+        with self.assertNumQueries(1):
+            models.TestModel.objects.single(cached=True, cache_alias='default')
+            models.TestModel.objects.single(cached=True, cache_alias='default')
+
+    def test_invalidation_bumps_shared_version(self):
+        G(models.TestModel, int_field=1)
+        models.TestModel.objects.single(cached=True, cache_alias='default')
+        self.assertIsNone(caches['default'].get('manager_utils.single.tests.TestModel'))
+
+        models.TestModel.objects.update(int_field=2)
+        self.assertIsNotNone(caches['default'].get('manager_utils.single.tests.TestModel'))
+
+    def test_registered_writer_bumps_shared_version(self):
+        # A process that only writes the model registers the alias without calling single
+        register_cached_single(models.TestModel, 'default')
+
+        G(models.TestModel, int_field=1)
+        self.assertIsNotNone(caches['default'].get('manager_utils.single.tests.TestModel'))
+
+
+class ClaimTest(TestCase):
+    """
+    Tests the claim function.
+    """
+    def test_claim_empty_queryset(self):
+        G(models.TestModel, int_field=1, char_field='pending')
+
+        self.assertEqual(models.TestModel.objects.none().claim(1, {'char_field': 'claimed'}), [])
+        self.assertEqual(models.TestModel.objects.filter(pk__in=[]).claim(1, {'char_field': 'claimed'}), [])
+        self.assertFalse(models.TestModel.objects.filter(char_field='claimed').exists())
+
+    def test_claim(self):
+        for i in range(5):
+            G(models.TestModel, int_field=i, char_field='pending')
+
+        with CaptureQueriesContext(connection) as queries:
+            claimed = models.TestModel.objects.filter(char_field='pending').order_by('int_field').claim(
+                2, {'char_field': 'claimed'})
+
+        self.assertEqual(sorted((obj.int_field, obj.char_field) for obj in claimed), [(0, 'claimed'), (1, 'claimed')])
+        self.assertEqual(
+            list(models.TestModel.objects.filter(char_field='claimed').order_by('int_field').values_list(
+                'int_field', flat=True)),
+            [0, 1]
+        )
+        claim_sql = [query['sql'] for query in queries.captured_queries if 'UPDATE' in query['sql']]
+        self.assertEqual(len(claim_sql), 1)
+        self.assertIn('FOR UPDATE OF "tests_testmodel" SKIP LOCKED', claim_sql[0])
+        self.assertIn('RETURNING', claim_sql[0])
+
+    def test_claim_across_nullable_relation(self):
+        claimable = G(models.TestModel, int_field=1, char_field='pending')
+        G(models.TestForeignKeyModel, test_model=G(models.TestModel, int_field=2, char_field='pending'))
+
+        # Only the rows of the model are locked, not the nullable side of the outer join
+        claimed = models.TestModel.objects.filter(testforeignkeymodel__isnull=True).claim(
+            10, {'char_field': 'claimed'})
+
+        self.assertEqual([obj.id for obj in claimed], [claimable.id])
+
+    def test_claim_expressions(self):
+        G(models.TestModel, int_field=1, char_field='job', float_field=1.0)
+
+        claimed = models.TestModel.objects.claim(
+            10, {'char_field': Concat(F('char_field'), Value('-claimed')), 'float_field': F('float_field') + 1})
+
+        self.assertEqual([(obj.char_field, obj.float_field) for obj in claimed], [('job-claimed', 2.0)])
+        self.assertFalse(claimed[0]._state.adding)
+
+    def test_claim_none(self):
+        G(models.TestModel, int_field=1, char_field='claimed')
+        self.assertEqual(models.TestModel.objects.filter(char_field='pending').claim(1, {'char_field': 'x'}), [])
+
+    @patch.object(post_bulk_operation, 'send', spec_set=True)
+    def test_claim_signal(self, mock_send):
+        models.TestModel.objects.claim(1, {'char_field': 'claimed'})
+        mock_send.assert_called_once_with(sender=models.TestModel, model=models.TestModel)
+
+
+class ClaimSkipLockedTest(TransactionTestCase):
+    """
+    Tests that claim skips rows locked by other transactions.
+    """
+    def test_claim_skips_locked_rows(self):
+        for i in range(3):
+            G(models.TestModel, int_field=i, char_field='pending')
+
+        # Lock the first row in another session
+        other_connection = connection.copy()
+        self.addCleanup(other_connection.close)
+        other_connection.set_autocommit(False)
+        with other_connection.cursor() as cursor:
+            cursor.execute('SELECT * FROM tests_testmodel WHERE int_field = 0 FOR UPDATE')
+
+        claimed = models.TestModel.objects.order_by('int_field').claim(2, {'char_field': 'claimed'})
+        other_connection.rollback()
+
+        self.assertEqual(sorted(obj.int_field for obj in claimed), [1, 2])
+
+
+class IdentityMapTest(TestCase):
+    """
+    Tests memoizing get_or_none and single in an identity map.
+    """
+    def test_get_or_none_cached(self):
+        test_obj = G(models.TestModel, int_field=1)
+
+        with identity_map(), self.assertNumQueries(1):
+            model_obj = models.TestModel.objects.get_or_none(int_field=1)
+            self.assertIs(models.TestModel.objects.get_or_none(int_field=1), model_obj)
+            self.assertIs(models.TestModel.objects.all().get_or_none(int_field=1), model_obj)
+
+        self.assertEqual(model_obj.id, test_obj.id)
+
+    def test_get_or_none_none_cached(self):
+        with identity_map(), self.assertNumQueries(1):
+            self.assertIsNone(models.TestModel.objects.get_or_none(int_field=1))
+            self.assertIsNone(models.TestModel.objects.get_or_none(int_field=1))
+
+    def test_different_lookups(self):
+        G(models.TestModel, int_field=1, char_field='1')
+        G(models.TestModel, int_field=2, char_field='1')
+
+        with identity_map(), self.assertNumQueries(3):
+            self.assertEqual(models.TestModel.objects.get_or_none(int_field=1).int_field, 1)
+            self.assertEqual(models.TestModel.objects.get_or_none(int_field=2).int_field, 2)
+            self.assertIsNone(models.TestModel.objects.filter(char_field='2').get_or_none(int_field=1))
+
+    def test_empty_lookup_not_cached(self):
+        with identity_map(), self.assertNumQueries(0):
+            self.assertIsNone(models.TestModel.objects.get_or_none(id__in=[]))
+            self.assertIsNone(models.TestModel.objects.get_or_none(id__in=[]))
+
+    def test_single_cached(self):
+        G(models.TestModel, int_field=1)
+
+        with identity_map(), self.assertNumQueries(1):
+            self.assertIs(models.TestModel.objects.single(), models.TestModel.objects.single())
+
+    def test_single_does_not_exist_not_cached(self):
+        with identity_map(), self.assertNumQueries(2):
+            for i in range(2):
+                with self.assertRaises(models.TestModel.DoesNotExist):
+                    models.TestModel.objects.single()
+
+    def test_invalidated_on_save(self):
+        with identity_map():
+            self.assertIsNone(models.TestModel.objects.get_or_none(int_field=1))
+            G(models.TestModel, int_field=1)
+            self.assertEqual(models.TestModel.objects.get_or_none(int_field=1).int_field, 1)
+
+    def test_invalidated_on_delete(self):
+        test_obj = G(models.TestModel, int_field=1)
+
+        with identity_map():
+            self.assertEqual(models.TestModel.objects.single().id, test_obj.id)
+            models.TestModel.objects.filter(id=test_obj.id).delete()
+            with self.assertRaises(models.TestModel.DoesNotExist):
+                models.TestModel.objects.single()
+
+    def test_invalidated_on_bulk_operation(self):
+        G(models.TestModel, int_field=1, char_field='1')
+
+        with identity_map():
+            self.assertEqual(models.TestModel.objects.get_or_none(int_field=1).char_field, '1')
+            models.TestModel.objects.update(char_field='2')
+            self.assertEqual(models.TestModel.objects.get_or_none(int_field=1).char_field, '2')
+
+    def test_not_invalidated_by_other_models(self):
+        G(models.TestModel, int_field=1)
+
+        with identity_map(), self.assertNumQueries(2):
+            model_obj = models.TestModel.objects.get_or_none(int_field=1)
+            models.TestPkChar.objects.update(char_field='2')
+            self.assertIs(models.TestModel.objects.get_or_none(int_field=1), model_obj)
+
+    def test_not_invalidated_by_other_contexts(self):
+        G(models.TestModel, int_field=1)
+
+        with identity_map(), self.assertNumQueries(1):
+            model_obj = models.TestModel.objects.get_or_none(int_field=1)
+            contextvars.Context().run(post_bulk_operation.send, sender=models.TestModel, model=models.TestModel)
+            self.assertIs(models.TestModel.objects.get_or_none(int_field=1), model_obj)
+
+    def test_nested(self):
+        G(models.TestModel, int_field=1)
+
+        with identity_map():
+            model_obj = models.TestModel.objects.get_or_none(int_field=1)
+            with identity_map():
+                self.assertIsNot(models.TestModel.objects.get_or_none(int_field=1), model_obj)
+            self.assertIs(models.TestModel.objects.get_or_none(int_field=1), model_obj)
+
+    def test_receivers_disconnected(self):
+        with identity_map():
+            self.assertTrue(post_delete.has_listeners(models.TestModel))
+
+        self.assertFalse(post_delete.has_listeners(models.TestModel))
+        with self.assertNumQueries(2):
+            models.TestModel.objects.get_or_none(int_field=1)
+            models.TestModel.objects.get_or_none(int_field=1)
+
+    def test_middleware(self):
+        G(models.TestModel, int_field=1)
+
+        def get_response(request):
+            return [models.TestModel.objects.get_or_none(int_field=1) for i in range(2)]
+
+        with self.assertNumQueries(1):
+            model_objs = IdentityMapMiddleware(get_response)(None)
+
+        self.assertIs(model_objs[0], model_objs[1])
+
+
 class BulkUpdateTest(TestCase):
     """
     Tests the bulk_update function.
@@ -2025,3 +4264,252 @@ class UpsertTest(TestCase):
         self.assertEqual(model_obj.int_field, 1)
         self.assertEqual(model_obj.float_field, 2.0)
         self.assertEqual(model_obj.char_field, 'Hello')
+
+
+class UpsertNativeTest(TestCase):
+    """
+    Tests the upsert method with a native postgres upsert.
+    """
+    def test_creation_defaults_updates(self):
+        with self.assertNumQueries(1):
+            model_obj, created = models.TestModel.objects.upsert(
+                int_field=1, defaults={'float_field': 1.0, 'char_field': '1'}, updates={'char_field': '2'},
+                native=True)
+
+        self.assertTrue(created)
+        self.assertEqual((model_obj.int_field, model_obj.float_field, model_obj.char_field), (1, 1.0, '2'))
+        self.assertEqual(model_obj.id, models.TestModel.objects.get(int_field=1).id)
+        self.assertEqual(model_obj.json_field, {})
+
+    def test_no_creation_defaults_updates(self):
+        extant_obj = G(models.TestModel, int_field=1, float_field=1.0, char_field='1')
+
+        with self.assertNumQueries(1):
+            model_obj, created = upsert(
+                models.TestModel.objects, int_field=1, defaults={'float_field': 2.0}, updates={'char_field': '2'},
+                native=True)
+
+        self.assertFalse(created)
+        self.assertEqual((model_obj.id, model_obj.float_field, model_obj.char_field), (extant_obj.id, 1.0, '2'))
+        model_obj = models.TestModel.objects.get(id=extant_obj.id)
+        self.assertEqual((model_obj.float_field, model_obj.char_field), (1.0, '2'))
+
+    def test_no_creation_no_update(self):
+        extant_obj = G(models.TestModel, int_field=1, float_field=1.0, char_field='1')
+
+        with self.assertNumQueries(1):
+            model_obj, created = models.TestModel.objects.upsert(
+                int_field=1, updates={'char_field': '1'}, native=True)
+
+        self.assertFalse(created)
+        self.assertEqual((model_obj.id, model_obj.char_field), (extant_obj.id, '1'))
+
+    def test_no_creation_no_updates_argument(self):
+        extant_obj = G(models.TestModel, int_field=1, float_field=1.0)
+
+        model_obj, created = models.TestModel.objects.upsert(int_field=1, defaults={'float_field': 2.0}, native=True)
+
+        self.assertFalse(created)
+        self.assertEqual((model_obj.id, model_obj.float_field), (extant_obj.id, 1.0))
+
+    def test_char_pk(self):
+        model_obj, created = models.TestPkChar.objects.upsert(my_key='1', updates={'char_field': '1'}, native=True)
+        self.assertTrue(created)
+
+        model_obj, created = models.TestPkChar.objects.upsert(my_key='1', updates={'char_field': '2'}, native=True)
+        self.assertFalse(created)
+        self.assertEqual(models.TestPkChar.objects.get(my_key='1').char_field, '2')
+
+    def test_fk_pk(self):
+        test_model = G(models.TestModel)
+
+        model_obj, created = models.TestPkForeignKey.objects.upsert(
+            my_key=test_model, updates={'char_field': '1'}, native=True)
+        self.assertTrue(created)
+        self.assertEqual((model_obj.my_key_id, model_obj.char_field), (test_model.id, '1'))
+
+        model_obj, created = models.TestPkForeignKey.objects.upsert(
+            my_key=test_model, updates={'char_field': '2'}, native=True)
+        self.assertFalse(created)
+        self.assertEqual(models.TestPkForeignKey.objects.get(my_key=test_model).char_field, '2')
+
+    def test_concurrent_insert_not_visible(self):
+        extant_obj = G(models.TestModel, int_field=1)
+
+        with patch('manager_utils.manager_utils.upsert2.upsert', return_value=upsert2.UpsertResult()):
+            model_obj, created = models.TestModel.objects.upsert(int_field=1, native=True)
+
+        self.assertFalse(created)
+        self.assertEqual(model_obj.id, extant_obj.id)
+
+    @patch.object(post_bulk_operation, 'send', spec_set=True)
+    def test_signal(self, mock_send):
+        models.TestModel.objects.upsert(int_field=1, native=True)
+        mock_send.assert_called_once_with(sender=models.TestModel, model=models.TestModel)
+
+
+class UpsertBufferTest(TestCase):
+    """
+    Tests buffering upserts with an UpsertBuffer.
+    """
+    def test_flush_on_exit(self):
+        extant_obj = G(models.TestModel, int_field=1, float_field=1.0, char_field='1')
+
+        with self.assertNumQueries(1):
+            with models.TestModel.objects.upsert_buffer() as buffer:
+                buffer.upsert(int_field=1, defaults={'float_field': 2.0}, updates={'char_field': '2'})
+                buffer.upsert(int_field=2, defaults={'float_field': 2.0}, updates={'char_field': '2'})
+                self.assertEqual(len(buffer), 2)
+
+        self.assertEqual(len(buffer), 0)
+        self.assertEqual(
+            models.TestModel.objects.values_list('id', 'float_field', 'char_field').get(int_field=1),
+            (extant_obj.id, 1.0, '2')
+        )
+        self.assertEqual(
+            models.TestModel.objects.values_list('float_field', 'char_field').get(int_field=2), (2.0, '2')
+        )
+
+    def test_not_flushed_on_exception(self):
+        with self.assertRaises(ValueError):
+            with UpsertBuffer(models.TestModel.objects.all()) as buffer:
+                buffer.upsert(int_field=1)
+                raise ValueError
+
+        self.assertFalse(models.TestModel.objects.exists())
+        self.assertEqual(len(buffer), 1)
+
+    def test_coalesced_last_write_wins(self):
+        with self.assertNumQueries(1):
+            with models.TestModel.objects.upsert_buffer() as buffer:
+                buffer.upsert(int_field=1, defaults={'float_field': 1.0, 'char_field': '0'},
+                              updates={'char_field': '1'})
+                buffer.upsert(int_field=1, defaults={'float_field': 2.0}, updates={'char_field': '2'})
+                buffer.upsert(int_field=1, updates={'char_field': '3'})
+                self.assertEqual(len(buffer), 1)
+
+        self.assertEqual(
+            list(models.TestModel.objects.values_list('int_field', 'float_field', 'char_field')), [(1, 1.0, '3')]
+        )
+
+    def test_coalesced_updates_merged(self):
+        G(models.TestModel, int_field=1, float_field=1.0, char_field='1')
+
+        with models.TestModel.objects.upsert_buffer() as buffer:
+            buffer.upsert(int_field=1, updates={'char_field': '2'})
+            buffer.upsert(int_field=1, updates={'float_field': 2.0})
+
+        self.assertEqual(
+            list(models.TestModel.objects.values_list('int_field', 'float_field', 'char_field')), [(1, 2.0, '2')]
+        )
+
+    def test_different_fields(self):
+        G(models.TestModel, int_field=1, float_field=1.0, char_field='1')
+
+        with self.assertNumQueries(2):
+            with models.TestModel.objects.upsert_buffer() as buffer:
+                buffer.upsert(int_field=1, defaults={'char_field': '2'})
+                buffer.upsert(int_field=2, char_field='2', updates={'float_field': 2.0})
+
+        self.assertEqual(
+            list(models.TestModel.objects.order_by('int_field').values_list('int_field', 'float_field', 'char_field')),
+            [(1, 1.0, '1'), (2, 2.0, '2')]
+        )
+
+    def test_flush_on_size(self):
+        buffer = models.TestModel.objects.all().upsert_buffer(max_size=2)
+        buffer.upsert(int_field=1)
+        self.assertFalse(models.TestModel.objects.exists())
+
+        buffer.upsert(int_field=1, updates={'char_field': '1'})
+        self.assertFalse(models.TestModel.objects.exists())
+
+        buffer.upsert(int_field=2)
+        self.assertEqual(models.TestModel.objects.count(), 2)
+        self.assertEqual(len(buffer), 0)
+
+    def test_flush_on_age(self):
+        buffer = UpsertBuffer(models.TestModel.objects.all(), max_age=10)
+
+        with patch('manager_utils.manager_utils.time.monotonic', return_value=100):
+            buffer.upsert(int_field=1)
+        with patch('manager_utils.manager_utils.time.monotonic', return_value=109):
+            buffer.upsert(int_field=2)
+        self.assertFalse(models.TestModel.objects.exists())
+
+        with patch('manager_utils.manager_utils.time.monotonic', return_value=110):
+            buffer.upsert(int_field=3)
+        self.assertEqual(models.TestModel.objects.count(), 3)
+
+    def test_flush_empty(self):
+        with self.assertNumQueries(0):
+            models.TestModel.objects.upsert_buffer().flush()
+
+    def test_foreign_key(self):
+        test_model = G(models.TestModel)
+
+        with models.TestPkForeignKey.objects.upsert_buffer() as buffer:
+            buffer.upsert(my_key=test_model, updates={'char_field': '1'})
+            buffer.upsert(my_key=test_model, updates={'char_field': '2'})
+
+        self.assertEqual(
+            list(models.TestPkForeignKey.objects.values_list('my_key', 'char_field')), [(test_model.id, '2')]
+        )
+
+    def test_normalized_keys(self):
+        test_model = G(models.TestModel)
+
+        with models.TestPkForeignKey.objects.upsert_buffer() as buffer:
+            buffer.upsert(my_key=test_model, updates={'char_field': '1'})
+            buffer.upsert(my_key_id=str(test_model.id), updates={'char_field': '2'})
+            self.assertEqual(len(buffer), 1)
+
+        self.assertEqual(
+            list(models.TestPkForeignKey.objects.values_list('my_key', 'char_field')), [(test_model.id, '2')]
+        )
+
+    def test_failed_flush_restored(self):
+        buffer = models.TestModel.objects.upsert_buffer()
+        buffer.upsert(int_field=1, updates={'char_field': '1'})
+        buffer.upsert(int_field=2)
+
+        # The upsert of the first set of fields is written before the second one fails
+        with patch('manager_utils.manager_utils.bulk_upsert2', side_effect=[None, DatabaseError], spec_set=True):
+            with self.assertRaises(DatabaseError):
+                buffer.flush()
+        self.assertEqual(len(buffer), 1)
+
+        # Upserts buffered after the failure are coalesced with the restored ones
+        buffer.upsert(int_field=2, updates={'float_field': 1.0})
+        buffer.flush()
+
+        self.assertEqual(len(buffer), 0)
+        self.assertEqual(list(models.TestModel.objects.values_list('int_field', 'float_field')), [(2, 1.0)])
+
+    def test_failed_flush_coalesced_with_new_upserts(self):
+        buffer = models.TestModel.objects.upsert_buffer()
+        buffer.upsert(int_field=1, updates={'char_field': '1', 'float_field': 1.0})
+
+        def bulk_upsert2(*args, **kwargs):
+            # Another thread buffers an upsert of the same object while the flush is writing
+            buffer.upsert(int_field=1, updates={'char_field': '2'})
+            buffer.upsert(int_field=3)
+            raise DatabaseError
+
+        with patch('manager_utils.manager_utils.bulk_upsert2', bulk_upsert2), self.assertRaises(DatabaseError):
+            buffer.flush()
+        self.assertEqual(len(buffer), 2)
+
+        buffer.flush()
+        self.assertEqual(
+            list(models.TestModel.objects.order_by('int_field').values_list('int_field', 'char_field', 'float_field')),
+            [(1, '2', 1.0), (3, None, None)]
+        )
+
+    @patch('manager_utils.manager_utils.bulk_upsert2', spec_set=True)
+    def test_retry_policy(self, mock_bulk_upsert2):
+        retry_policy = RetryPolicy()
+        with models.TestModel.objects.upsert_buffer(retry_policy=retry_policy) as buffer:
+            buffer.upsert(int_field=1)
+
+        self.assertEqual(mock_bulk_upsert2.call_args[1]['retry_policy'], retry_policy)
@@ -1,5 +1,6 @@
 from django.contrib.postgres.fields import JSONField, ArrayField
 from django.db import models
+from django.db.models import Q
 from manager_utils import ManagerUtilsManager
 from timezone_field import TimeZoneField
 
@@ -57,6 +58,30 @@ class TestForeignKeyModel(models.Model):
     objects = ManagerUtilsManager()
 
 
+class TestChildModel(models.Model):
+    """
+    A test model that is unique within its parent.
+    """
+    int_field = models.IntegerField()
+    char_field = models.CharField(max_length=128, null=True)
+    test_model = models.ForeignKey(TestModel, on_delete=models.CASCADE)
+
+    objects = ManagerUtilsManager()
+
+    class Meta:
+        unique_together = ('test_model', 'int_field')
+
+
+class TestM2MModel(models.Model):
+    """
+    A test model with a many to many relation.
+    """
+    int_field = models.IntegerField(null=True)
+    test_models = models.ManyToManyField(TestModel)
+
+    objects = ManagerUtilsManager()
+
+
 class TestPkForeignKey(models.Model):
     """
     A test model with a primary key thats a foreign key to another model.
@@ -75,3 +100,35 @@ class TestPkChar(models.Model):
     char_field = models.CharField(max_length=128, null=True)
 
     objects = ManagerUtilsManager()
+
+
+class TestHashModel(models.Model):
+    """
+    A test model with a field that stores a hash of its contents.
+    """
+    int_field = models.IntegerField(null=True, unique=True)
+    char_field = models.CharField(max_length=128, null=True)
+    json_field = JSONField(default=dict)
+    array_field = ArrayField(models.CharField(max_length=128), default=list)
+    content_hash = models.CharField(max_length=64, null=True)
+
+    objects = ManagerUtilsManager()
+
+
+class TestPartialUniqueModel(models.Model):
+    """
+    A test model with a partial unique index and a named unique constraint.
+    """
+    int_field = models.IntegerField()
+    char_field = models.CharField(max_length=128, null=True)
+    float_field = models.FloatField(null=True)
+    deleted_at = models.DateTimeField(null=True)
+
+    objects = ManagerUtilsManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['int_field'], condition=Q(deleted_at__isnull=True),
+                                    name='partial_unique_int_field'),
+            models.UniqueConstraint(fields=['char_field'], name='unique_char_field'),
+        ]
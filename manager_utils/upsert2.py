@@ -1,9 +1,18 @@
 """
 The new interface for manager utils upsert
 """
-from collections import namedtuple
+from collections import Counter, namedtuple
+from contextlib import nullcontext
+from functools import reduce
+import hashlib
+import json
+import operator
 
-from django.db import connection, models
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, models, transaction
+from django.db.models.expressions import CombinedExpression
+from django.core.exceptions import EmptyResultSet
+from django.db.models.sql import Query, UpdateQuery
 from django.utils import timezone
 
 
@@ -12,8 +21,13 @@ class UpsertResult(list):
     Returned by the upsert operation.
 
     Wraps a list and provides properties to access created, updated,
-    untouched, and deleted elements
+    untouched, and deleted elements. The number of times the operation
+    was retried is available in ``retries`` and the number of duplicate
+    input rows that were collapsed is available in ``collapsed``
     """
+    retries = 0
+    collapsed = 0
+
     @property
     def created(self):
         return (i for i in self if i.status_ == 'c')
@@ -31,10 +45,49 @@ class UpsertResult(list):
         return (i for i in self if i.status_ == 'd')
 
 
+class Excluded(models.Expression):
+    """
+    References the value of a field in the row proposed for insertion by an upsert. Used in
+    merge expressions of update fields, for example ``F('count') + Excluded('count')``
+    """
+    def __init__(self, name):
+        super().__init__()
+        self.name = name
+
+    def resolve_expression(self, query=None, allow_joins=True, reuse=None, summarize=False, for_save=False):
+        excluded = self.copy()
+        excluded.output_field = query.model._meta.get_field(self.name)
+        return excluded
+
+    def as_sql(self, compiler, connection):
+        return 'EXCLUDED.{0}'.format(_quote(self.output_field.column)), []
+
+
 def _quote(field):
     return '"{0}"'.format(field)
 
 
+def _get_merge_expression(model, attname, merge):
+    """
+    Get the expression that merges the value of a field in the row proposed for insertion with
+    the value of the existing row. A merge is either an expression or the name of a merger
+    """
+    field = model._meta.get_field(attname)
+    mergers = {
+        'add': lambda: models.F(attname) + Excluded(attname),
+        'greatest': lambda: models.Func(models.F(attname), Excluded(attname), function='GREATEST'),
+        'least': lambda: models.Func(models.F(attname), Excluded(attname), function='LEAST'),
+        # Merges jsonb objects and appends arrays
+        'concat': lambda: CombinedExpression(models.F(attname), '||', Excluded(attname), output_field=field),
+    }
+
+    if isinstance(merge, str):
+        if merge not in mergers:
+            raise ValueError('Invalid merger {0} for {1}. Must be one of {2}'.format(merge, attname, sorted(mergers)))
+        return mergers[merge]()
+    return merge
+
+
 def _get_update_fields(model, uniques, to_update):
     """
     Get the fields to be updated in an upsert.
@@ -61,6 +114,20 @@ def _get_update_fields(model, uniques, to_update):
     return to_update
 
 
+def _get_sync_update_fields(model, update_fields, on_missing, revive):
+    """
+    Get the fields to be updated in a sync that marks missing rows with the values of on_missing.
+
+    The fields that mark missing rows are only updated when reviving rows that reappear
+    """
+    missing_attnames = [model._meta.get_field(field).attname for field in on_missing]
+    update_fields = [attname for attname in update_fields if attname not in missing_attnames]
+    if revive:
+        update_fields.extend(missing_attnames)
+
+    return update_fields
+
+
 def _fill_auto_fields(model, values):
     """
     Given a list of models, fill in auto_now and auto_now_add fields
@@ -80,12 +147,124 @@ def _fill_auto_fields(model, values):
     return values
 
 
-def _sort_by_unique_fields(model, model_objs, unique_fields):
+def _fill_hash_field(model, model_objs, update_fields, hash_field):
+    """
+    Given a list of models, fill in the hash field with a hash of the update fields. The fields are
+    hashed in their serialized string form, which every field supports. Automatically generated date
+    times are not hashed since they change on every upsert.
+    """
+    hash_attname = model._meta.get_field(hash_field).attname
+    hashed_fields = sorted([
+        field for field in model._meta.fields
+        if (field.attname in update_fields
+            and field.attname != hash_attname
+            and not getattr(field, 'auto_now', False))
+    ], key=lambda field: field.attname)
+
+    for model_obj in model_objs:
+        values = [[field.attname, field.value_to_string(model_obj)] for field in hashed_fields]
+        setattr(model_obj, hash_attname, hashlib.sha256(
+            json.dumps(values, cls=DjangoJSONEncoder, sort_keys=True).encode('utf-8')
+        ).hexdigest())
+
+    return model_objs
+
+
+def _filter_by_unique_keys(queryset, unique_attnames, unique_keys):
+    """
+    Filters a queryset down to the rows that match any of the provided unique keys.
+    """
+    if len(unique_attnames) == 1:
+        attname = unique_attnames[0]
+        values = [unique_key[0] for unique_key in unique_keys]
+        lookup = models.Q(**{'{0}__in'.format(attname): [value for value in values if value is not None]})
+        if None in values:
+            lookup |= models.Q(**{'{0}__isnull'.format(attname): True})
+    else:
+        lookup = reduce(operator.or_, (
+            models.Q(**dict(zip(unique_attnames, unique_key)))
+            for unique_key in unique_keys
+        ))
+
+    return queryset.filter(lookup)
+
+
+def _fetch_hashes(queryset, model_objs, unique_fields, hash_field, batch_size, returned_fields=()):
+    """
+    Fetch the primary key, returned fields, hash, and unique fields of the rows of the queryset matching the
+    models in batches
+    """
+    unique_attnames = [field.attname for field in unique_fields]
+    for i in range(0, len(model_objs), batch_size):
+        unique_keys = [
+            tuple(getattr(model_obj, attname) for attname in unique_attnames)
+            for model_obj in model_objs[i:i + batch_size]
+        ]
+        yield from _filter_by_unique_keys(queryset, unique_attnames, unique_keys).values_list(
+            'pk', *[field.attname for field in list(returned_fields) + [hash_field] + unique_fields]
+        )
+
+
+def _exclude_unchanged(queryset, model_objs, unique_fields, update_fields, hash_field=None, batch_size=1000,
+                       returned_fields=()):
+    """
+    Given a list of models, prefetch the stored values of the matching rows and exclude the
+    models that are unchanged. If a hash field is provided, only the hashes of the rows matching
+    the models are fetched. Otherwise the unique and update fields of every row in the queryset
+    are streamed in one query and compared with the models. Returns the models to upsert and
+    the primary key of each excluded row paired with the values of its returned fields.
+    """
+    model = queryset.model
+    unique_fields = [model._meta.get_field(unique_field) for unique_field in unique_fields]
+
+    def get_values(model_obj, fields):
+        return tuple(field.to_python(getattr(model_obj, field.attname)) for field in fields)
+
+    # Null values never conflict, so models with null unique fields are always upserted
+    keyed_model_objs = [model_obj for model_obj in model_objs if None not in get_values(model_obj, unique_fields)]
+
+    if hash_field:
+        compared_fields = [model._meta.get_field(hash_field)]
+        rows = _fetch_hashes(queryset, keyed_model_objs, unique_fields, compared_fields[0], batch_size,
+                             returned_fields)
+    else:
+        # Automatically generated date times change on every upsert and are not compared
+        compared_fields = [
+            field for field in model._meta.fields
+            if field.attname in update_fields and not getattr(field, 'auto_now', False)
+        ]
+        rows = queryset.values_list(
+            'pk', *[field.attname for field in list(returned_fields) + compared_fields + unique_fields]
+        ).iterator(chunk_size=batch_size)
+
+    # Each row is its primary key followed by the returned, compared, and unique fields
+    num_returned = len(returned_fields)
+    num_fetched = 1 + num_returned + len(compared_fields)
+    extant_values = {
+        row[num_fetched:]: (row[:1 + num_returned], row[1 + num_returned:num_fetched]) for row in rows
+    }
+
+    to_upsert = []
+    unchanged = []
+    for model_obj in model_objs:
+        key = get_values(model_obj, unique_fields)
+        returned, values = extant_values.get(key, (None, None)) if None not in key else (None, None)
+        if returned is not None and values == get_values(model_obj, compared_fields):
+            unchanged.append((returned[0], returned[1:]))
+        else:
+            to_upsert.append(model_obj)
+
+    return to_upsert, unchanged
+
+
+def _sort_by_unique_fields(model, model_objs, unique_fields, on_duplicate_input=None):
     """
     Sort a list of models by their unique fields.
 
     Sorting models in an upsert greatly reduces the chances of deadlock
-    when doing concurrent upserts
+    when doing concurrent upserts. Models with the same unique fields can
+    optionally be collapsed, keeping the first or last one, since postgres
+    cannot update a row twice in an upsert
     """
     unique_fields = [
         field for field in model._meta.fields
@@ -98,7 +277,26 @@ def _sort_by_unique_fields(model, model_objs, unique_fields):
                                    connection)
             for field in unique_fields
         )
-    return sorted(model_objs, key=sort_key)
+    keyed_model_objs = [(sort_key(model_obj), model_obj) for model_obj in model_objs]
+
+    if on_duplicate_input is not None:
+        if on_duplicate_input not in ('first', 'last', 'error'):
+            raise ValueError('on_duplicate_input must be one of "first", "last", or "error"')
+
+        collapsed = {}
+        null_keyed_model_objs = []
+        for key, model_obj in keyed_model_objs:
+            # Null values never conflict, so they are never duplicates
+            if None in key:
+                null_keyed_model_objs.append((key, model_obj))
+            elif key not in collapsed or on_duplicate_input == 'last':
+                collapsed[key] = model_obj
+            elif on_duplicate_input == 'error':
+                raise ValueError('Duplicate values {0} for unique fields {1}'.format(
+                    key, [field.attname for field in unique_fields]))
+        keyed_model_objs = list(collapsed.items()) + null_keyed_model_objs
+
+    return [model_obj for key, model_obj in sorted(keyed_model_objs, key=operator.itemgetter(0))]
 
 
 def _get_values_for_row(model_obj, all_fields):
@@ -110,18 +308,88 @@ def _get_values_for_row(model_obj, all_fields):
     ]
 
 
-def _get_values_for_rows(model_objs, all_fields):
+def _get_natural_key_values(model_obj, natural_keys):
+    """
+    Get the values of the natural keys of the parents that are assigned to the foreign keys of a model.
+    The values are null when no parent is assigned
+    """
+    values = []
+    for fk, parent_fields in natural_keys:
+        parent = fk.get_cached_value(model_obj, None)
+        values.extend(
+            field.get_db_prep_save(getattr(parent, field.attname) if parent is not None else None, connection)
+            for field in parent_fields
+        )
+
+    return values
+
+
+def _get_natural_keys(model, natural_keys, on_unresolved):
+    """
+    Get the foreign keys of a model that are resolved from the natural keys of their parents, paired
+    with the fields of the natural keys
+    """
+    if on_unresolved not in ('error', 'skip', 'null'):
+        raise ValueError('on_unresolved must be one of "error", "skip", or "null"')
+
+    resolved_natural_keys = []
+    for fk_name, parent_fields in (natural_keys or {}).items():
+        fk = model._meta.get_field(fk_name)
+        parent_fields = [parent_fields] if isinstance(parent_fields, str) else parent_fields
+        resolved_natural_keys.append((fk, [fk.related_model._meta.get_field(field) for field in parent_fields]))
+
+    return resolved_natural_keys
+
+
+def _check_natural_keys(model_objs, natural_keys, on_unresolved):
+    """
+    Raise a ValueError when the natural keys of any model don't match a parent. The natural keys of
+    every foreign key are checked with one anti-join against the parent table. Models without a natural
+    key, such as models that assign the foreign key directly, are not checked
+    """
+    if on_unresolved != 'error' or not model_objs:
+        return
+
+    for fk, parent_fields in natural_keys:
+        row_values, sql_args = _get_values_for_rows(model_objs, [], [(fk, parent_fields)])
+        columns_sql = ', '.join('"nk_{0}"'.format(i) for i in range(len(parent_fields)))
+        sql = (
+            'SELECT DISTINCT {columns_sql} FROM (VALUES {row_values_sql}) AS r({columns_sql})'
+            ' WHERE NOT ({null_natural_key_sql})'
+            ' AND NOT EXISTS (SELECT 1 FROM {parent_table} AS p WHERE {conditions_sql})'
+        ).format(
+            columns_sql=columns_sql,
+            null_natural_key_sql=' AND '.join('"nk_{0}" IS NULL'.format(i) for i in range(len(parent_fields))),
+            row_values_sql=', '.join(row_values),
+            parent_table=_quote(fk.related_model._meta.db_table),
+            conditions_sql=' AND '.join(
+                'p.{0} = r."nk_{1}"'.format(_quote(field.column), i) for i, field in enumerate(parent_fields)
+            )
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, sql_args)
+            unresolved = cursor.fetchall()
+        if unresolved:
+            raise ValueError('Unresolved natural keys {0} of {1} for {2}'.format(
+                unresolved, [field.attname for field in parent_fields], fk.name
+            ))
+
+
+def _get_values_for_rows(model_objs, all_fields, natural_keys=()):
     row_values = []
     sql_args = []
+    # The natural keys of the parents of a row follow its fields
+    natural_key_fields = [field for fk, parent_fields in natural_keys for field in parent_fields]
 
     for i, model_obj in enumerate(model_objs):
         sql_args.extend(_get_values_for_row(model_obj, all_fields))
+        sql_args.extend(_get_natural_key_values(model_obj, natural_keys))
         if i == 0:
             row_values.append('({0})'.format(
-                ', '.join(['%s::{0}'.format(f.db_type(connection)) for f in all_fields]))
+                ', '.join(['%s::{0}'.format(f.db_type(connection)) for f in all_fields + natural_key_fields]))
             )
         else:
-            row_values.append('({0})'.format(', '.join(['%s'] * len(all_fields))))
+            row_values.append('({0})'.format(', '.join(['%s'] * (len(all_fields) + len(natural_key_fields)))))
 
     return row_values, sql_args
 
@@ -138,13 +406,137 @@ def _get_return_fields_sql(returning, return_status=False, alias=None):
     return return_fields_sql
 
 
+def _compile_expression(model, expression):
+    """
+    Compile an expression or a Q object on the fields of a model to sql. F expressions reference
+    the existing row of the upsert
+    """
+    compiler = Query(model).get_compiler(connection=connection)
+    return compiler.compile(expression.resolve_expression(compiler.query))
+
+
+def _compile_condition(model, condition):
+    """
+    Compile a condition on the fields of a model to sql. The condition is either a Q object, an
+    expression, or raw sql
+    """
+    if isinstance(condition, str):
+        return condition, []
+    return _compile_expression(model, condition)
+
+
+def _get_conflict_target_sql(model, unique_fields, unique_constraint, unique_condition):
+    """
+    Get the conflict target of an upsert. It is either the name of a unique constraint or the
+    unique fields with an optional predicate of a partial unique index
+    """
+    if unique_constraint:
+        return 'ON CONSTRAINT {0}'.format(_quote(unique_constraint)), []
+
+    unique_field_names_sql = ', '.join([_quote(field.column) for field in unique_fields])
+    if unique_condition is None:
+        return '({0})'.format(unique_field_names_sql), []
+
+    unique_condition_sql, unique_condition_args = _compile_condition(model, unique_condition)
+    return '({0}) WHERE {1}'.format(unique_field_names_sql, unique_condition_sql), unique_condition_args
+
+
+def _get_update_values_sql(model, update_fields, update_expressions):
+    """
+    Get the sql of the values that update fields are set to in an upsert. Fields without a merge
+    expression are set to the value of the row proposed for insertion
+    """
+    update_values_sql = []
+    update_values_args = []
+    for field in update_fields:
+        if field.attname in update_expressions:
+            sql, args = _compile_expression(model, update_expressions[field.attname])
+        else:
+            sql, args = 'EXCLUDED.' + _quote(field.column), []
+        update_values_sql.append(sql)
+        update_values_args.extend(args)
+
+    return update_values_sql, update_values_args
+
+
+def _get_input_rows_sql(all_fields, row_values_sql, natural_keys, on_unresolved):
+    """
+    Get the sql of the input_rows CTE of an upsert. The rows are numbered by temp_id_. Foreign keys with
+    natural keys are resolved by left joining the parent tables on the natural keys that follow the fields
+    of each row. Rows without a natural key keep their foreign key. Rows with unresolved natural keys are
+    either filtered out or have a null foreign key
+    """
+    all_field_names_sql = ', '.join([_quote(field.column) for field in all_fields])
+    if not natural_keys:
+        return 'input_rows("temp_id_", {0}) AS (VALUES {1})'.format(all_field_names_sql, row_values_sql)
+
+    natural_key_columns = [
+        ['nk_{0}_{1}'.format(i, j) for j in range(len(parent_fields))]
+        for i, (fk, parent_fields) in enumerate(natural_keys)
+    ]
+    resolved_columns_sql = {
+        fk.column: 'COALESCE(p{0}.{1}, r.{2})'.format(i, _quote(fk.target_field.column), _quote(fk.column))
+        for i, (fk, parent_fields) in enumerate(natural_keys)
+    }
+    joins_sql = ' '.join(
+        'LEFT JOIN {parent_table} AS p{i} ON {conditions}'.format(
+            parent_table=_quote(fk.related_model._meta.db_table),
+            i=i,
+            conditions=' AND '.join(
+                'p{0}.{1} = r.{2}'.format(i, _quote(field.column), _quote(column))
+                for field, column in zip(parent_fields, natural_key_columns[i])
+            )
+        )
+        for i, (fk, parent_fields) in enumerate(natural_keys)
+    )
+    # Skipped rows have a natural key that matches no parent
+    skip_sql = ''
+    if on_unresolved == 'skip':
+        skip_sql = 'WHERE ' + ' AND '.join(
+            '(p{0}.{1} IS NOT NULL OR ({2}))'.format(
+                i, _quote(parent_fields[0].column),
+                ' AND '.join('r.{0} IS NULL'.format(_quote(column)) for column in natural_key_columns[i])
+            )
+            for i, (fk, parent_fields) in enumerate(natural_keys)
+        )
+
+    return (
+        'input_rows AS ('
+        '     SELECT r."temp_id_", {select_sql}'
+        '     FROM (VALUES {row_values_sql}) AS r("temp_id_", {all_field_names_sql}, {natural_key_columns_sql})'
+        '     {joins_sql} {skip_sql}'
+        ')'
+    ).format(
+        select_sql=', '.join(
+            '{0} AS {1}'.format(
+                resolved_columns_sql.get(field.column, 'r.' + _quote(field.column)), _quote(field.column)
+            )
+            for field in all_fields
+        ),
+        row_values_sql=row_values_sql,
+        all_field_names_sql=all_field_names_sql,
+        natural_key_columns_sql=', '.join(_quote(column) for columns in natural_key_columns for column in columns),
+        joins_sql=joins_sql,
+        skip_sql=skip_sql
+    )
+
+
 def _get_upsert_sql(queryset, model_objs, unique_fields, update_fields, returning,
-                    ignore_duplicate_updates=True, return_untouched=False):
+                    ignore_duplicate_updates=True, return_untouched=False, hash_field=None,
+                    update_expressions=None, update_condition=None, unique_constraint=None,
+                    unique_condition=None, natural_keys=(), on_unresolved='error'):
     """
     Generates the postgres specific sql necessary to perform an upsert (ON CONFLICT)
     INSERT INTO table_name (field1, field2)
     VALUES (1, 'two')
     ON CONFLICT (unique_field) DO UPDATE SET field2 = EXCLUDED.field2;
+
+    If a hash field is provided, duplicate updates are detected by only comparing the hash field.
+    Update expressions map update fields to merge expressions of the existing and proposed rows.
+    An update condition is an additional predicate that rows must satisfy to be updated.
+    The conflict target is the unique fields unless the name of a unique constraint is provided.
+    A unique condition is the predicate of a partial unique index on the unique fields.
+    Foreign keys with natural keys are resolved by joining the input rows to the parent tables.
     """
     model = queryset.model
 
@@ -171,45 +563,72 @@ def _get_upsert_sql(queryset, model_objs, unique_fields, update_fields, returnin
     unique_field_names_sql = ', '.join([
         _quote(field.column) for field in unique_fields
     ])
+    conflict_target_sql, conflict_target_args = _get_conflict_target_sql(
+        model, unique_fields, unique_constraint, unique_condition
+    )
+    update_values_sql, update_values_args = _get_update_values_sql(model, update_fields, update_expressions or {})
     update_fields_sql = ', '.join([
-        '{0} = EXCLUDED.{0}'.format(_quote(field.column))
-        for field in update_fields
+        '{0} = {1}'.format(_quote(field.column), update_value_sql)
+        for field, update_value_sql in zip(update_fields, update_values_sql)
     ])
 
-    row_values, sql_args = _get_values_for_rows(model_objs, all_fields)
+    row_values, sql_args = _get_values_for_rows(model_objs, all_fields, natural_keys)
+    sql_args.extend(conflict_target_args)
+    sql_args.extend(update_values_args)
 
     return_sql = 'RETURNING ' + _get_return_fields_sql(returning, return_status=True) if returning else ''
-    ignore_duplicates_sql = ''
+    update_conditions_sql = []
     if ignore_duplicate_updates:
-        ignore_duplicates_sql = (
-            ' WHERE ({update_fields_sql}) IS DISTINCT FROM ({excluded_update_fields_sql}) '
+        # Compare the hash field instead of every update field. Merged fields are compared with their
+        # merged values
+        if hash_field:
+            compared_fields = [model._meta.get_field(hash_field)]
+            compared_values_sql = ['EXCLUDED.' + _quote(compared_fields[0].column)]
+        else:
+            compared_fields = update_fields
+            compared_values_sql = update_values_sql
+            sql_args.extend(update_values_args)
+        update_conditions_sql.append((
+            '({update_fields_sql}) IS DISTINCT FROM ({excluded_update_fields_sql})'
         ).format(
             update_fields_sql=', '.join(
                 '{0}.{1}'.format(model._meta.db_table, _quote(field.column))
-                for field in update_fields
+                for field in compared_fields
             ),
-            excluded_update_fields_sql=', '.join(
-                'EXCLUDED.' + _quote(field.column)
-                for field in update_fields
-            )
-        )
+            excluded_update_fields_sql=', '.join(compared_values_sql)
+        ))
+
+    if update_condition is not None:
+        update_condition_sql, update_condition_args = _compile_condition(model, update_condition)
+        update_conditions_sql.append('({0})'.format(update_condition_sql))
+        sql_args.extend(update_condition_args)
+
+    ignore_duplicates_sql = ' WHERE {0} '.format(' AND '.join(update_conditions_sql)) if update_conditions_sql else ''
 
     on_conflict = (
         'DO UPDATE SET {0} {1}'.format(update_fields_sql, ignore_duplicates_sql) if update_fields else 'DO NOTHING'
     )
 
-    if return_untouched:
+    if return_untouched or natural_keys:
         row_values_sql = ', '.join([
             '(\'{0}\', {1})'.format(i, row_value[1:-1])
             for i, row_value in enumerate(row_values)
         ])
+        input_rows_sql = _get_input_rows_sql(all_fields, row_values_sql, natural_keys, on_unresolved)
+
+    if return_untouched:
+        # Only join the rows covered by a partial unique index
+        extant_rows_sql = model._meta.db_table
+        if unique_condition is not None:
+            unique_condition_sql, unique_condition_args = _compile_condition(model, unique_condition)
+            extant_rows_sql = '(SELECT * FROM {0} WHERE {1})'.format(model._meta.db_table, unique_condition_sql)
+            sql_args.extend(unique_condition_args)
+
         sql = (
-            ' WITH input_rows("temp_id_", {all_field_names_sql}) AS ('
-            '     VALUES {row_values_sql}'
-            ' ), ins AS ( '
+            ' WITH {input_rows_sql}, ins AS ( '
             '     INSERT INTO {table_name} ({all_field_names_sql})'
             '     SELECT {all_field_names_sql} FROM input_rows ORDER BY temp_id_'
-            '     ON CONFLICT ({unique_field_names_sql}) {on_conflict} {return_sql}'
+            '     ON CONFLICT {conflict_target_sql} {on_conflict} {return_sql}'
             ' )'
             ' SELECT DISTINCT ON ({table_pk_name}) * FROM ('
             '     SELECT status_, {return_fields_sql}'
@@ -217,31 +636,47 @@ def _get_upsert_sql(queryset, model_objs, unique_fields, update_fields, returnin
             '     UNION  ALL'
             '     SELECT \'n\' AS status_, {aliased_return_fields_sql}'
             '     FROM input_rows'
-            '     JOIN {table_name} c USING ({unique_field_names_sql})'
+            '     JOIN {extant_rows_sql} c USING ({unique_field_names_sql})'
             ' ) as results'
             ' ORDER BY results."{table_pk_name}", CASE WHEN(status_ = \'n\') THEN 1 ELSE 0 END;'
         ).format(
+            input_rows_sql=input_rows_sql,
             all_field_names_sql=all_field_names_sql,
-            row_values_sql=row_values_sql,
             table_name=model._meta.db_table,
             unique_field_names_sql=unique_field_names_sql,
+            conflict_target_sql=conflict_target_sql,
+            extant_rows_sql=extant_rows_sql,
             on_conflict=on_conflict,
             return_sql=return_sql,
-            table_pk_name=model._meta.pk.name,
+            table_pk_name=model._meta.pk.column,
             return_fields_sql=_get_return_fields_sql(returning),
             aliased_return_fields_sql=_get_return_fields_sql(returning, alias='c')
         )
+    elif natural_keys:
+        sql = (
+            ' WITH {input_rows_sql}'
+            ' INSERT INTO {table_name} ({all_field_names_sql})'
+            ' SELECT {all_field_names_sql} FROM input_rows ORDER BY temp_id_'
+            ' ON CONFLICT {conflict_target_sql} {on_conflict} {return_sql}'
+        ).format(
+            input_rows_sql=input_rows_sql,
+            table_name=model._meta.db_table,
+            all_field_names_sql=all_field_names_sql,
+            conflict_target_sql=conflict_target_sql,
+            on_conflict=on_conflict,
+            return_sql=return_sql
+        )
     else:
         row_values_sql = ', '.join(row_values)
         sql = (
             ' INSERT INTO {table_name} ({all_field_names_sql})'
             ' VALUES {row_values_sql}'
-            ' ON CONFLICT ({unique_field_names_sql}) {on_conflict} {return_sql}'
+            ' ON CONFLICT {conflict_target_sql} {on_conflict} {return_sql}'
         ).format(
             table_name=model._meta.db_table,
             all_field_names_sql=all_field_names_sql,
             row_values_sql=row_values_sql,
-            unique_field_names_sql=unique_field_names_sql,
+            conflict_target_sql=conflict_target_sql,
             on_conflict=on_conflict,
             return_sql=return_sql
         )
@@ -249,50 +684,307 @@ def _get_upsert_sql(queryset, model_objs, unique_fields, update_fields, returnin
     return sql, sql_args
 
 
+def _get_dry_run_updated_sql(model, update_fields, ignore_duplicate_updates, hash_field, update_expressions,
+                             update_condition):
+    """
+    Get the condition of a dry run that matched rows are updated on. It mirrors the conditions of the
+    update of an upsert, and rows are always updated without any condition
+    """
+    if not update_fields:
+        return 'FALSE', []
+
+    update_conditions_sql = []
+    sql_args = []
+    if ignore_duplicate_updates:
+        if hash_field:
+            compared_fields = [model._meta.get_field(hash_field)]
+            compared_values_sql = ['EXCLUDED.' + _quote(compared_fields[0].column)]
+        else:
+            compared_fields = update_fields
+            compared_values_sql, sql_args = _get_update_values_sql(model, update_fields, update_expressions or {})
+        update_conditions_sql.append('({0}) IS DISTINCT FROM ({1})'.format(
+            ', '.join(
+                '{0}.{1}'.format(_quote(model._meta.db_table), _quote(field.column)) for field in compared_fields
+            ),
+            ', '.join(compared_values_sql)
+        ))
+
+    if update_condition is not None:
+        update_condition_sql, update_condition_args = _compile_condition(model, update_condition)
+        update_conditions_sql.append('({0})'.format(update_condition_sql))
+        sql_args.extend(update_condition_args)
+
+    return ' AND '.join(update_conditions_sql) or 'TRUE', sql_args
+
+
+def _get_dry_run_deleted_sql(queryset, unique_fields):
+    """
+    Get the sql of a dry run that selects the rows of the queryset that no input row matches
+    """
+    try:
+        queryset_sql, queryset_args = queryset.values('pk').query.sql_with_params()
+    except EmptyResultSet:
+        return '', []
+
+    table_sql = _quote(queryset.model._meta.db_table)
+    pk_sql = '{0}.{1}'.format(table_sql, _quote(queryset.model._meta.pk.column))
+    deleted_sql = (
+        ' UNION ALL'
+        ' SELECT \'d\', {table_unique_fields_sql}'
+        ' FROM {table_sql}'
+        ' WHERE {pk_sql} IN ({queryset_sql})'
+        ' AND NOT EXISTS (SELECT 1 FROM diff WHERE diff.pk_ = {pk_sql})'
+    ).format(
+        table_unique_fields_sql=', '.join('{0}.{1}'.format(table_sql, _quote(field.column)) for field in unique_fields),
+        table_sql=table_sql,
+        pk_sql=pk_sql,
+        queryset_sql=queryset_sql
+    )
+    return deleted_sql, list(queryset_args)
+
+
+def _get_dry_run_sql(queryset, model_objs, unique_fields, update_fields, sync, return_keys,
+                     ignore_duplicate_updates=True, hash_field=None, update_expressions=None,
+                     update_condition=None, unique_condition=None):
+    """
+    Generates the sql that computes the statuses of an upsert without performing it. The input rows
+    are left joined against the table on the unique fields with the same names as an upsert, so the
+    existing row is the table and the proposed row is EXCLUDED:
+
+    WITH input_rows(field1, field2) AS (VALUES (1, 'two'))
+    SELECT CASE WHEN table_name.id IS NULL THEN 'c' WHEN ... THEN 'u' ELSE 'n' END AS status_
+    FROM input_rows AS EXCLUDED LEFT JOIN table_name ON table_name.field1 = EXCLUDED.field1;
+
+    In a sync, rows of the queryset that no input row matches are deleted. Either the count of each
+    status or the unique fields of every row with its status are selected.
+    """
+    model = queryset.model
+    table_sql = _quote(model._meta.db_table)
+    pk_sql = '{0}.{1}'.format(table_sql, _quote(model._meta.pk.column))
+
+    all_fields = [
+        field for field in model._meta.fields
+        if field.column != model._meta.pk.name or not field.auto_created
+    ]
+    all_field_names_sql = ', '.join([_quote(field.column) for field in all_fields])
+    unique_fields = [model._meta.get_field(unique_field) for unique_field in unique_fields]
+    update_fields = [model._meta.get_field(update_field) for update_field in update_fields]
+
+    if model_objs:
+        row_values, sql_args = _get_values_for_rows(model_objs, all_fields)
+        input_rows_sql = 'VALUES {0}'.format(', '.join(row_values))
+    else:
+        input_rows_sql = 'SELECT {0} FROM {1} LIMIT 0'.format(all_field_names_sql, table_sql)
+        sql_args = []
+
+    updated_sql, updated_args = _get_dry_run_updated_sql(
+        model, update_fields, ignore_duplicate_updates, hash_field, update_expressions, update_condition
+    )
+    sql_args.extend(updated_args)
+
+    # Only join the rows covered by a partial unique index
+    extant_rows_sql = table_sql
+    if unique_condition is not None:
+        unique_condition_sql, unique_condition_args = _compile_condition(model, unique_condition)
+        extant_rows_sql = '(SELECT * FROM {0} WHERE {1}) AS {0}'.format(table_sql, unique_condition_sql)
+        sql_args.extend(unique_condition_args)
+
+    deleted_sql, deleted_args = _get_dry_run_deleted_sql(queryset, unique_fields) if sync else ('', [])
+    sql_args.extend(deleted_args)
+
+    if return_keys:
+        select_sql = 'SELECT * FROM results'
+    else:
+        select_sql = 'SELECT status_, COUNT(*) FROM results GROUP BY status_'
+
+    sql = (
+        ' WITH input_rows({all_field_names_sql}) AS ({input_rows_sql}),'
+        ' diff AS ('
+        '     SELECT {pk_sql} AS pk_,'
+        '            CASE WHEN {pk_sql} IS NULL THEN \'c\' WHEN {updated_sql} THEN \'u\' ELSE \'n\' END AS status_,'
+        '            {excluded_unique_fields_sql}'
+        '     FROM input_rows AS EXCLUDED'
+        '     LEFT JOIN {extant_rows_sql} ON {join_sql}'
+        ' ), results AS ('
+        '     SELECT status_, {diff_unique_fields_sql} FROM diff{deleted_sql}'
+        ' )'
+        ' {select_sql}'
+    ).format(
+        all_field_names_sql=all_field_names_sql,
+        input_rows_sql=input_rows_sql,
+        pk_sql=pk_sql,
+        updated_sql=updated_sql,
+        excluded_unique_fields_sql=', '.join('EXCLUDED.' + _quote(field.column) for field in unique_fields),
+        extant_rows_sql=extant_rows_sql,
+        join_sql=' AND '.join(
+            '{0}.{1} = EXCLUDED.{1}'.format(table_sql, _quote(field.column)) for field in unique_fields
+        ),
+        diff_unique_fields_sql=', '.join(_quote(field.column) for field in unique_fields),
+        deleted_sql=deleted_sql,
+        select_sql=select_sql
+    )
+
+    return sql, sql_args
+
+
+def _dry_run(queryset, model_objs, unique_fields, update_fields, returning, sync, **kwargs):
+    """
+    Compute the statuses of an upsert without performing it. Returns a Counter of the statuses, or
+    the unique fields of every row with its status if returning
+    """
+    model = queryset.model
+    sql, sql_args = _get_dry_run_sql(
+        queryset, model_objs, unique_fields, update_fields, sync, bool(returning), **kwargs
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, sql_args)
+        rows = cursor.fetchall()
+
+    if not returning:
+        return Counter(dict(rows))
+
+    nt_result = namedtuple('DryRunResult', [
+        'status_'
+    ] + [model._meta.get_field(unique_field).attname for unique_field in unique_fields])
+    return UpsertResult(nt_result(*row) for row in rows)
+
+
+def _mark_missing(model, pks, on_missing):
+    """
+    Mark the rows missing from a sync by updating them with the values of on_missing instead
+    of deleting them. Returns the primary keys of the marked rows
+    """
+    if not pks:
+        return []
+
+    update_query = UpdateQuery(model)
+    update_query.add_update_values(on_missing)
+    update_query.add_q(models.Q(pk__in=pks))
+    update_sql, update_sql_args = update_query.get_compiler(connection=connection).as_sql()
+    with connection.cursor() as cursor:
+        cursor.execute('{0} RETURNING {1}'.format(update_sql, _quote(model._meta.pk.column)), update_sql_args)
+        return [row[0] for row in cursor.fetchall()]
+
+
+def _get_returned_fields(model, returning):
+    """
+    Get the fields of the returned columns of an upsert. Columns are either field columns or names
+    """
+    fields = {field.name: field for field in model._meta.fields}
+    fields.update({field.column: field for field in model._meta.fields})
+    return [fields[column] for column in returning]
+
+
 def _fetch(
     queryset, model_objs, unique_fields, update_fields, returning, sync,
-    ignore_duplicate_updates=True, return_untouched=False
+    ignore_duplicate_updates=True, return_untouched=False, return_models=False,
+    hash_field=None, exclude_unchanged=False, update_expressions=None, update_condition=None,
+    unique_constraint=None, unique_condition=None, on_missing=None, natural_keys=(), on_unresolved='error'
 ):
     """
     Perfom the upsert and do an optional sync operation
     """
     model = queryset.model
+    returning = True if return_models else returning
     if (return_untouched or sync) and returning is not True:
         returning = set(returning) if returning else set()
-        returning.add(model._meta.pk.name)
+        returning.add(model._meta.pk.column)
+    returning = [f.column for f in model._meta.fields] if returning is True else returning
     upserted = []
     deleted = []
+    unchanged = []
     # We must return untouched rows when doing a sync operation
     return_untouched = True if sync else return_untouched
 
+    if model_objs and exclude_unchanged:
+        # Unchanged rows are returned with the same fields as the upserted rows
+        returning = list(returning or [])
+        model_objs, unchanged = _exclude_unchanged(
+            queryset, model_objs, unique_fields, update_fields, hash_field=hash_field,
+            returned_fields=_get_returned_fields(model, returning if return_untouched else [])
+        )
+
     if model_objs:
         sql, sql_args = _get_upsert_sql(queryset, model_objs, unique_fields, update_fields, returning,
                                         ignore_duplicate_updates=ignore_duplicate_updates,
-                                        return_untouched=return_untouched)
+                                        return_untouched=return_untouched,
+                                        hash_field=hash_field,
+                                        update_expressions=update_expressions,
+                                        update_condition=update_condition,
+                                        unique_constraint=unique_constraint,
+                                        unique_condition=unique_condition,
+                                        natural_keys=natural_keys,
+                                        on_unresolved=on_unresolved)
 
-        with connection.cursor() as cursor:
-            cursor.execute(sql, sql_args)
-            if cursor.description:
-                nt_result = namedtuple('Result', [col[0] for col in cursor.description])
-                upserted = [nt_result(*row) for row in cursor.fetchall()]
+        if return_models:
+            # Hydrate models from the returned rows. The status of each row is annotated on its model
+            upserted = list(queryset.raw(sql, sql_args))
+        else:
+            with connection.cursor() as cursor:
+                cursor.execute(sql, sql_args)
+                if cursor.description:
+                    nt_result = namedtuple('Result', [col[0] for col in cursor.description])
+                    upserted = [nt_result(*row) for row in cursor.fetchall()]
 
-    pk_field = model._meta.pk.name
+    pk_field = model._meta.pk.column
     if sync:
-        orig_ids = queryset.values_list(pk_field, flat=True)
-        deleted = set(orig_ids) - {getattr(r, pk_field) for r in upserted}
-        model.objects.filter(pk__in=deleted).delete()
+        orig_ids = queryset.values_list('pk', flat=True)
+        deleted = set(orig_ids) - {r.pk if return_models else getattr(r, pk_field) for r in upserted}
+        deleted -= {pk for pk, values in unchanged}
+        if on_missing:
+            deleted = _mark_missing(model, deleted, on_missing)
+        else:
+            model.objects.filter(pk__in=deleted).delete()
+
+    # Rows excluded because they are unchanged are returned as untouched with the fetched returned fields
+    if return_untouched:
+        nt_unchanged_result = namedtuple('UnchangedResult', list(returning) + ['status_'])
+        unchanged = [nt_unchanged_result(*values, 'n') for pk, values in unchanged]
+    else:
+        unchanged = []
 
-    nt_deleted_result = namedtuple('DeletedResult', [model._meta.pk.name, 'status_'])
+    nt_deleted_result = namedtuple('DeletedResult', [pk_field, 'status_'])
     return UpsertResult(
-        upserted + [nt_deleted_result(**{pk_field: d, 'status_': 'd'}) for d in deleted]
+        upserted + unchanged + [nt_deleted_result(**{pk_field: d, 'status_': 'd'}) for d in deleted]
     )
 
 
+def _validate_upsert_args(sync, return_models, hash_field, exclude_unchanged, update_expressions,
+                          unique_constraint, unique_condition, on_missing, dry_run, natural_keys):
+    """
+    Raise a ValueError for combinations of upsert arguments that are not supported
+    """
+    if exclude_unchanged and return_models:
+        raise ValueError('exclude_unchanged cannot return models')
+    if update_expressions and (hash_field or exclude_unchanged):
+        raise ValueError('Merged update fields cannot be used with a hash_field or exclude_unchanged')
+    if unique_condition is not None and (unique_constraint or exclude_unchanged):
+        raise ValueError('unique_condition cannot be used with a unique_constraint or exclude_unchanged')
+    if on_missing and not sync:
+        raise ValueError('on_missing can only be used in a sync')
+    if dry_run and return_models:
+        raise ValueError('A dry_run cannot return models')
+    if natural_keys and (hash_field or exclude_unchanged or dry_run):
+        raise ValueError('natural_keys cannot be used with a hash_field, exclude_unchanged, or a dry_run')
+
+
 def upsert(
     queryset, model_objs, unique_fields,
     update_fields=None, returning=False, sync=False,
     ignore_duplicate_updates=True,
-    return_untouched=False
+    return_untouched=False,
+    return_models=False,
+    hash_field=None,
+    exclude_unchanged=False,
+    on_duplicate_input=None,
+    update_condition=None,
+    unique_constraint=None,
+    unique_condition=None,
+    on_missing=None,
+    revive=False,
+    dry_run=False,
+    natural_keys=None,
+    on_unresolved='error'
 ):
     """
     Perform a bulk upsert on a table, optionally syncing the results.
@@ -304,26 +996,118 @@ def upsert(
             if sync=True.
         unique_fields (List[str]): A list of fields that define the uniqueness of the model. The
             model must have a unique constraint on these fields
-        update_fields (List[str], default=None): A list of fields to update whenever objects
-            already exist. If an empty list is provided, it is equivalent to doing a bulk
-            insert on the objects that don't exist. If `None`, all fields will be updated.
+        update_fields (List[str]|Dict[str, str|Expression], default=None): A list of fields to update
+            whenever objects already exist. If an empty list is provided, it is equivalent to doing a bulk
+            insert on the objects that don't exist. If `None`, all fields will be updated. A dictionary
+            maps fields to how they are merged with the existing row. A merge is either ``None`` to
+            overwrite the field, an expression where ``F`` references the existing row and ``Excluded``
+            references the proposed row, or one of the mergers ``'add'``, ``'greatest'``, ``'least'``,
+            or ``'concat'`` (merges jsonb objects and appends arrays)
         returning (bool|List[str]): If True, returns all fields. If a list, only returns
             fields in the list
         sync (bool, default=False): Perform a sync operation on the queryset
         ignore_duplicate_updates (bool, default=False): Don't perform an update if the row is
             a duplicate.
         return_untouched (bool, default=False): Return untouched rows by the operation
+        return_models (bool, default=False): Return hydrated models instead of rows. All fields are
+            returned and the status of each model is available on its ``status_`` attribute
+        hash_field (str, default=None): A field that stores a hash of the update fields. The hash is
+            computed for every model and duplicate updates are detected by only comparing hashes,
+            which avoids comparing wide json and array columns. The field must hold 64 characters
+        exclude_unchanged (bool, default=False): Prefetch the stored values of the rows and don't send
+            the models that are unchanged. With a ``hash_field``, the hashes of the matching rows are
+            fetched. Otherwise the unique and update fields of the whole queryset are streamed in one
+            query and compared in Python. The excluded rows are returned as untouched with the same
+            returned fields as the upserted rows
+        on_duplicate_input (str, default=None): How models with the same unique fields are handled.
+            ``'first'`` or ``'last'`` keep only the first or last of them, and ``'error'`` raises a
+            ``ValueError``. If ``None``, duplicates are sent and postgres fails the upsert. The number
+            of collapsed models is available in ``collapsed`` of the result
+        update_condition (Q|Expression|str, default=None): A condition that existing rows must meet to be
+            updated. ``F`` references the existing row and ``Excluded`` references the proposed row, for
+            example ``Q(updated_at__lt=Excluded('updated_at'))``. A string is used as raw sql. Rows that
+            don't meet the condition are untouched
+        unique_constraint (str, default=None): The name of the unique constraint that is the conflict
+            target of the upsert. The unique fields must still be the fields of the constraint
+        unique_condition (Q|Expression|str, default=None): The predicate of a partial unique index on
+            the unique fields, for example ``Q(deleted_at__isnull=True)``. Only rows that meet the
+            predicate conflict with the models. A string is used as raw sql
+        on_missing (dict, default=None): Values that rows missing from a sync are updated with instead of
+            being deleted, for example ``{'deleted_at': Now()}``. The updated rows are returned as deleted
+        revive (bool, default=False): Overwrite the fields of on_missing with the values of the models
+            when marked rows reappear in a sync. Otherwise the fields of on_missing are never updated
+        dry_run (bool, default=False): Compute what the upsert would do in a single read only query
+            instead of performing it. The input rows are joined against the table and a ``Counter`` of
+            the statuses is returned. If returning, an ``UpsertResult`` of the unique fields of every
+            row with its status is returned instead
+        natural_keys (Dict[str, str|List[str]], default=None): Maps foreign keys to the fields of their
+            parents that form a natural key, for example ``{'test_model': 'int_field'}``. The natural key
+            of each model is read from the unsaved parent that is assigned to the foreign key, such as
+            ``TestForeignKeyModel(test_model=TestModel(int_field=5))``, and the foreign key is resolved by
+            joining the parent table in the upsert. The natural key must be unique in the parent table.
+            Models without a parent assigned keep the value of their foreign key, such as ``test_model_id``
+        on_unresolved (str, default='error'): What to do with models whose natural keys don't match a parent.
+            ``'error'`` raises a ``ValueError`` before anything is written, ``'skip'`` leaves the models out
+            of the upsert, and ``'null'`` upserts them with a null foreign key
     """
     queryset = queryset if isinstance(queryset, models.QuerySet) else queryset.objects.all()
     model = queryset.model
 
+    update_expressions = {}
+    if isinstance(update_fields, dict):
+        update_expressions = {
+            attname: _get_merge_expression(model, attname, merge)
+            for attname, merge in update_fields.items() if merge is not None
+        }
+        update_fields = list(update_fields)
+    _validate_upsert_args(
+        sync, return_models, hash_field, exclude_unchanged, update_expressions, unique_constraint,
+        unique_condition, on_missing, dry_run, natural_keys
+    )
+    natural_keys = _get_natural_keys(model, natural_keys, on_unresolved)
+
     # Populate automatically generated fields in the rows like date times
     _fill_auto_fields(model, model_objs)
 
     # Sort the rows to reduce the chances of deadlock during concurrent upserts
-    model_objs = _sort_by_unique_fields(model, model_objs, unique_fields)
+    num_model_objs = len(model_objs)
+    model_objs = _sort_by_unique_fields(model, model_objs, unique_fields, on_duplicate_input=on_duplicate_input)
     update_fields = _get_update_fields(model, unique_fields, update_fields)
+    if on_missing:
+        update_fields = _get_sync_update_fields(model, update_fields, on_missing, revive)
+
+    if hash_field:
+        _fill_hash_field(model, model_objs, update_fields, hash_field)
+        # The hash must be updated along with the fields it hashes
+        hash_attname = model._meta.get_field(hash_field).attname
+        if update_fields and hash_attname not in update_fields:
+            update_fields.append(hash_attname)
+
+    _check_natural_keys(model_objs, natural_keys, on_unresolved)
+
+    if dry_run:
+        # Unchanged rows are untouched either way, so they don't have to be excluded
+        return _dry_run(queryset, model_objs, unique_fields, update_fields, returning, sync,
+                        ignore_duplicate_updates=ignore_duplicate_updates,
+                        hash_field=hash_field,
+                        update_expressions=update_expressions,
+                        update_condition=update_condition,
+                        unique_condition=unique_condition)
 
-    return _fetch(queryset, model_objs, unique_fields, update_fields, returning, sync,
-                  ignore_duplicate_updates=ignore_duplicate_updates,
-                  return_untouched=return_untouched)
+    # Rows must not be marked as missing unless the upsert that left them untouched is committed with them
+    with transaction.atomic() if on_missing else nullcontext():
+        results = _fetch(queryset, model_objs, unique_fields, update_fields, returning, sync,
+                         ignore_duplicate_updates=ignore_duplicate_updates,
+                         return_untouched=return_untouched,
+                         return_models=return_models,
+                         hash_field=hash_field,
+                         exclude_unchanged=exclude_unchanged,
+                         update_expressions=update_expressions,
+                         update_condition=update_condition,
+                         unique_constraint=unique_constraint,
+                         unique_condition=unique_condition,
+                         on_missing=on_missing,
+                         natural_keys=natural_keys,
+                         on_unresolved=on_unresolved)
+    results.collapsed = num_model_objs - len(model_objs)
+    return results